@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Read-only JSON API over the pass-up count aggregates.
+
+/api/passups/counts?group=<route|year|hour|period|type> answers from the
+bundle's count cube (pass-ups counted by route, year, hour, time period and
+type at build time): the filters select cube cells and the group sums them,
+which touches a few thousand rows whatever the number of pass-ups. Encoded
+responses are cached per data version and normalised query, and carry an
+ETag of their body, so repeated queries are a dictionary lookup and
+clients holding the body get a 304. With a shared cache (shared_cache.py),
+a query answered by one worker process is reused by the others:
+
+    curl 'http://localhost:8050/api/passups/counts?group=route&year=2019&period=6-9am'
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from export import split_values
+
+# Query parameter -> count cube column
+COUNT_GROUPS = {'route': 'Route Number', 'year': 'Year', 'hour': 'Hour', 'period': 'Time_Period', 'type': 'Pass-Up Type'}
+# Groups listed in key order rather than busiest first
+ORDERED_GROUPS = ('year', 'hour')
+# Encoded responses kept across all cities and versions
+COUNTS_CACHE_SIZE = 1024
+
+
+class QueryError(ValueError):
+    """A group or filter the API can't answer."""
+
+
+def normalise_query(args):
+    """
+    The group and filters of the request arguments, in a canonical form.
+
+    Args:
+        args (dict): 'group' (a COUNT_GROUPS key, 'route' by default), and
+            optional comma-separated filters named like the groups, plus
+            'hours' as an inclusive 'from-to' range like the export.
+
+    Returns:
+        tuple: (group, tuple of (name, sorted values) filters).
+    """
+    group = args.get('group', 'route')
+    if group not in COUNT_GROUPS:
+        raise QueryError('group must be one of %s' % ', '.join(COUNT_GROUPS))
+    filters = []
+    for name in sorted(COUNT_GROUPS):
+        if args.get(name):
+            values = split_values(args[name])
+            if name in ('year', 'hour'):
+                try:
+                    values = [int(value) for value in values]
+                except ValueError:
+                    raise QueryError('%s must be whole numbers' % name)
+            filters.append((name, tuple(sorted(set(values)))))
+    if args.get('hours'):
+        try:
+            start, end = (int(hour) for hour in args['hours'].split('-'))
+        except ValueError:
+            raise QueryError("hours must be a 'from-to' range")
+        hours = range(start, end + 1) if start <= end else list(range(start, 24)) + list(range(0, end + 1))
+        filters.append(('hours', tuple(hours)))
+    return group, tuple(filters)
+
+
+def label(value):
+    # JSON-friendly group labels: missing as null, whole numbers as ints
+    if pd.isna(value):
+        return None
+    return int(value) if isinstance(value, (int, np.integer)) else value
+
+
+def count_body(cube, version, group, filters):
+    """The encoded JSON response of one normalised query."""
+    mask = np.ones(len(cube), dtype=bool)
+    for name, values in filters:
+        column = COUNT_GROUPS.get(name, 'Hour')
+        mask &= cube[column].isin(values).fillna(False).to_numpy(dtype=bool)
+    column = COUNT_GROUPS[group]
+    counts = cube[mask].groupby(column, dropna=False, observed=True)['Count'].sum()
+    if group in ORDERED_GROUPS:
+        counts = counts.sort_index(na_position='last')
+    else:
+        counts = counts.sort_values(ascending=False, kind='stable')
+    return json.dumps({
+        'version': version,
+        'group': group,
+        'filters': {name: list(values) for name, values in filters},
+        'total': int(counts.sum()),
+        'counts': [{column: label(key), 'Count': int(count)} for key, count in counts.items()],
+    }).encode()
+
+
+def encode(bundle, group, filters):
+    body = count_body(bundle.aggregate('count_cube'), bundle.version, group, filters)
+    return body, hashlib.sha1(body).hexdigest()[:16]
+
+
+class CountsCache:
+    """
+    Encoded count responses and their ETags, least recently used dropped first; safe across threads.
+
+    Args:
+        max_entries (int): Responses kept in this process.
+        shared (shared_cache.SharedCache): Cache shared with the other worker processes, if any.
+    """
+
+    def __init__(self, max_entries=COUNTS_CACHE_SIZE, shared=None):
+        self.max_entries = max_entries
+        self.shared = shared
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, bundle, args):
+        """
+        The response of a query against a bundle.
+
+        Returns:
+            tuple: (JSON body bytes, ETag).
+
+        Raises:
+            QueryError: If the group or a filter is invalid.
+        """
+        group, filters = normalise_query(args)
+        key = (bundle.version, group, filters)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        # Computed outside the lock; two threads racing on one key compute the same bytes
+        if self.shared is not None:
+            entry = self.shared.get_or_compute('counts', bundle.version, [group, filters],
+                                               lambda: encode(bundle, group, filters))
+        else:
+            entry = encode(bundle, group, filters)
+        with self.lock:
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
@@ -1,752 +1,866 @@
 # -*- coding: utf-8 -*-
 
-import dash
-import dash_bootstrap_components as dbc
-from dash import Dash, html, dcc, Input, Output, callback, State
-import plotly.express as px
-import pandas as pd
-import geopandas as gpd
-from shapely.geometry import Point
-import osmnx as ox
-import os
-
-# Function for creating Scatter Maps
-def create_scatter_mapbox(df, lat, lon, color, hover_name, hover_data, title, zoom_level, center_lat, center_lon, mapbox_style, admin):
-    fig = px.scatter_mapbox(
-        df,
-        lat=lat,
-        lon=lon,
-        color=color,
-        hover_name=hover_name,
-        hover_data=hover_data,
-        title=title,
-        zoom=zoom_level,
-        center=dict(lat=center_lat, lon=center_lon),
-        mapbox_style=mapbox_style,
-        color_discrete_sequence=px.colors.qualitative.Light24,
-    )
+# First, so the boot profile counts the imports below (see startup.py)
+from startup import PROFILE_STARTUP, boot
 
-    # Just use the Winnipeg's boundary (lines)
-    for _, row in admin.iterrows():
-        fig.add_trace(
-            px.line_mapbox(
-                gpd.GeoDataFrame(geometry=[row.geometry.exterior], crs=admin.crs),
-                lat=row.geometry.exterior.coords.xy[1].tolist(),
-                lon=row.geometry.exterior.coords.xy[0].tolist(),
-            ).data[0]
-        )
-
-    # update the margin to fit the screen
-    fig.update_layout(
-        margin={"r": 0, "t": 0, "l": 0, "b": 0},
-    )
-
-    return fig
-
-# Function for creating Heat Maps
-def create_density_mapbox(df, lat, lon, z_col, radius, opacity, title, zoom_level, center_lat, center_lon, mapbox_style, color_continuous_scale, admin):
-    fig = px.density_mapbox(
-        df,
-        lat=lat,
-        lon=lon,
-        z=z_col,
-        radius=radius,
-        opacity=opacity,
-        title=title,
-        zoom=zoom_level,
-        center=dict(lat=center_lat, lon=center_lon),
-        mapbox_style=mapbox_style,
-        color_continuous_scale=color_continuous_scale,
-    )
+import copy
+import os
 
-    # Add Winnipeg administrative boundaries
-    for _, row in admin.iterrows():
-        fig.add_trace(
-            px.line_mapbox(
-                gpd.GeoDataFrame(geometry=[row.geometry.exterior], crs=admin.crs),
-                lat=row.geometry.exterior.coords.xy[1].tolist(),
-                lon=row.geometry.exterior.coords.xy[0].tolist(),
-            ).data[0]
-        )
-
-    # update the margin to fit the screen
-    fig.update_layout(
-        margin={"r": 0, "t": 0, "l": 0, "b": 0},
-    )
+import dash
+import dash_bootstrap_components as dbc
+import plotly.graph_objects as go
+from dash import Dash, html, dcc, dash_table, Input, Output, Patch, callback, State
+from flask import abort, jsonify, request, send_from_directory, stream_with_context
+
+from api import CountsCache, QueryError
+from cities import DEFAULT_CITY, REFRESH_SECONDS, CityRegistry, MissingBundle
+from density import raster_bounds
+from export import EXPORT_FORMATS, ExportError, export_stream
+from figures import (RECOLOURED_TABLES, SCATTER_VIEWS, ZOOM_LEVEL, map_center, route_timeseries_figure,
+                     scatter_view, view_colors, view_marker)
+from ingest import MAX_INGEST_BYTES, category_key
+from paging import PASSUP_RECORD_COLUMNS, PagedTable
+from shared_cache import SharedCache
+from vector_tiles import MAX_VIEW_POINTS, VECTOR_TILE_THRESHOLD, viewport
+boot.mark('imports')
+
+# Results and live pass-ups shared by the worker processes, see shared_cache.py
+shared_cache = SharedCache()
+# All data work happens in build.py; the web process only reads the bundles,
+# one per city, loaded on first use (see cities.py). Only the default city is
+# built here if it has no bundle, at boot; requests never wait on a build
+registry = CityRegistry(live_log=shared_cache.live_log, worker_states=shared_cache.worker_states())
+if not registry.has_bundle(DEFAULT_CITY):
+    registry.build(DEFAULT_CITY)
+registry.get(DEFAULT_CITY)
+boot.mark('bundle')
+counts_cache = CountsCache(shared=shared_cache)
+boot.mark('caches')
+
+# Main filter values showing a point scatter map
+SCATTER_FILTERS = {
+    'stop_point': 'fig',
+    'passup_point': 'fig_pass',
+    'passup_year': 'fig_YR',
+    'passup_timeperiod': 'fig_TR',
+    'passup_hour': 'fig_HR',
+    'passup_type': 'fig_TP',
+    'passup_routenumber': 'fig_RN',
+}
+# Bar chart of every main filter value, and the aggregate each bar chart shows
+BAR_FILTERS = {
+    'passup_year': 'fig_YRbar',
+    'passup_timeperiod': 'fig_TRbar',
+    'passup_hour': 'fig_HRbar',
+    'passup_type': 'fig_TPbar',
+    'passup_month': 'fig_YRbar',
+    'passup_hourly': 'fig_HRbar',
+    'passup_spikes': 'fig_spikebar',
+    'passup_corridors': 'fig_corridorbar',
+}
+BAR_AGGREGATES = {
+    'fig_RNbar': 'route_counts',
+    'fig_YRbar': 'year_counts',
+    'fig_HRbar': 'hour_counts',
+    'fig_TRbar': 'time_counts',
+    'fig_TPbar': 'type_counts',
+}
+# Main filter values, and the figure a value needs in the bundle to be offered
+MAIN_FILTER_OPTIONS = [
+    {'label': 'Bus Stops Scatter Map', 'value': 'stop_point'},
+    {'label': 'Bus Stops Heat Map', 'value': 'stop_heat'},
+    {'label': 'Passup Scatter Map', 'value': 'passup_point'},
+    {'label': 'Passup Heat Map', 'value': 'passup_heat'},
+    {'label': 'Passup by Year', 'value': 'passup_year'},
+    {'label': 'Passup by Time Period', 'value': 'passup_timeperiod'},
+    {'label': 'Passup by Hour', 'value': 'passup_hour'},
+    {'label': 'Passup by Type', 'value': 'passup_type'},
+    {'label': 'Passup by Route Number', 'value': 'passup_routenumber'},
+    {'label': 'Passup Hotspots by Month', 'value': 'passup_month'},
+    {'label': 'Passup Hotspots by Hour of Day', 'value': 'passup_hourly'},
+    {'label': 'Passup Spikes', 'value': 'passup_spikes'},
+    {'label': 'Passup Corridors', 'value': 'passup_corridors'},
+]
+OPTIONAL_FILTERS = {'passup_corridors': 'fig_corridors'}
+# Main filter values showing the pass-ups per route bars
+ROUTE_BAR_FILTERS = {'stop_point', 'stop_heat', 'passup_point', 'passup_heat', 'passup_routenumber'}
+# Seconds between two polls of the live feed
+LIVE_POLL_SECONDS = int(os.environ.get('WTC_LIVE_POLL_SECONDS', 5))
+
+
+def live_trace(records):
+    # Live pass-ups, drawn as the first trace so polls can extend data[0]
+    return go.Scattermapbox(
+        lat=records['Lat'].tolist() if len(records) else [],
+        lon=records['Long'].tolist() if len(records) else [],
+        text=live_text(records), hoverinfo='text', mode='markers', name='Live pass-ups',
+        marker=dict(size=10, color='red'),
+    ).to_plotly_json()
+
+
+def live_text(records):
+    if not len(records):
+        return []
+    return ['%s: Route %s, %s' % (time, route, kind) for time, route, kind in
+            zip(records['Time'].astype(str), records['Route'], records['Pass-Up Type'])]
+
+
+def with_live(city, fig):
+    """The scatter map with the buffered live pass-ups as its first trace."""
+    fig = fig.to_dict() if isinstance(fig, go.Figure) else fig
+    return {**fig, 'data': [live_trace(city.live_feed.records())] + list(fig['data'])}
+
+
+def bar_positions(city, name):
+    """
+    Where each category of a bar chart sits in its figure.
 
+    Returns:
+        dict: category_key -> (trace index, point index, value axis, bundle count).
+    """
+    if name not in city.bar_positions:
+        positions = {}
+        for i, trace in enumerate(city.figures[name]['data']):
+            horizontal = trace.get('orientation') == 'h'
+            categories, values = (trace['y'], trace['x']) if horizontal else (trace['x'], trace['y'])
+            for j, (category, value) in enumerate(zip(categories, values)):
+                positions[category_key(category)] = (i, j, 'x' if horizontal else 'y', value)
+        city.bar_positions[name] = positions
+    return city.bar_positions[name]
+
+
+def live_bar(city, name):
+    """The bar chart with the live pass-ups added to its counts."""
+    if name not in BAR_AGGREGATES:
+        return city.figures[name]
+    fig = copy.deepcopy(city.figures[name])
+    positions = bar_positions(city, name)
+    for category, delta in city.live_feed.count_deltas(BAR_AGGREGATES[name]).items():
+        if category in positions:
+            i, j, axis, count = positions[category]
+            fig['data'][i][axis][j] = count + delta
+            fig['data'][i]['text'][j] = count + delta
     return fig
 
-# Step 1: Read the data
-# Use the url of the csv I uploaded to github
-df_stops = pd.read_csv('https://raw.githubusercontent.com/xupeitao/winnipegteencommute.github.io/eed46f305bef43e3238668591bda862e8e899799/data/stops.txt')
-
-# Step 2: Convert stop locations into a GeoDataFrame
-geometry = [Point(xy) for xy in zip(df_stops['Long'], df_stops['Lat'])]
-gdf_stops = gpd.GeoDataFrame(df_stops, geometry=geometry)
-gdf_stops.crs = 'EPSG:4326'
-
-# Get the administrative boundary of Winnipeg using OSMnx
-city = 'Winnipeg, Canada'
-admin = ox.geocode_to_gdf(city)
-admin.crs = 4326
-
-# Step 3: Spatial Join to identify stops within the city boundary
-stops_within = gpd.sjoin(gdf_stops, admin, how="inner", predicate="within")
-
-# Step 4: Layout pre-setting, to show all the city boundary
-center_lat = stops_within['Lat'].mean() - 0.025
-center_lon = stops_within['Long'].mean()
-zoom_level = 9
-
-fig = create_scatter_mapbox(
-    df=stops_within,
-    lat='Lat',
-    lon='Long',
-    color=None,
-    hover_name='stop_name',
-    hover_data='stop_url',
-    title='<br>Winnipeg Public Transport Stops',
-    zoom_level=zoom_level,
-    center_lat=center_lat,
-    center_lon=center_lon,
-    mapbox_style="carto-positron",
-    admin=admin
-)
-
-# Heat Map
-fig_heat = create_density_mapbox(
-    df=stops_within,
-    lat='Lat',
-    lon='Long',
-    z_col=None,
-    radius=2,
-    opacity=0.5,
-    title='<br>Winnipeg Public Transport Stops Density',
-    zoom_level=zoom_level,
-    center_lat=center_lat,
-    center_lon=center_lon,
-    mapbox_style='carto-positron',
-    color_continuous_scale="Plasma",
-    admin=admin
-)
-
-# Step 1: Read the data
-# Use the url of the csv I uploaded to github
-df_passup = pd.read_csv('https://raw.githubusercontent.com/xupeitao/winnipegteencommute.github.io/eed46f305bef43e3238668591bda862e8e899799/data/Transit_Pass_ups.csv')
 
-# Step 2: Data Cleaning
-print("Number of Rows before deleting:", len(df_passup))
-
-# convert Long and Lat to numeric format
-df_passup['Long'] = pd.to_numeric(df_passup['Long'], errors='coerce')
-df_passup['Lat'] = pd.to_numeric(df_passup['Lat'], errors='coerce')
-
-# Replace '#VALUE!' with NaN
-df_passup.replace('#VALUE!', pd.NA, inplace=True)
-
-# Replace any '0' value in Long and Lat with NaN
-df_passup["Lat"] = df_passup["Lat"].replace(0, pd.NA)
-df_passup["Long"] = df_passup["Long"].replace(0, pd.NA)
-
-# Drop rows with NaN in 'Long' or 'Lat'
-df_passup.dropna(subset=['Long', 'Lat'], inplace=True)
-
-print("Number of Rows after deleting:", len(df_passup))
-
-# Step 3: Time data pre-processing
-# Convert 'Time' column to datetime type
-df_passup['Time'] = pd.to_datetime(df_passup['Time'], errors='coerce')
+def patch_bar(city, name, changed):
+    """
+    Dash Patch setting only the changed counts of a bar chart.
 
-# Extraction year, date, and hour
-df_passup['Year'] = df_passup['Time'].dt.year
-df_passup['Date'] = df_passup['Time'].dt.date
-df_passup['Hour'] = df_passup['Time'].dt.hour
+    Args:
+        name (str): The bar figure name.
+        changed (dict): Changed category keys per aggregate, see LiveFeed.since;
+            None refreshes every live count.
 
-# Define Time Period ()
-def time_period(hour):
+    Returns:
+        dash.Patch: The partial update, or dash.no_update.
     """
-    Distinguish time periods:
-    6-9am: Represents the time students go to school in the morning.
-    3-6pm: Represents the time students leave school in the afternoon.
-    Others: Covers times out of peak hours.
+    if name not in BAR_AGGREGATES:
+        return dash.no_update
+    deltas = city.live_feed.count_deltas(BAR_AGGREGATES[name])
+    positions = bar_positions(city, name)
+    patch, patched = Patch(), False
+    for category in (deltas if changed is None else changed[BAR_AGGREGATES[name]]):
+        if category in positions:
+            i, j, axis, count = positions[category]
+            patch['data'][i][axis][j] = count + deltas.get(category, 0)
+            patch['data'][i]['text'][j] = count + deltas.get(category, 0)
+            patched = True
+    return patch if patched else dash.no_update
+
+
+def route_figure(city, route, freq):
+    # Figures are rebuilt only after the matrix has taken new pass-ups
+    key = (route, freq, city.route_matrix.revision)
+    if key not in city.route_figures:
+        if len(city.route_figures) > 64:
+            city.route_figures.clear()
+        city.route_figures[key] = route_timeseries_figure(city.route_matrix, route, freq)
+    return city.route_figures[key]
+
+
+def route_options(city):
+    # Every route, including those grouped into 'Other' on the maps, busiest first
+    totals = city.route_matrix.totals().sort_values(ascending=False)
+    return [{'label': '%s (%d pass-ups)' % (route, count), 'value': route} for route, count in totals.items()]
+
+
+def paged_table(city, name):
+    # Sort orders are memory-mapped from the bundle, so keeping the table is cheap
+    if name not in city.paged_tables:
+        city.paged_tables[name] = PagedTable.from_bundle(city.bundle, name)
+    return city.paged_tables[name]
+
+
+def view_rows(city, name, relayout=None):
     """
-    if 0 <= hour < 6:
-        return '0-6am'
-    elif 6 <= hour < 9:
-        return '6-9am'
-    elif 9 <= hour < 12:
-        return '9-12am'
-    elif 12 <= hour < 15:
-        return '12-3pm'
-    elif 15 <= hour < 18:
-        return '3-6pm'
-    else:
-        return '6-12pm'
-
-df_passup['Time_Period'] = df_passup['Hour'].apply(time_period)
-
-# Step 4: Convert stop locations into a GeoDataFrame
-geometry = [Point(xy) for xy in zip(df_passup['Long'], df_passup['Lat'])]
-gdf_passup = gpd.GeoDataFrame(df_passup, geometry=geometry)
-gdf_passup.crs = 'EPSG:4326'
-
-# Get the administrative boundary of Winnipeg using OSMnx
-city = 'Winnipeg, Canada'
-admin = ox.geocode_to_gdf(city)
-admin.crs = 4326
-
-# Spatial Join to identify stops within the city boundary
-passup_within = gpd.sjoin(gdf_passup, admin, how="inner", predicate="within")
-
-# Step 5: Route data pre-processing
-# Count the occurrences of each Route Number
-route_counts = passup_within['Route Number'].value_counts()
-
-# Replace Route Numbers with counts less than 1000 with 'Other'
-def update_route_number(route_number):
-    if pd.notna(route_number) and route_counts[route_number] < 1000:
-        return 'Other'
-    else:
-        return route_number
-
-passup_within['Route Number'] = passup_within['Route Number'].apply(update_route_number)
-
-# Step 6: Number Counted by different parameters
-# Calculate Route Number counts after replacement
-route_counts = passup_within['Route Number'].value_counts().reset_index()
-route_counts.columns = ['Route Number', 'Count']
-
-# Calculate number by Year
-year_counts = passup_within['Year'].value_counts().reset_index()
-year_counts.columns = ['Year', 'Count']
-
-# Calculate number by hour
-hour_counts = passup_within['Hour'].value_counts().reset_index()
-hour_counts.columns = ['Hour', 'Count']
-hour_counts['Hour'] = hour_counts['Hour'].astype(int)
-hour_counts = hour_counts.sort_values(by='Hour')
-
-# Calculate number by Time Period
-time_counts = passup_within['Time_Period'].value_counts().reset_index()
-time_counts.columns = ['Time_Period', 'Count']
-
-# Calculate number by Pass-Up Type
-type_counts = passup_within['Pass-Up Type'].value_counts().reset_index()
-type_counts.columns = ['Pass-Up Type', 'Count']
-
-# Step 7: Layout pre-setting, to show all the city boundary
-center_lat = passup_within['Lat'].mean() - 0.025
-center_lon = passup_within['Long'].mean()
-zoom_level = 9
-
-# Scatter Map
-fig_pass = create_scatter_mapbox(
-    df=passup_within,
-    lat='Lat',
-    lon='Long',
-    color=None,
-    hover_name='Pass-Up ID',
-    hover_data=['Route Name','Route Number','Pass-Up Type','Time'],
-    title='<br>Winnipeg Public Transport Pass-up Data',
-    zoom_level=zoom_level,
-    center_lat=center_lat,
-    center_lon=center_lon,
-    mapbox_style="carto-positron",
-    admin=admin
-)
-
-# Heat Map
-fig_passheat = create_density_mapbox(
-    df=passup_within,
-    lat='Lat',
-    lon='Long',
-    z_col=None,
-    radius=2,
-    opacity=0.5,
-    title='<br>Winnipeg Public Transport Pass-up Data',
-    zoom_level=zoom_level,
-    center_lat=center_lat,
-    center_lon=center_lon,
-    mapbox_style='carto-positron',
-    color_continuous_scale="Plasma",
-    admin=admin
-)
+    The rows of a scatter view on the map for a relayoutData.
 
-# Scatter Map
-fig_RN = create_scatter_mapbox(
-    df=passup_within,
-    lat='Lat',
-    lon='Long',
-    color='Route Number',
-    hover_name='Pass-Up ID',
-    hover_data=['Route Name','Route Number','Pass-Up Type','Time'],
-    title='<br>Winnipeg Public Transport Pass-up Data by Route Number',
-    zoom_level=zoom_level,
-    center_lat=center_lat,
-    center_lon=center_lon,
-    mapbox_style="carto-positron",
-    admin=admin
-)
-
-# Create interactive bar chart
-fig_RNbar = px.bar(
-    route_counts,
-    x='Route Number',
-    y='Count',
-    title='Pass-ups per Route Number in the past decade',
-    labels={'Count': 'Pass-up Times'},
-    text='Count',
-    color='Route Number',
-    # orientation='h',
-)
-fig_RNbar.update_traces(textposition='outside')
-
-# Scatter Map
-fig_YR = create_scatter_mapbox(
-    df=passup_within,
-    lat='Lat',
-    lon='Long',
-    color='Year',
-    hover_name='Pass-Up ID',
-    hover_data=['Route Name','Route Number','Pass-Up Type','Time'],
-    title='<br>Pass-ups data in Winnipeg by year',
-    zoom_level=zoom_level,
-    center_lat=center_lat,
-    center_lon=center_lon,
-    mapbox_style="carto-positron",
-    admin=admin
-)
-
-# Bar chart
-fig_YRbar = px.bar(
-    year_counts,
-    x='Year',
-    y='Count',
-    title='<br>Pass-up times in Winnipeg by Year',
-    labels={'Count': 'Pass-up Times'},
-    text='Count',
-    color='Year'
-)
-fig_YRbar.update_traces(textposition='outside')
-
-# Scatter Map
-fig_TR = create_scatter_mapbox(
-    df=passup_within,
-    lat='Lat',
-    lon='Long',
-    color='Time_Period',
-    hover_name='Pass-Up ID',
-    hover_data=['Route Name','Route Number','Pass-Up Type','Time'],
-    title='<br>Pass-ups data in Winnipeg by Time Period',
-    zoom_level=zoom_level,
-    center_lat=center_lat,
-    center_lon=center_lon,
-    mapbox_style="carto-positron",
-    admin=admin
-)
-
-# Scatter Map
-fig_HR = create_scatter_mapbox(
-    df=passup_within,
-    lat='Lat',
-    lon='Long',
-    color='Hour',
-    hover_name='Pass-Up ID',
-    hover_data=['Route Name','Route Number','Pass-Up Type','Time'],
-    title='<br>Pass-ups data in Winnipeg by Hour',
-    zoom_level=zoom_level,
-    center_lat=center_lat,
-    center_lon=center_lon,
-    mapbox_style="carto-positron",
-    admin=admin
-)
+    Returns:
+        tuple: (rows, zoom, (center_lat, center_lon), tiles); rows is None when
+        the pre-built figure with the whole table is shown, and tiles, the
+        tile zoom and x and y ranges the rows were read from, identifies them.
+        None when relayout doesn't describe a map position.
+    """
+    view = SCATTER_VIEWS[name]
+    if city.bundle.manifest['tables'][view['table']] <= VECTOR_TILE_THRESHOLD:
+        return None if relayout is not None else (None, ZOOM_LEVEL, None, None)
+    position = viewport(relayout, raster_bounds(city.bundle.boundary, pad=0), ZOOM_LEVEL)
+    if position is None:
+        return None
+    bounds, zoom, center = position
+
+    table = city.vector_tiles.table(view['table'])
+    if relayout is None:
+        center = map_center(table)
+    z, xs, ys = city.vector_tiles.view_tiles(bounds, zoom)
+    tiles = [z, xs.start, xs.stop, ys.start, ys.stop]
+    return table.iloc[city.vector_tiles.view_positions(view['table'], bounds, zoom)], zoom, center, tiles
+
+
+def view_color_settings(city, name):
+    view = SCATTER_VIEWS[name]
+    if name not in city.view_colors:
+        city.view_colors[name] = view_colors(city.bundle.table(view['table']), view['color'])
+    return city.view_colors[name]
+
+
+def scatter_figure(city, name, relayout=None):
+    """
+    The pre-built scatter map, or for a table above VECTOR_TILE_THRESHOLD rows
+    only the points of the tiles in view (thinned at city scale).
 
-# Bar chart by Hour
-fig_HRbar = px.bar(
-    hour_counts,
-    x='Hour',
-    y='Count',
-    title='<br>Pass-up times in Winnipeg by Hour',
-    labels={'Count': 'Pass-up Times'},
-    text='Count',
-    color='Hour',
-)
-fig_HRbar.update_traces(textposition='outside')
-
-# Bar chart by Time Period
-fig_TRbar = px.bar(
-    time_counts,
-    y='Time_Period',
-    x='Count',
-    title='Pass-up times in Winnipeg by Time Period',
-    labels={'Count': 'Pass-up Times'},
-    text='Count',
-    color='Time_Period',
-    color_discrete_sequence=px.colors.qualitative.Light24,
-    orientation='h'
-)
-fig_TRbar.update_traces(textposition='outside')
-
-# Scatter Map
-fig_TP = create_scatter_mapbox(
-    df=passup_within,
-    lat='Lat',
-    lon='Long',
-    color='Pass-Up Type',
-    hover_name='Pass-Up ID',
-    hover_data=['Route Name','Route Number','Pass-Up Type','Time'],
-    title='<br>Pass-ups data in Winnipeg by Pass-up Type',
-    zoom_level=zoom_level,
-    center_lat=center_lat,
-    center_lon=center_lon,
-    mapbox_style="carto-positron",
-    admin=admin
-)
+    Returns None when relayout doesn't describe a map position.
+    """
+    rows = view_rows(city, name, relayout)
+    if rows is None:
+        return None
+    subset, zoom, center, tiles = rows
+    if subset is None:
+        return with_live(city, city.figures[name])
+
+    def build():
+        fig = scatter_view(name, subset, center[0], center[1], city.bundle.boundary, zoom, **view_color_settings(city, name))
+        # Keep the user's pan and zoom when the points are swapped
+        fig.update_layout(uirevision=city.key + name)
+        return fig.to_dict()
+
+    # The points depend only on the bundle and the tiles in view (and the thinning
+    # limit), so every worker reuses them for any pan or zoom within the same tiles
+    fig = shared_cache.get_or_compute('scatter', city.bundle.version, [city.key, name, tiles, MAX_VIEW_POINTS], build)
+    fig['layout']['mapbox'].update(zoom=zoom, center={'lat': center[0], 'lon': center[1]})
+    return with_live(city, fig)
+
+
+def recolour(city, name, shown):
+    """
+    Dash Patch turning the scatter view on screen into view `name` when both
+    show the same points, see figures.create_coloured_scatter_mapbox.
 
-# Bar chart
-fig_TPbar = px.bar(
-    type_counts,
-    y='Pass-Up Type',
-    x='Count',
-    title='<br>Pass-up times in Winnipeg per Pass-Up Type',
-    labels={'Count': 'Pass-up Times'},
-    text='Count',
-    color='Pass-Up Type',
-    color_discrete_sequence=px.colors.qualitative.Light24,
-    orientation='h'
-)
-fig_TPbar.update_traces(textposition='outside')
-
-# Step 1: Read the data
-# Use the url of the csv I uploaded to github
-df_census = pd.read_csv('https://raw.githubusercontent.com/xupeitao/winnipegteencommute.github.io/refs/heads/main/data/Winnipeg_Census_Point.csv')
-
-# Step 4: Convert stop locations into a GeoDataFrame
-geometry = [Point(xy) for xy in zip(df_census['Long'], df_census['Lat'])]
-gdf_census = gpd.GeoDataFrame(df_census, geometry=geometry)
-gdf_census.crs = 'EPSG:4326'
-
-# Get the administrative boundary of Winnipeg using OSMnx
-city = 'Winnipeg, Canada'
-admin = ox.geocode_to_gdf(city)
-admin.crs = 4326
-
-# Spatial Join to identify stops within the city boundary
-census_within = gpd.sjoin(gdf_census, admin, how="inner", predicate="within")
-
-# Layout Pre-setting
-center_lat = census_within['Lat'].mean() - 0.025
-center_lon = census_within['Long'].mean()
-zoom_level = 9
-
-limits = [(0, 50), (50, 100), (100, 200), (200,500), (500,2000)]
-colors = ["grey", "royalblue", "lightseagreen", "orange", "red"]
-sizes = [1, 3, 5, 7, 20]
-
-# Create a new column for color categories based on the limits
-census_within['Color_Category'] = pd.cut(census_within['Total_15_Density'], bins=[limit[0] for limit in limits] + [limits[-1][1]],
-                                            labels=colors, right=False)
-
-# Scatter Map
-fig_total = create_scatter_mapbox(
-    df=df_census,
-    lat='Lat',
-    lon='Long',
-    color='Total_15_Density',
-    hover_name='OBJECTID',
-    hover_data=['Total_15_to_19_years','Men_15_to_19_years','Women_15_to_19_years','Shape_Area(km^2)','Total_15_Density','Men_15_Density','Women_15_Density'],
-    title='<br>Total Teenager Density in Winnipeg (2021)',
-    zoom_level=zoom_level,
-    center_lat=center_lat,
-    center_lon=center_lon,
-    mapbox_style="carto-positron",
-    admin=admin
-)
+    Args:
+        name (str): The new view, a key of SCATTER_VIEWS.
+        shown (dict): The 'scatter-state' store: the 'city', 'name' and
+            'relayout' of the view on screen and its number of 'legend' traces.
 
-# Update marker sizes by limits group
-size_map = {color: size for color, size in zip(colors, sizes)}
-census_within['Marker_Size'] = census_within['Color_Category'].map(size_map)
-census_within['Marker_Size'] = census_within['Marker_Size'].fillna(5)
-fig_total.update_traces(marker={'size': census_within['Marker_Size']})
-
-# Box chart
-fig_csbox = px.box(df_census, x=['Total_15_to_19_years','Men_15_to_19_years','Women_15_to_19_years',"Total_15_Density", "Men_15_Density", "Women_15_Density"],
-                    title="Teenager Density in Winnipeg (2021)", orientation='h')
-fig_csbox.update_layout(xaxis_type="log")
-
-# Heat Map
-fig_totalheat = create_density_mapbox(
-    df=census_within,
-    lat='Lat',
-    lon='Long',
-    z_col='Total_15_Density',
-    radius=20,
-    opacity=1,
-    title='<br>Total Teenager Density in Winnipeg (2021)',
-    zoom_level=zoom_level,
-    center_lat=center_lat,
-    center_lon=center_lon,
-    mapbox_style='carto-positron',
-    color_continuous_scale="Plasma",
-    admin=admin
-)
+    Returns:
+        tuple: (dash.Patch, number of legend traces of the new view), or None
+        when the whole figure has to be sent.
+    """
+    view = SCATTER_VIEWS[name]
+    if not shown or shown.get('name') not in SCATTER_VIEWS or view['table'] not in RECOLOURED_TABLES:
+        return None
+    if shown.get('city') != city.key or SCATTER_VIEWS[shown['name']]['table'] != view['table']:
+        return None
+    rows = view_rows(city, name, shown['relayout'])
+    if rows is None:
+        return None
+    subset = rows[0] if rows[0] is not None else city.bundle.table(view['table'])
+    marker, legend = view_marker(subset, view['color'], view_color_settings(city, name))
+
+    # Traces: the live pass-ups, the boundary rings, the points, then the legend
+    points = 1 + len(city.bundle.boundary)
+    patch = Patch()
+    patch['data'][points]['marker'] = marker
+    for i in reversed(range(points + 1, points + 1 + shown['legend'])):
+        del patch['data'][i]
+    if legend:
+        patch['data'].extend([trace.to_plotly_json() for trace in legend])
+    patch['layout']['title']['text'] = view['title']
+    patch['layout']['legend']['title']['text'] = view['color']
+    return patch, len(legend)
+
+
+def same_points(filter_a, filter_b):
+    # Main filter values whose maps are recoloured into each other, keeping the live trace
+    tables = [SCATTER_VIEWS[SCATTER_FILTERS[value]]['table'] if value in SCATTER_FILTERS else None
+              for value in (filter_a, filter_b)]
+    return tables[0] == tables[1] and tables[0] in RECOLOURED_TABLES
+
+
+def legend_count(city, name):
+    # Legend traces of a coloured view, see figures.view_marker
+    view = SCATTER_VIEWS[name]
+    if view['table'] not in RECOLOURED_TABLES or view['color'] is None or 'range_color' in view_color_settings(city, name):
+        return 0
+    return len(view_color_settings(city, name)['category_orders'][view['color']])
+
+
+def scatter_state(city, name, relayout=None):
+    # What the 'scatter-state' store records about a freshly sent scatter view
+    return {'city': city.key, 'name': name, 'relayout': relayout, 'legend': legend_count(city, name)}
+
+
+def request_city():
+    # The city of a request: ?city=<key>, else the one with a bundle of ?v=<version>, else the default
+    key = request.args.get('city')
+    if key is not None:
+        if key not in registry.cities:
+            abort(404)
+        return registry.get(key)
+    version = request.args.get('v')
+    if version is None:
+        return registry.get(DEFAULT_CITY)
+    city = registry.by_version(version)
+    if city is None:
+        # Never another city's data under this one's url
+        abort(404)
+    return city
 
-# Heat Map
-fig_men = create_density_mapbox(
-    df=census_within,
-    lat='Lat',
-    lon='Long',
-    z_col='Men_15_Density',
-    radius=20,
-    opacity=1,
-    title='<br>Men Teenager Density in Winnipeg (2021)',
-    zoom_level=zoom_level,
-    center_lat=center_lat,
-    center_lon=center_lon,
-    mapbox_style='carto-positron',
-    color_continuous_scale="Plasma",
-    admin=admin
-)
-
-# Heat Map
-fig_women = create_density_mapbox(
-    df=census_within,
-    lat='Lat',
-    lon='Long',
-    z_col='Women_15_Density',
-    radius=20,
-    opacity=1,
-    title='<br>Women Teenager Density in Winnipeg (2021)',
-    zoom_level=zoom_level,
-    center_lat=center_lat,
-    center_lon=center_lon,
-    mapbox_style='carto-positron',
-    color_continuous_scale="Plasma",
-    admin=admin
-)
 
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP], suppress_callback_exceptions=True)
 server = app.server # for deployment
 
-# define the layout
-app.layout = dbc.Container(
-    [
-        dbc.Row(
-            [
-                dbc.Col(
-                    html.Div(
-                        [
-                            html.H2("Winnipeg Teens and Public Transit Unreliability", style={'textAlign': 'center'}),
-                        ],
-                        style={'backgroundColor': '#e6f2ff', 'padding': '10px','display': 'flex','justifyContent': 'center','alignItems': 'center','height': '100px'}
-                    ),
-                    md=6,
-                ),
-                dbc.Col(
-                    html.Div(
-                        [
-                            html.H6("This project addressed 'What impact might public transit unreliability have on young riders?' by analyzing the gaps in transit reliability in neighbourhoods that host large population of young people.", style={'textAlign': 'center'}),
-                        ],
-                        style={'backgroundColor': '#e6f2ff', 'padding': '10px','display': 'flex','justifyContent': 'center','alignItems': 'center','height': '100px'}
-                    ),
-                    md=6,
-                ),
-            ]
-        ),
-        dbc.Row(
-            [
-                dbc.Col(
-                    [
-                        html.Div(
-                            [
-                                html.H4("Public Transit Map", style={'textAlign': 'center'}),
-                            ],
-                            style={'backgroundColor': '#e6f2ff', 'padding': '10px','display': 'flex','justifyContent': 'center','alignItems': 'center','height': '100px'}
-                        ),
-                    ],
-                    md=3,
-                ),
-                dbc.Col(
-                    [
+# Heat map rasters; urls include the data version, so they can be cached forever
+@server.route('/density/<version>/<layer>/<resolution>.png')
+def density_raster(version, layer, resolution):
+    path = registry.root_of(version)
+    if path is None:
+        abort(404)
+    return send_from_directory(os.path.join(path, 'rasters'), '%s_%s.png' % (layer, resolution), max_age=365 * 24 * 3600)
+
+# Heat map xyz tiles, rendered on demand and cached on disk
+@server.route('/tiles/<layer>/<int:z>/<int:x>/<int:y>.png')
+def heat_tile(layer, z, x, y):
+    city = request_city()
+    data = city.tile_renderer.tile(layer, z, x, y)
+    if data is None:
+        abort(404)
+    response = server.response_class(data, mimetype='image/png')
+    # Tile urls carry ?v=<data version>, so a matching version can be cached for good
+    if request.args.get('v') == city.bundle.version:
+        response.cache_control.public = True
+        response.cache_control.max_age = 365 * 24 * 3600
+    return response
+
+# Stop and pass-up points as GeoJSON vector tiles
+@server.route('/vtiles/<layer>/<int:z>/<int:x>/<int:y>.geojson')
+def vector_tile(layer, z, x, y):
+    city = request_city()
+    data = city.vector_tiles.tile(layer, z, x, y)
+    if data is None:
+        abort(404)
+    response = server.response_class(data, mimetype='application/geo+json')
+    if request.args.get('v') == city.bundle.version:
+        response.cache_control.public = True
+        response.cache_control.max_age = 365 * 24 * 3600
+    return response
+
+# Live pass-ups as JSON lines, see ingest.py
+@server.route('/api/passups', methods=['POST'])
+def ingest_passups():
+    token = os.environ.get('WTC_INGEST_TOKEN')
+    if token and request.headers.get('Authorization') != 'Bearer ' + token:
+        abort(401)
+    if (request.content_length or 0) > MAX_INGEST_BYTES:
+        abort(413)
+    return jsonify(request_city().live_feed.ingest(request.get_data(as_text=True)))
+
+# Filtered pass-ups as a file, streamed batch by batch, see export.py
+@server.route('/api/passups/export.<fmt>')
+def export_passups(fmt):
+    if fmt not in EXPORT_FORMATS:
+        abort(404)
+    city = request_city()
+    try:
+        chunks = export_stream(city.bundle, request.args, fmt)
+    except ExportError as error:
+        return jsonify({'error': str(error)}), 400
+    response = server.response_class(stream_with_context(chunks), mimetype=EXPORT_FORMATS[fmt])
+    response.headers['Content-Disposition'] = 'attachment; filename=passups-%s-%s.%s' % (city.key, city.bundle.version, fmt)
+    return response
+
+# A city that hasn't been built yet, see CityRegistry.load_bundle
+@server.errorhandler(MissingBundle)
+def missing_bundle(error):
+    return jsonify({'error': str(error)}), 503
+
+# Pass-up counts as JSON, see api.py
+@server.route('/api/passups/counts')
+def passup_counts():
+    city = request_city()
+    try:
+        body, etag = counts_cache.get(city.bundle, request.args)
+    except QueryError as error:
+        return jsonify({'error': str(error)}), 400
+    response = server.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    return response.make_conditional(request)
+
+# Hit and miss counts of the shared cache
+@server.route('/api/cache/stats')
+def cache_stats():
+    return jsonify(shared_cache.stats())
+
+def main_filter_options(city):
+    # Corridors need a GTFS feed with shapes at build time
+    figures = city.bundle.manifest['figures']
+    return [option for option in MAIN_FILTER_OPTIONS
+            if option['value'] not in OPTIONAL_FILTERS or OPTIONAL_FILTERS[option['value']] in figures]
+
+
+def city_title(city):
+    return "%s Teens and Public Transit Unreliability" % city.label
+
+
+def first_route(city):
+    return city.route_matrix.routes[0] if city.route_matrix.routes else None
+
+
+def page_layout(city):
+    """The page as first served, showing the default city."""
+    return dbc.Container(
+        [
+            dbc.Row(
+                [
+                    dbc.Col(
                         html.Div(
                             [
-                                html.Label(""), #Main Filtering:
-                                dcc.Dropdown(
-                                    id='main-filter-dropdown',
-                                    options=[
-                                        {'label': 'Bus Stops Scatter Map', 'value': 'stop_point'},
-                                        {'label': 'Bus Stops Heat Map', 'value': 'stop_heat'},
-                                        {'label': 'Passup Scatter Map', 'value': 'passup_point'},
-                                        {'label': 'Passup Heat Map', 'value': 'passup_heat'},
-                                        {'label': 'Passup by Year', 'value': 'passup_year'},
-                                        {'label': 'Passup by Time Period', 'value': 'passup_timeperiod'},
-                                        {'label': 'Passup by Hour', 'value': 'passup_hour'},
-                                        {'label': 'Passup by Type', 'value': 'passup_type'},
-                                        {'label': 'Passup by Route Number', 'value': 'passup_routenumber'},
-                                    ],
-                                    value='passup_routenumber',  # Default
-                                )
+                                html.H2(city_title(city), id='city-title', style={'textAlign': 'center'}),
+                                dcc.Dropdown(id='city-dropdown', options=registry.options(), value=DEFAULT_CITY, clearable=False,
+                                             style={'width': '200px', 'display': 'block' if len(registry.cities) > 1 else 'none'}),
                             ],
-                            style={'backgroundColor': '#e6f2ff', 'padding': '10px','height': '100px'}
+                            style={'backgroundColor': '#e6f2ff', 'padding': '10px','display': 'flex','flexDirection': 'column','justifyContent': 'center','alignItems': 'center','height': '100px'}
                         ),
-                    ],
-                    md=3,
-                ),
-                dbc.Col(
-                    [
+                        md=6,
+                    ),
+                    dbc.Col(
                         html.Div(
                             [
-                                html.H4("Teen Census Map", style={'textAlign': 'center'}),
+                                html.H6("This project addressed 'What impact might public transit unreliability have on young riders?' by analyzing the gaps in transit reliability in neighbourhoods that host large population of young people.", style={'textAlign': 'center'}),
                             ],
                             style={'backgroundColor': '#e6f2ff', 'padding': '10px','display': 'flex','justifyContent': 'center','alignItems': 'center','height': '100px'}
                         ),
-                    ],
-                    md=3,
-                ),
-                dbc.Col(
-                    [
-                        html.Div(
-                            [
-                                html.Label(""), #Census Filtering:
-                                dcc.Dropdown(
-                                    id='census-filter-dropdown',
-                                    options=[
-                                        {'label': 'Total Census Scatter Map', 'value': 'census_point'},
-                                        {'label': 'Total Census Heat Map', 'value': 'census_heat'},
-                                        {'label': 'Male Census Heat Map', 'value': 'census_male_heat'},
-                                        {'label': 'Female Census Heat Map', 'value': 'census_female_heat'}
-                                    ],
-                                    value='census_point',  # Default
-                                )
-                            ],
-                            style={'backgroundColor': '#e6f2ff', 'padding': '10px','height': '100px'}
-                        ),
-                    ],
-                    md=3,
-                ),
-            ]
-        ),
-        dbc.Row(
-            [
-                dbc.Col(
-                    [
-                        html.Div(
-                            [
-                                html.H4("", style={'textAlign': 'center'}), #Public Transit Map
-                                dcc.Graph(id='passup_routenumber', figure=fig_RN)
-                            ],
-                            style={'padding': '20px', 'display': 'flex','justifyContent': 'center','alignItems': 'center'}
-                        ),
-                    ],
-                    md=6,
-                ),
-                dbc.Col(
-                    [
-                        html.Div(
-                            [
-                                html.H4("", style={'textAlign': 'center'}), #Teenager Census Map
-                                dcc.Graph(id='census_total_scatter', figure=fig_total)
-                            ],
-                            style={'padding': '20px','display': 'flex','justifyContent': 'center','alignItems': 'center'}
-                        ),
-                    ],
-                    md=6,
-                ),
-            ]
-        ),
-        dbc.Row(
-            [
-                dbc.Col(
-                    [
-                        html.Div(
-                            [
-                                html.H4("", style={'textAlign': 'center'}), #Pass-up Data Chart
-                                dcc.Graph(id='passup_RNbar', figure=fig_RNbar)
-                            ],
-                            style={'padding': '20px','display': 'flex','justifyContent': 'center','alignItems': 'center'}
-                        ),
-                    ],
-                    md=6,
-                ),
-                dbc.Col(
-                    [
-                        html.Div(
-                            [
-                                html.H4("", style={'textAlign': 'center'}), #Teenagers Census Box Chart
-                                dcc.Graph(id='census_total_box', figure=fig_csbox)
-                            ],
-                            style={'padding': '20px','display': 'flex','justifyContent': 'center','alignItems': 'center'}
-                        ),
-                    ],
-                    md=6,
-                ),
-            ]
-        ),
-    ],
-    fluid=True,
-)
+                        md=6,
+                    ),
+                ]
+            ),
+            dbc.Row(
+                [
+                    dbc.Col(
+                        [
+                            html.Div(
+                                [
+                                    html.H4("Public Transit Map", style={'textAlign': 'center'}),
+                                ],
+                                style={'backgroundColor': '#e6f2ff', 'padding': '10px','display': 'flex','justifyContent': 'center','alignItems': 'center','height': '100px'}
+                            ),
+                        ],
+                        md=3,
+                    ),
+                    dbc.Col(
+                        [
+                            html.Div(
+                                [
+                                    html.Label(""), #Main Filtering:
+                                    dcc.Dropdown(
+                                        id='main-filter-dropdown',
+                                        options=main_filter_options(city),
+                                        value='passup_routenumber',  # Default
+                                    )
+                                ],
+                                style={'backgroundColor': '#e6f2ff', 'padding': '10px','height': '100px'}
+                            ),
+                        ],
+                        md=3,
+                    ),
+                    dbc.Col(
+                        [
+                            html.Div(
+                                [
+                                    html.H4("Teen Census Map", style={'textAlign': 'center'}),
+                                ],
+                                style={'backgroundColor': '#e6f2ff', 'padding': '10px','display': 'flex','justifyContent': 'center','alignItems': 'center','height': '100px'}
+                            ),
+                        ],
+                        md=3,
+                    ),
+                    dbc.Col(
+                        [
+                            html.Div(
+                                [
+                                    html.Label(""), #Census Filtering:
+                                    dcc.Dropdown(
+                                        id='census-filter-dropdown',
+                                        options=[
+                                            {'label': 'Total Census Scatter Map', 'value': 'census_point'},
+                                            {'label': 'Total Census Heat Map', 'value': 'census_heat'},
+                                            {'label': 'Male Census Heat Map', 'value': 'census_male_heat'},
+                                            {'label': 'Female Census Heat Map', 'value': 'census_female_heat'}
+                                        ],
+                                        value='census_point',  # Default
+                                    )
+                                ],
+                                style={'backgroundColor': '#e6f2ff', 'padding': '10px','height': '100px'}
+                            ),
+                        ],
+                        md=3,
+                    ),
+                ]
+            ),
+            dbc.Row(
+                [
+                    dbc.Col(
+                        [
+                            html.Div(
+                                [
+                                    html.H4("", style={'textAlign': 'center'}), #Public Transit Map
+                                    dcc.Graph(id='passup_routenumber', figure=scatter_figure(city, 'fig_RN'))
+                                ],
+                                style={'padding': '20px', 'display': 'flex','justifyContent': 'center','alignItems': 'center'}
+                            ),
+                        ],
+                        md=6,
+                    ),
+                    dbc.Col(
+                        [
+                            html.Div(
+                                [
+                                    html.H4("", style={'textAlign': 'center'}), #Teenager Census Map
+                                    dcc.Graph(id='census_total_scatter', figure=city.figures['fig_total'])
+                                ],
+                                style={'padding': '20px','display': 'flex','justifyContent': 'center','alignItems': 'center'}
+                            ),
+                        ],
+                        md=6,
+                    ),
+                ]
+            ),
+            dbc.Row(
+                [
+                    dbc.Col(
+                        [
+                            html.Div(
+                                [
+                                    html.H4("", style={'textAlign': 'center'}), #Pass-up Data Chart
+                                    dcc.Graph(id='passup_RNbar', figure=live_bar(city, 'fig_RNbar'))
+                                ],
+                                style={'padding': '20px','display': 'flex','justifyContent': 'center','alignItems': 'center'}
+                            ),
+                        ],
+                        md=6,
+                    ),
+                    dbc.Col(
+                        [
+                            html.Div(
+                                [
+                                    html.H4("", style={'textAlign': 'center'}), #Teenagers Census Box Chart
+                                    dcc.Graph(id='census_total_box', figure=city.figures['fig_csbox'])
+                                ],
+                                style={'padding': '20px','display': 'flex','justifyContent': 'center','alignItems': 'center'}
+                            ),
+                        ],
+                        md=6,
+                    ),
+                ]
+            ),
+            dbc.Row(
+                [
+                    dbc.Col(
+                        [
+                            html.Div(
+                                [
+                                    html.H4("Route Reliability Over Time", style={'textAlign': 'center'}),
+                                    dcc.Dropdown(id='route-dropdown', options=route_options(city), value=first_route(city)),
+                                    dcc.RadioItems(
+                                        id='route-frequency',
+                                        options=[{'label': ' Daily', 'value': 'D'}, {'label': ' Weekly', 'value': 'W'}],
+                                        value='W', inline=True, inputStyle={'marginLeft': '10px'},
+                                    ),
+                                    dcc.Graph(id='route_timeseries'),
+                                ],
+                                style={'backgroundColor': '#e6f2ff', 'padding': '20px'}
+                            ),
+                        ],
+                        md=12,
+                    ),
+                ]
+            ),
+            dbc.Row(
+                [
+                    dbc.Col(
+                        [
+                            html.Div(
+                                [
+                                    html.H4("Teen Transit Equity", style={'textAlign': 'center'}),
+                                    html.H6("Neighbourhoods ranked by teen density, pass-ups within 500 m and stops within 400 m; higher scores need service most.", style={'textAlign': 'center'}),
+                                    dash_table.DataTable(
+                                        id='equity-table',
+                                        columns=[{'name': column, 'id': column} for column in paged_table(city, 'equity').df.columns],
+                                        page_current=0, page_size=15,
+                                        page_action='custom', sort_action='custom', sort_mode='single', filter_action='custom',
+                                        style_table={'overflowX': 'auto'},
+                                    ),
+                                ],
+                                style={'backgroundColor': '#e6f2ff', 'padding': '20px'}
+                            ),
+                        ],
+                        md=12,
+                    ),
+                ]
+            ),
+            dbc.Row(
+                [
+                    dbc.Col(
+                        [
+                            html.Div(
+                                [
+                                    html.H4("Pass-Up Records", style={'textAlign': 'center'}),
+                                    html.H6("Every pass-up in the city; shift-click a column to sort by several, and filter with e.g. 'datestartswith 2019-05' on Time.", style={'textAlign': 'center'}),
+                                    dash_table.DataTable(
+                                        id='passup-records',
+                                        columns=[{'name': column, 'id': column} for column in PASSUP_RECORD_COLUMNS],
+                                        page_current=0, page_size=20,
+                                        page_action='custom', sort_action='custom', sort_mode='multi', filter_action='custom',
+                                        style_table={'overflowX': 'auto'},
+                                    ),
+                                ],
+                                style={'backgroundColor': '#e6f2ff', 'padding': '20px'}
+                            ),
+                        ],
+                        md=12,
+                    ),
+                ]
+            ),
+            dcc.Interval(id='live-interval', interval=LIVE_POLL_SECONDS * 1000),
+            dcc.Store(id='live-state', data={'seq': 0, 'view': 'passup_routenumber', 'city': DEFAULT_CITY}),
+            dcc.Store(id='scatter-state', data=scatter_state(city, 'fig_RN')),
+        ],
+        fluid=True,
+    )
+
+
+def serve_layout():
+    # Built once per bundle of the default city and served to every visit, so
+    # a hot-reloaded bundle (see CityRegistry.refresh) shows on the next page load
+    city = registry.get(DEFAULT_CITY)
+    if city.layout is None:
+        city.layout = page_layout(city)
+    return city.layout
+
+
+def warm_city(city):
+    # What a first visit needs, made by the refresher before a new bundle is swapped in
+    paged_table(city, 'equity')
+    paged_table(city, 'passups')
+    if city.key == DEFAULT_CITY:
+        city.layout = page_layout(city)
+
+
+# New bundles are picked up by a thread of every worker, started by its first request, each on its own timer
+@server.before_request
+def start_refresher():
+    registry.start_refresher(warm=warm_city)
+
+# Served and current data version of every city across the workers, and how the last refresh went
+@server.route('/api/status')
+def status():
+    return jsonify({'cities': registry.status(), 'refresh_seconds': REFRESH_SECONDS})
+
+
+# define the layout
+app.layout = serve_layout
+# Built now rather than on the first visit; under gunicorn, the preloaded master builds it for every worker
+serve_layout()
+boot.mark('layout')
+
+def scatter_update(city, name, shown):
+    # Recolour the points on screen if possible, else send the whole view
+    recoloured = recolour(city, name, shown)
+    if recoloured is not None:
+        patch, legend = recoloured
+        return patch, dict(shown, name=name, legend=legend)
+    return scatter_figure(city, name), scatter_state(city, name)
 
 @app.callback(
     Output('passup_routenumber', 'figure'),
-    [Input('main-filter-dropdown', 'value')]
+    Output('scatter-state', 'data'),
+    Input('main-filter-dropdown', 'value'),
+    Input('city-dropdown', 'value'),
+    State('scatter-state', 'data'),
 )
-def update_map(main_filter):
-    if main_filter == 'stop_point':
-        return fig
+def update_map(main_filter, city_key, shown):
+    city = registry.get(city_key)
+    if main_filter in SCATTER_FILTERS:
+        return scatter_update(city, SCATTER_FILTERS[main_filter], shown)
     elif main_filter == 'stop_heat':
-        return fig_heat
-    elif main_filter == 'passup_point':
-        return fig_pass
+        return city.figures['fig_heat'], None
     elif main_filter == 'passup_heat':
-        return fig_passheat
-    elif main_filter == 'passup_year':
-        return fig_YR
-    elif main_filter == 'passup_timeperiod':
-        return fig_TR
-    elif main_filter == 'passup_hour':
-        return fig_HR
-    elif main_filter == 'passup_type':
-        return fig_TP
-    elif main_filter == 'passup_routenumber':
-        return fig_RN
+        return city.figures['fig_passheat'], None
+    elif main_filter == 'passup_month':
+        return city.figures['fig_passmonth'], None
+    elif main_filter == 'passup_hourly':
+        return city.figures['fig_passhour'], None
+    elif main_filter == 'passup_spikes':
+        return city.figures['fig_spikes'], None
+    elif main_filter == 'passup_corridors' and 'fig_corridors' in city.bundle.manifest['figures']:
+        return city.figures['fig_corridors'], None
+    return dash.no_update, dash.no_update
+
+# Large point tables: reload the points in view after every pan or zoom
+@app.callback(
+    Output('passup_routenumber', 'figure', allow_duplicate=True),
+    Output('scatter-state', 'data', allow_duplicate=True),
+    Input('passup_routenumber', 'relayoutData'),
+    State('main-filter-dropdown', 'value'),
+    State('city-dropdown', 'value'),
+    prevent_initial_call=True,
+)
+def update_view(relayout, main_filter, city_key):
+    if main_filter not in SCATTER_FILTERS:
+        return dash.no_update, dash.no_update
+    city = registry.get(city_key)
+    name = SCATTER_FILTERS[main_filter]
+    fig = scatter_figure(city, name, relayout)
+    if fig is None:
+        return dash.no_update, dash.no_update
+    return fig, scatter_state(city, name, relayout)
 
 @app.callback(
     Output('passup_RNbar', 'figure'),
-    [Input('main-filter-dropdown', 'value')]
+    [Input('main-filter-dropdown', 'value'), Input('city-dropdown', 'value')]
 )
-def update_map(main_filter):
-    if main_filter == 'stop_point':
-        return fig_RNbar
-    elif main_filter == 'stop_heat':
-        return fig_RNbar
-    elif main_filter == 'passup_point':
-        return fig_RNbar
-    elif main_filter == 'passup_heat':
-        return fig_RNbar
-    elif main_filter == 'passup_year':
-        return fig_YRbar
-    elif main_filter == 'passup_timeperiod':
-        return fig_TRbar
-    elif main_filter == 'passup_hour':
-        return fig_HRbar
-    elif main_filter == 'passup_type':
-        return fig_TPbar
-    elif main_filter == 'passup_routenumber':
-        return fig_RNbar
+def update_map(main_filter, city_key):
+    city = registry.get(city_key)
+    name = BAR_FILTERS.get(main_filter, 'fig_RNbar')
+    return live_bar(city, name if name in city.bundle.manifest['figures'] else 'fig_RNbar')
+
+# Open dashboards poll for live pass-ups and get only the new points and changed counts
+@app.callback(
+    Output('passup_routenumber', 'figure', allow_duplicate=True),
+    Output('passup_RNbar', 'figure', allow_duplicate=True),
+    Output('live-state', 'data'),
+    Input('live-interval', 'n_intervals'),
+    State('main-filter-dropdown', 'value'),
+    State('city-dropdown', 'value'),
+    State('live-state', 'data'),
+    prevent_initial_call=True,
+)
+def push_live(_, main_filter, city_key, state):
+    city = registry.get(city_key)
+    if (state is None or state.get('city') != city.key
+            or (state.get('view') != main_filter and not same_points(state.get('view'), main_filter))):
+        # The figures were just rebuilt with everything buffered so far
+        return dash.no_update, dash.no_update, {'seq': city.live_feed.latest(), 'view': main_filter, 'city': city.key}
+    seq, records, changed = city.live_feed.since(state['seq'])
+    if seq == state['seq']:
+        return dash.no_update, dash.no_update, dash.no_update
+
+    map_patch = dash.no_update
+    if main_filter in SCATTER_FILTERS and len(records):
+        map_patch = Patch()
+        map_patch['data'][0]['lat'].extend(records['Lat'].tolist())
+        map_patch['data'][0]['lon'].extend(records['Long'].tolist())
+        map_patch['data'][0]['text'].extend(live_text(records))
+    bar_patch = patch_bar(city, BAR_FILTERS.get(main_filter, 'fig_RNbar'), changed)
+    return map_patch, bar_patch, {'seq': seq, 'view': main_filter, 'city': city.key}
 
 @app.callback(
     Output('census_total_scatter', 'figure'),
-    [Input('census-filter-dropdown', 'value')]
+    [Input('census-filter-dropdown', 'value'), Input('city-dropdown', 'value')]
 )
-def update_map(census_filter):
+def update_map(census_filter, city_key):
+    figures = registry.get(city_key).figures
     if census_filter == 'census_point':
-        return fig_total
+        return figures['fig_total']
     elif census_filter == 'census_heat':
-        return fig_totalheat
+        return figures['fig_totalheat']
     elif census_filter == 'census_male_heat':
-        return fig_men
+        return figures['fig_men']
     elif census_filter == 'census_female_heat':
-        return fig_women
+        return figures['fig_women']
+
+# Switching city swaps the title, the census box chart, the map choices and the route list
+@app.callback(
+    Output('city-title', 'children'),
+    Output('census_total_box', 'figure'),
+    Output('main-filter-dropdown', 'options'),
+    Output('route-dropdown', 'options'),
+    Output('route-dropdown', 'value', allow_duplicate=True),
+    Input('city-dropdown', 'value'),
+    prevent_initial_call=True,
+)
+def switch_city(city_key):
+    city = registry.get(city_key)
+    return city_title(city), city.figures['fig_csbox'], main_filter_options(city), route_options(city), first_route(city)
+
+@app.callback(
+    Output('route_timeseries', 'figure'),
+    [Input('route-dropdown', 'value'), Input('route-frequency', 'value')],
+    State('city-dropdown', 'value'),
+)
+def update_route(route, freq, city_key):
+    city = registry.get(city_key)
+    if route not in city.route_matrix.index:
+        return dash.no_update
+    return route_figure(city, route, freq)
+
+# Clicking a route's bar opens its history
+@app.callback(
+    Output('route-dropdown', 'value'),
+    Input('passup_RNbar', 'clickData'),
+    State('main-filter-dropdown', 'value'),
+    State('city-dropdown', 'value'),
+    prevent_initial_call=True,
+)
+def select_route(click, main_filter, city_key):
+    route = click['points'][0].get('x') if click else None
+    # Only the route bars have route labels on the x axis
+    if main_filter not in ROUTE_BAR_FILTERS or str(route) not in registry.get(city_key).route_matrix.index:
+        return dash.no_update
+    return str(route)
+
+# The equity table only ever receives the rows of its current page
+@app.callback(
+    Output('equity-table', 'data'),
+    Output('equity-table', 'page_count'),
+    Input('equity-table', 'page_current'),
+    Input('equity-table', 'page_size'),
+    Input('equity-table', 'sort_by'),
+    Input('equity-table', 'filter_query'),
+    Input('city-dropdown', 'value'),
+)
+def update_equity(page_current, page_size, sort_by, filter_query, city_key):
+    records, page_count, _ = paged_table(registry.get(city_key), 'equity').page(page_current, page_size, sort_by, filter_query)
+    return records, page_count
+
+@app.callback(
+    Output('passup-records', 'data'),
+    Output('passup-records', 'page_count'),
+    Input('passup-records', 'page_current'),
+    Input('passup-records', 'page_size'),
+    Input('passup-records', 'sort_by'),
+    Input('passup-records', 'filter_query'),
+    Input('city-dropdown', 'value'),
+)
+def update_records(page_current, page_size, sort_by, filter_query, city_key):
+    records, page_count, _ = paged_table(registry.get(city_key), 'passups').page(page_current, page_size, sort_by, filter_query)
+    return records, page_count
+
+boot.mark('callbacks')
+if PROFILE_STARTUP:
+    boot.report()
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8050)) # for Heroku deployment
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+Versioned artifact bundle written by build.py and read by the web app.
+
+Layout of a bundle:
+
+    artifacts/
+        CURRENT                 version of the active bundle
+        <version>/
+            manifest.json       version, sources, row counts, build timings
+            boundary.json       city boundary trace
+            tables/*.parquet    cleaned stops, pass-ups and census points, and the
+                                quarantined pass-ups with their reason codes
+            aggregates/*.parquet
+            figures/*.json      pre-serialized plotly figures
+            rasters/*.png       heat map density rasters
+            arrays/*.npy        precomputed indexes (e.g. Morton order of the points)
+            mapped/*.arrow      the tables as Arrow IPC files, written on first use
+
+Only pandas, numpy and pyarrow are needed to read a bundle. Tables are
+memory-mapped from their Arrow files rather than read into every process,
+so the gunicorn workers of a host share one copy of them in the page cache.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+
+ARTIFACT_ROOT = os.environ.get('WTC_ARTIFACTS', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'artifacts'))
+
+# Rows per parquet row group of the tables, so streamed reads hold one group at a time
+TABLE_ROW_GROUP = 65536
+
+# Map tables from Arrow files (see Bundle.map_table); 0 reads them from parquet into each process
+MAPPED_TABLES = os.environ.get('WTC_MAPPED_TABLES', '1') != '0'
+
+# Bump when the bundle layout or the pipeline output changes
+BUNDLE_FORMAT = 12
+
+
+def data_version(raw, params):
+    """
+    Content hash of the pipeline inputs.
+
+    Args:
+        raw (dict): Raw source bytes keyed by source name.
+        params (dict): JSON-serializable pipeline parameters (city, thresholds, ...).
+
+    Returns:
+        str: A short hex version string.
+    """
+    digest = hashlib.sha1()
+    digest.update(json.dumps({'format': BUNDLE_FORMAT, 'params': params}, sort_keys=True).encode())
+    for name in sorted(raw):
+        digest.update(name.encode())
+        digest.update(hashlib.sha1(raw[name]).digest())
+    return digest.hexdigest()[:12]
+
+
+def write_json(path, obj):
+    with open(path, 'w') as f:
+        json.dump(obj, f)
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def replace_text(path, text):
+    # Write next to the target and rename, so readers never see a partial file
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def write_bundle(version, tables, aggregates, boundary, figures, manifest, rasters=None, arrays=None, root=None):
+    """
+    Writes a bundle and makes it the current one.
+
+    The bundle is written to a temporary directory and renamed into place, so
+    a reader never sees a half-written bundle.
+
+    Args:
+        version (str): The data version, see data_version.
+        tables (dict): DataFrames keyed by table name.
+        aggregates (dict): Count DataFrames keyed by aggregate name.
+        boundary (list): The boundary trace.
+        figures (dict): plotly figures, or their JSON, keyed by name.
+        manifest (dict): Extra metadata to store in manifest.json.
+        rasters (dict): PNG bytes keyed by file name.
+        arrays (dict): numpy arrays keyed by name.
+        root (str): The artifact root directory; defaults to ARTIFACT_ROOT.
+
+    Returns:
+        str: The path of the bundle.
+    """
+    root = root or ARTIFACT_ROOT
+    path = os.path.join(root, version)
+    tmp = os.path.join(root, '.%s.%d.tmp' % (version, os.getpid()))
+    for sub in ('tables', 'aggregates', 'figures', 'rasters', 'arrays'):
+        os.makedirs(os.path.join(tmp, sub), exist_ok=True)
+
+    for name, df in tables.items():
+        df.to_parquet(os.path.join(tmp, 'tables', name + '.parquet'), row_group_size=TABLE_ROW_GROUP)
+    for name, df in aggregates.items():
+        df.to_parquet(os.path.join(tmp, 'aggregates', name + '.parquet'))
+    for name, fig in figures.items():
+        with open(os.path.join(tmp, 'figures', name + '.json'), 'w') as f:
+            f.write(fig if isinstance(fig, str) else fig.to_json())
+    for name, png in (rasters or {}).items():
+        with open(os.path.join(tmp, 'rasters', name), 'wb') as f:
+            f.write(png)
+    for name, array in (arrays or {}).items():
+        np.save(os.path.join(tmp, 'arrays', name + '.npy'), array)
+    write_json(os.path.join(tmp, 'boundary.json'), boundary)
+    write_json(os.path.join(tmp, 'manifest.json'), {
+        **manifest,
+        'version': version,
+        'format': BUNDLE_FORMAT,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'tables': {name: len(df) for name, df in tables.items()},
+        'aggregates': sorted(aggregates),
+        'figures': sorted(figures),
+        'arrays': sorted(arrays or {}),
+    })
+
+    if os.path.isdir(path):
+        # Same inputs were already built
+        shutil.rmtree(tmp)
+    else:
+        os.rename(tmp, path)
+    replace_text(os.path.join(root, 'CURRENT'), version)
+    return path
+
+
+def current_version(root=None):
+    root = root or ARTIFACT_ROOT
+    try:
+        with open(os.path.join(root, 'CURRENT')) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def bundle_dir(version, root=None):
+    """
+    Directory of a bundle version, or None if the version string isn't a plain
+    hex version (it comes from request urls).
+    """
+    if not version.isalnum():
+        return None
+    return os.path.join(root or ARTIFACT_ROOT, version)
+
+
+# Rough size in memory of a parsed JSON figure relative to its file
+JSON_MEMORY_FACTOR = 4
+
+
+class FigureStore(dict):
+    """Figure dicts of a bundle, each read from its JSON file on first access."""
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.file_bytes = 0
+
+    def __missing__(self, name):
+        path = os.path.join(self.path, name + '.json')
+        fig = read_json(path)
+        self[name] = fig
+        self.file_bytes += os.path.getsize(path)
+        return fig
+
+
+class Bundle:
+    """
+    A built artifact bundle.
+
+    The manifest and boundary are read eagerly; figures, tables, aggregates and
+    arrays are read on first use and kept.
+
+    Args:
+        path (str): The bundle directory.
+        mapped (bool): Memory-map the tables, see map_table.
+    """
+
+    def __init__(self, path, mapped=MAPPED_TABLES):
+        self.path = path
+        self.mapped = mapped
+        self.manifest = read_json(os.path.join(path, 'manifest.json'))
+        self.version = self.manifest['version']
+        self.boundary = read_json(os.path.join(path, 'boundary.json'))
+        self.figures = FigureStore(os.path.join(path, 'figures'))
+        self._tables = {}
+        self._aggregates = {}
+        self._arrays = {}
+        # Deep memory of every loaded frame, measured once at load; measuring string columns is slow
+        self._frame_bytes = 0
+
+    def read_frame(self, sub, name):
+        df = pd.read_parquet(os.path.join(self.path, sub, name + '.parquet'))
+        self._frame_bytes += int(df.memory_usage(deep=True).sum())
+        return df
+
+    def table(self, name):
+        if name not in self._tables:
+            self._tables[name] = self.map_table(name) if self.mapped else self.read_frame('tables', name)
+        return self._tables[name]
+
+    def mapped_path(self, name):
+        """The Arrow file of a table, written from its parquet file if missing; None if it can't be written."""
+        path = os.path.join(self.path, 'mapped', name + '.arrow')
+        if not os.path.exists(path):
+            table = pq.read_table(os.path.join(self.path, 'tables', name + '.parquet'))
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Uncompressed, so the columns can be used where they lie in the file
+                with ipc.new_file(tmp, table.schema) as writer:
+                    writer.write_table(table)
+                os.replace(tmp, path)
+            except OSError:
+                return None
+        return path
+
+    def map_table(self, name):
+        """
+        A table whose columns are views of its memory-mapped Arrow file.
+
+        Numbers, times and strings stay in the file's pages, which the OS
+        shares between every process mapping the file, so a worker holds
+        little more than the column objects. The columns are read-only, like
+        any pandas view. Falls back to reading the parquet file when the
+        bundle directory isn't writable.
+        """
+        path = self.mapped_path(name)
+        if path is None:
+            return self.read_frame('tables', name)
+        return ipc.open_file(pa.memory_map(path)).read_all().to_pandas(split_blocks=True)
+
+    def prepare(self):
+        """Writes the Arrow file of every table, e.g. in the gunicorn master before it forks the workers."""
+        for name in self.manifest['tables']:
+            self.mapped_path(name)
+
+    def array(self, name):
+        # Memory-mapped, so only the pages a request touches are read
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.path, 'arrays', name + '.npy'), mmap_mode='r')
+        return self._arrays[name]
+
+    def aggregate(self, name):
+        if name not in self._aggregates:
+            self._aggregates[name] = self.read_frame('aggregates', name)
+        return self._aggregates[name]
+
+    def warm(self, figures=None):
+        """
+        Reads the tables, aggregates and figures now rather than on first use.
+
+        Args:
+            figures (list): The figures to read, e.g. those in use in the bundle
+                this one replaces; all of them by default.
+        """
+        for name in self.manifest['tables']:
+            self.table(name)
+        for name in self.manifest['aggregates']:
+            self.aggregate(name)
+        for name in (self.manifest['figures'] if figures is None else figures):
+            if name in self.manifest['figures']:
+                self.figures[name]
+
+    def memory_bytes(self):
+        """
+        Estimated memory held by what has been loaded so far.
+
+        Memory-mapped tables and arrays aren't counted; the OS pages them in and out.
+        """
+        return self._frame_bytes + self.figures.file_bytes * JSON_MEMORY_FACTOR
+
+
+def load_bundle(version=None, root=None):
+    """
+    Opens a bundle.
+
+    Args:
+        version (str): The version to open; defaults to the current one.
+        root (str): The artifact root directory; defaults to ARTIFACT_ROOT.
+
+    Returns:
+        Bundle: The bundle, or None if nothing has been built yet.
+    """
+    root = root or ARTIFACT_ROOT
+    version = version or current_version(root)
+    if version is None:
+        return None
+    return Bundle(os.path.join(root, version))
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Build command: runs the data pipeline once and writes the artifact bundle
+that app.py starts from.
+
+    python build.py
+    python build.py --passups data/Transit_Pass_ups.csv --out artifacts
+    python build.py --gtfs data/google_transit.zip --walk-graph cache/winnipeg_walk.graphml
+    python build.py --dry-run
+"""
+
+import argparse
+import time
+
+from plotly.colors import sequential
+
+import artifacts
+import density
+import equity
+import gtfs
+import paging
+import pipeline
+import shapes
+import walk
+from cities import DEFAULT_CITY, load_cities
+from figures import build_census_figures, build_passup_figures, build_stop_figures, density_rasters
+from frames import build_all_frames
+from spikes import SpikeDetector
+from stages import STAGE_CACHE_DIR
+from tiles import TileRenderer
+from timeseries import RouteDayMatrix
+from vector_tiles import build_spatial_indexes
+
+# Optional sources that build.py reads itself instead of the pipeline
+EXTRA_SOURCES = ('gtfs', 'walk_graph')
+
+
+def raster_stage(stops, passups, census, boundary):
+    return density.build_rasters({'stops': stops, 'passups': passups, 'census': census}, boundary, sequential.Plasma)
+
+
+def frames_stage(passups, boundary):
+    return build_all_frames(passups, density.raster_bounds(boundary, pad=0))
+
+
+def spikes_stage(passups):
+    # The matrix as its parts; it holds a lock, so it can't be pickled itself
+    route_matrix = RouteDayMatrix.from_passups(passups)
+    return route_matrix.meta(), route_matrix.counts, SpikeDetector.backfill(route_matrix).spike_table()
+
+
+def corridors_stage(passups, feed):
+    return shapes.corridor_counts(passups, feed)
+
+
+# Figure stages keep the JSON the bundle stores; unpickling plotly figures would validate them all over again
+def stop_figures_stage(stops, boundary, version, rasters, city_key=DEFAULT_CITY):
+    figures = build_stop_figures(stops, boundary, density_rasters(version, rasters[1], city=city_key))
+    return {name: fig.to_json() for name, fig in figures.items()}
+
+
+def passup_figures_stage(passups, aggregates, boundary, version, rasters, frames, spikes, corridors=None, city_key=DEFAULT_CITY):
+    aggregates = {**aggregates, 'spikes': spikes[2]}
+    if corridors is not None:
+        aggregates['corridors'] = corridors[0]
+    figures = build_passup_figures(passups, aggregates, boundary, density_rasters(version, rasters[1], city=city_key),
+                                   {'arrays': frames[0], 'meta': frames[1]})
+    return {name: fig.to_json() for name, fig in figures.items()}
+
+
+def census_figures_stage(census, census_all, boundary, version, rasters, city_key=DEFAULT_CITY):
+    figures = build_census_figures(census, census_all, boundary, density_rasters(version, rasters[1], city=city_key))
+    return {name: fig.to_json() for name, fig in figures.items()}
+
+
+def add_build_stages(graph, version, feed=None, feed_digest=None, city_key=DEFAULT_CITY):
+    """
+    Adds the rasters, animation frames, spikes, corridors and figure groups to a pipeline graph.
+
+    The figures embed raster urls holding the data version, so they are
+    keyed by it and rebuilt whenever any source changes; the rasters and
+    frames only when their own inputs do.
+
+    Args:
+        graph (stages.StageGraph): The pipeline graph, see pipeline.pipeline_graph.
+        version (str): The data version.
+        feed (gtfs.Feed): The GTFS feed, if any.
+        feed_digest (str): feed.digest(), if the caller already has it; the
+            feed's files are hashed otherwise.
+        city_key (str): The registry key of the city (see cities.py), part of the tile urls.
+
+    Returns:
+        list: The names of the added stages.
+    """
+    graph.add_value('version', version, key=version)
+    graph.add('rasters', raster_stage, ['stops.sjoin', 'passups.routes', 'census.classes', 'boundary.trace'])
+    graph.add('frames', frames_stage, ['passups.routes', 'boundary.trace'])
+    graph.add('spikes', spikes_stage, ['passups.routes'])
+    passup_inputs = ['passups.routes', 'aggregates', 'boundary.trace', 'version', 'rasters', 'frames', 'spikes']
+    if feed is not None and 'shapes.txt' in feed.names():
+        graph.add_value('gtfs', feed, key=feed_digest or feed.digest())
+        graph.add('corridors', corridors_stage, ['passups.routes', 'gtfs'])
+        passup_inputs.append('corridors')
+    city = {'city_key': city_key}
+    graph.add('figures.stops', stop_figures_stage, ['stops.sjoin', 'boundary.trace', 'version', 'rasters'], params=city)
+    graph.add('figures.passups', passup_figures_stage, passup_inputs, params=city)
+    graph.add('figures.census', census_figures_stage, ['census.classes', 'census.parse', 'boundary.trace', 'version', 'rasters'],
+              params=city)
+    return [name for name in ('rasters', 'frames', 'spikes', 'corridors', 'figures.stops', 'figures.passups', 'figures.census')
+            if name in graph.stages]
+
+
+def build(sources=None, city=pipeline.CITY, root=None, workers=4, processes=None, seed_tiles=False, dry_run=False,
+          city_key=DEFAULT_CITY, passup_types=None, cache_dir=STAGE_CACHE_DIR):
+    """
+    Runs the pipeline, builds the figures and writes the bundle.
+
+    Args:
+        sources (dict): Paths or urls overriding pipeline.SOURCES, plus an
+            optional 'gtfs' feed (directory or zip) for the scheduled service
+            rates and, if it has shapes.txt, the corridor map, and an optional
+            'walk_graph' GraphML file for the census walk access.
+        city (str): The place name of the city boundary.
+        root (str): The artifact root directory.
+        workers (int): Threads used to run the pipeline branches concurrently.
+        processes (int): Processes for the pass-up time enrichment and boundary filter; None or 1 keeps them serial.
+        seed_tiles (bool): Pre-render the heat map tiles for zoom 9-13.
+        dry_run (bool): Only print which stages would be recomputed and which loaded from the stage cache.
+        city_key (str): The registry key of the city (see cities.py), so its tile urls name it.
+        passup_types (list): Pass-Up Type labels of the city's agency; pipeline.PASSUP_TYPES by default.
+        cache_dir (str): Directory of the stage cache; None recomputes every stage.
+
+    Returns:
+        str: The path of the written bundle; None for a dry run.
+    """
+    timings = {}
+    feed = (sources or {}).get('gtfs')
+    graph_path = (sources or {}).get('walk_graph')
+
+    # The pipeline stages plus the build's own, memoized by content hash (see stages.py)
+    graph = pipeline.pipeline_graph({name: source for name, source in (sources or {}).items() if name not in EXTRA_SOURCES},
+                                    city, processes, cache_dir, passup_types)
+    params = {'city': city, 'min_route_count': pipeline.MIN_ROUTE_COUNT, 'passup_types': passup_types or pipeline.PASSUP_TYPES,
+              'heat_layers': density.HEAT_LAYERS, 'resolutions': density.RESOLUTIONS}
+    # Reading the sources is the only work needed to key every stage
+    raw = {name[:-len('.read')]: value for name, value in graph.run([name for name in graph.stages if name.endswith('.read')]).items()}
+    feed_digest = None
+    if feed:
+        # The feed is streamed, never read whole; its digest stands in for the bytes
+        feed = gtfs.Feed(feed)
+        feed_digest = feed.digest()
+        raw = {**raw, 'gtfs': feed_digest}
+    if graph_path:
+        raw = {**raw, 'walk_graph': pipeline.read_source(graph_path)}
+    version = artifacts.data_version(raw, params)
+    targets = add_build_stages(graph, version, feed, feed_digest, city_key)
+
+    if dry_run:
+        print("Data version", version, "- stages of a build (run = recomputed, cached = loaded from %s):" % graph.cache_dir)
+        graph.report(pipeline.PIPELINE_TARGETS + targets)
+        return None
+
+    start = time.perf_counter()
+    result = pipeline.run_pipeline(city=city, workers=workers, processes=processes, graph=graph)
+    timings['pipeline'] = time.perf_counter() - start
+
+    values = graph.run(targets, workers, timings)
+    raster_files, raster_meta = values['rasters']
+    frame_arrays, frame_meta = values['frames']
+    figures = {**values['figures.stops'], **values['figures.passups'], **values['figures.census']}
+
+    route_day, route_counts, result['aggregates']['spikes'] = values['spikes']
+    route_matrix = RouteDayMatrix(route_day['routes'], route_day['start'], route_counts)
+
+    service_meta = None
+    if feed:
+        start = time.perf_counter()
+        service_aggregates, service_meta = gtfs.service_aggregates(result['tables']['passups'], feed)
+        result['aggregates'].update(service_aggregates)
+        timings['gtfs'] = time.perf_counter() - start
+        if 'corridors' in values:
+            result['aggregates']['corridors'], service_meta['corridors'] = values['corridors']
+
+    walk_meta, access = None, None
+    if graph_path:
+        start = time.perf_counter()
+        walk_graph = walk.WalkGraph(walk.load_graph(graph_path))
+        census = result['tables']['census']
+        access = walk.walk_access(census, result['tables']['stops'], walk_graph)
+        result['aggregates']['walk_access'] = census[['DAUID', 'Total_15_to_19_years', 'Lat', 'Long']].join(access)
+        walk_meta = {'graph': walk_graph.version, 'nodes': len(walk_graph.x), 'cutoff': walk.MAX_WALK_METERS}
+        timings['walk'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result['aggregates']['equity'] = equity.equity_scores(result['tables']['census'], result['tables']['passups'],
+                                                          result['tables']['stops'], access)
+    timings['equity'] = time.perf_counter() - start
+
+    tables = {name: df for name, df in result['tables'].items() if name != 'census_all'}
+    # Sort permutations and category codes of the dashboard's paged tables
+    equity_arrays, equity_paging = paging.table_indexes('equity', result['aggregates']['equity'], equity.EQUITY_COLUMNS)
+    record_arrays, record_paging = paging.table_indexes('passups', tables['passups'], paging.PASSUP_RECORD_COLUMNS,
+                                                        paging.PASSUP_RECORD_CATEGORIES, table='passups')
+    arrays = {**build_spatial_indexes(tables), **frame_arrays, 'route_day': route_matrix.counts,
+              **equity_arrays, **record_arrays}
+
+    start = time.perf_counter()
+    path = artifacts.write_bundle(
+        version, tables, result['aggregates'], result['boundary'], figures,
+        manifest={'params': params, 'sources': {**pipeline.SOURCES, **(sources or {})},
+                  'timings': timings, 'stage_timings': result['timings'], 'rasters': raster_meta,
+                  'frames': frame_meta, 'route_day': route_matrix.meta(), 'gtfs': service_meta,
+                  'walk': walk_meta, 'paging': {'equity': equity_paging, 'passups': record_paging},
+                  'quarantine': pipeline.quarantine_counts(tables['quarantine'])},
+        rasters=raster_files,
+        arrays=arrays,
+        root=root,
+    )
+    timings['write'] = time.perf_counter() - start
+
+    if seed_tiles:
+        start = time.perf_counter()
+        count = TileRenderer(artifacts.load_bundle(version, root)).seed()
+        timings['tiles'] = time.perf_counter() - start
+        print("Seeded", count, "heat map tiles")
+
+    pruned = graph.prune()
+    print("Built data version", version, "in", path)
+    if pruned:
+        print("Pruned", pruned, "stale files from the stage cache")
+    print("Quarantined pass-ups by reason:", pipeline.quarantine_counts(tables['quarantine']) or 'none')
+    cached = sorted(name for name, status in graph.status.items() if status == 'cached')
+    print("Stages loaded from the stage cache:", ', '.join(cached) if cached else 'none')
+    pipeline.report_timings(result['timings'])
+    for stage, seconds in timings.items():
+        print("  %-16s %.2fs" % (stage, seconds))
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stops', help='path or url of the GTFS stops file')
+    parser.add_argument('--passups', help='path or url of the pass-up csv')
+    parser.add_argument('--census', help='path or url of the census point csv')
+    parser.add_argument('--gtfs', help='GTFS feed directory or zip, for pass-ups per 100 scheduled trips')
+    parser.add_argument('--walk-graph', help='GraphML walk network (see walk.py), for walking distances to stops')
+    parser.add_argument('--city', default=None, help='place name of the city boundary (default: %s)' % pipeline.CITY)
+    parser.add_argument('--city-key', default=None, help='build a city of the registry (see cities.py) into its own artifact root')
+    parser.add_argument('--out', default=None, help='artifact root directory')
+    parser.add_argument('--workers', type=int, default=4, help='threads for the concurrent pipeline stages (1 = sequential)')
+    parser.add_argument('--processes', type=int, default=None, help='processes for the pass-up time enrichment and boundary filter')
+    parser.add_argument('--seed-tiles', action='store_true', help='pre-render the heat map tiles for zoom 9-13')
+    parser.add_argument('--dry-run', action='store_true', help='only report which stages would be recomputed')
+    args = parser.parse_args(argv)
+
+    sources = {name: getattr(args, name) for name in ('stops', 'passups', 'census') + EXTRA_SOURCES if getattr(args, name)}
+    city, root, city_key, passup_types = args.city or pipeline.CITY, args.out, args.city_key or DEFAULT_CITY, None
+    if args.city_key:
+        entry = load_cities()[args.city_key]
+        sources = {**entry['sources'], **sources}
+        city, root, passup_types = args.city or entry['place'], args.out or entry['root'], entry['passup_types']
+    build(sources, city, root, args.workers, args.processes, args.seed_tiles, args.dry_run, city_key, passup_types)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of the cities served by the dashboard.
+
+Every city has its own artifact root with versioned bundles (see
+artifacts.py), built from its own stops, pass-up and census sources:
+
+    python build.py --city-key calgary
+
+Cities are declared in a JSON file named by WTC_CITIES, keyed by a short
+city key:
+
+    {"calgary": {"label": "Calgary", "place": "Calgary, Canada",
+                 "sources": {"stops": "...", "passups": "...", "census": "..."},
+                 "passup_types": ["Full Bus", "Accessible Pass-Up"]}}
+
+passup_types lists the Pass-Up Type labels of the city's agency, which
+validation accepts; Winnipeg's (ingest.PASSUP_TYPES) by default.
+
+The web process loads a city's bundle when it is first asked for, and
+never builds one while serving: a city without a bundle raises
+MissingBundle, which the app answers with a 503 naming the build command.
+It evicts the least recently used cities once the loaded data goes over
+WTC_CITY_MEMORY_MB. A background thread checks the loaded cities for a new
+bundle every WTC_REFRESH_SECONDS and hot-swaps it in, see CityRegistry.refresh.
+Under gunicorn every worker has its own thread and timer, so for up to one
+interval after a new bundle the workers serve different versions; they
+record what they serve in the shared cache, and CityRegistry.status reports
+the split the same from any worker.
+"""
+
+import collections
+import json
+import os
+import threading
+import time
+
+import artifacts
+from ingest import LIVE_BUFFER_SIZE, PASSUP_TYPES, LiveFeed
+from spikes import SpikeDetector
+from tiles import TileRenderer
+from timeseries import RouteDayMatrix
+from vector_tiles import VectorTiles
+
+DEFAULT_CITY = 'winnipeg'
+
+# The original city: pipeline.CITY and pipeline.SOURCES, bundles directly under ARTIFACT_ROOT
+CITIES = {
+    DEFAULT_CITY: {'label': 'Winnipeg', 'place': 'Winnipeg, Canada', 'sources': {}},
+}
+
+CITY_MEMORY_BYTES = int(os.environ.get('WTC_CITY_MEMORY_MB', 1024)) * 1024 * 1024
+# Seconds between two checks for new bundles; 0 turns the refresher off
+REFRESH_SECONDS = float(os.environ.get('WTC_REFRESH_SECONDS', 30))
+# Refresh intervals without a report after which a worker counts as stopped, see CityRegistry.status
+WORKER_STATE_INTERVALS = 3
+
+
+def load_cities(path=None):
+    """
+    The built-in cities plus those of the WTC_CITIES file.
+
+    Returns:
+        dict: City entries keyed by city key, each with 'label', 'place',
+        'sources', 'passup_types' (None for the default) and 'root' (its
+        artifact root directory).
+    """
+    cities = {key: dict(entry) for key, entry in CITIES.items()}
+    path = path or os.environ.get('WTC_CITIES')
+    if path:
+        with open(path) as f:
+            cities.update(json.load(f))
+    for key, entry in cities.items():
+        if not key.isalnum():
+            raise ValueError("City keys must be alphanumeric: %r" % key)
+        entry.setdefault('label', key.title())
+        entry.setdefault('place', entry['label'])
+        entry.setdefault('sources', {})
+        entry.setdefault('passup_types', None)
+        entry.setdefault('root', artifacts.ARTIFACT_ROOT if key == DEFAULT_CITY
+                         else os.path.join(artifacts.ARTIFACT_ROOT, 'cities', key))
+    return cities
+
+
+class CityData:
+    """
+    The loaded bundle of one city and everything the dashboard derives from it.
+
+    Attributes:
+        key (str): The city key.
+        label (str): Display name.
+        bundle (artifacts.Bundle): The city's current bundle.
+        live_feed (ingest.LiveFeed): Live pass-ups of the city; outlives evictions.
+
+    An existing live feed is attached to the new route matrix and spike
+    detector right away, unless attach is False; then attach() does it later.
+    A new one logs to live_log(key, size) if given, see shared_cache.SharedCache.live_log.
+    """
+
+    def __init__(self, key, entry, bundle, live_feed=None, attach=True, live_log=None):
+        self.key = key
+        self.label = entry['label']
+        self.bundle = bundle
+        self.figures = bundle.figures
+        self.tile_renderer = TileRenderer(bundle)
+        self.vector_tiles = VectorTiles(bundle)
+        self.route_matrix = RouteDayMatrix.from_bundle(bundle)
+        self.detector = SpikeDetector.backfill(self.route_matrix)
+        if live_feed is None:
+            live_feed = LiveFeed(bundle.boundary, bundle.aggregate('route_counts')['Route Number'].astype(str),
+                                 self.route_matrix, self.detector,
+                                 log=live_log(key, LIVE_BUFFER_SIZE) if live_log is not None else None,
+                                 passup_types=bundle.manifest['params'].get('passup_types') or PASSUP_TYPES)
+        elif attach:
+            live_feed.attach(self.route_matrix, self.detector)
+        self.live_feed = live_feed
+        # Per-city caches of the dashboard callbacks
+        self.bar_positions = {}
+        self.view_colors = {}
+        self.route_figures = {}
+        self.paged_tables = {}
+        self.layout = None
+
+    def attach(self):
+        """Points the live feed at this city's route matrix and detector, replaying its buffer into them."""
+        self.live_feed.attach(self.route_matrix, self.detector)
+
+    def memory_bytes(self):
+        points = sum(p.xs.nbytes + p.ys.nbytes + (0 if p.weights is None else p.weights.nbytes)
+                     for p in self.tile_renderer.points.values())
+        return self.bundle.memory_bytes() + points + self.route_matrix.counts.nbytes
+
+
+class MissingBundle(LookupError):
+    """A registered city that has no artifact bundle yet."""
+
+
+class CityRegistry:
+    """
+    Lazily loaded cities with least recently used eviction.
+
+    Args:
+        cities (dict): City entries, see load_cities.
+        budget_bytes (int): Estimated memory the loaded cities may hold; the
+            city in use is never evicted, even when it alone is over budget.
+        build_missing (bool): Build a city's bundle on first use if it has none,
+            outside the registry lock. Off in the web process, where a request
+            must not wait on a build; scripts may turn it on.
+        live_log (callable): Makes the live pass-up log of a city from its key
+            and size, e.g. SharedCache.live_log; each process keeps its own otherwise.
+        worker_states (shared_cache.SharedWorkerStates): Where the processes
+            running a refresher record the versions they serve, for status;
+            status only knows this process's otherwise.
+    """
+
+    def __init__(self, cities=None, budget_bytes=CITY_MEMORY_BYTES, build_missing=False, live_log=None,
+                 worker_states=None):
+        self.cities = cities if cities is not None else load_cities()
+        self.budget_bytes = budget_bytes
+        self.build_missing = build_missing
+        self.live_log = live_log
+        self.worker_states = worker_states
+        self.loaded = collections.OrderedDict()
+        self.live_feeds = {}
+        self.lock = threading.RLock()
+        # One lock per city key, held while that city loads, see get
+        self.loading = {}
+        # The last refresh of every city, see refresh
+        self.refreshes = {}
+        self.refresher = None
+        self.refresh_interval = None
+
+    def get(self, key=None):
+        """
+        The loaded city, loading it first if needed.
+
+        A city is loaded outside the registry lock, under a lock of its own
+        key, so requests for the cities already loaded don't wait on it and
+        concurrent requests for the same city load it once. It is inserted
+        under the registry lock, like refresh swaps one in.
+
+        Raises:
+            KeyError: For a city key that isn't registered.
+            MissingBundle: For a city that has no bundle, unless build_missing is set.
+        """
+        key = key or DEFAULT_CITY
+        entry = self.cities[key]
+        with self.lock:
+            city = self.loaded.get(key)
+            if city is not None:
+                self.loaded.move_to_end(key)
+                return city
+            loading = self.loading.setdefault(key, threading.Lock())
+        with loading:
+            with self.lock:
+                city = self.loaded.get(key)
+            if city is None:
+                if self.build_missing and not self.has_bundle(key):
+                    self.build(key)
+                # The live feed keeps its log and buffer across evictions, and moves onto this city once inserted
+                city = CityData(key, entry, self.load_bundle(key, entry), self.live_feeds.get(key), attach=False,
+                                live_log=self.live_log)
+                with self.lock:
+                    self.loaded[key] = city
+                    city.attach()
+                    self.live_feeds[key] = city.live_feed
+                    self.trim(keep=key)
+                self.report()
+        return city
+
+    def load_bundle(self, key, entry):
+        bundle = artifacts.load_bundle(root=entry['root'])
+        if bundle is None:
+            raise MissingBundle("No artifact bundle for %s, build one with `python build.py --city-key %s`"
+                                % (entry['label'], key))
+        return bundle
+
+    def has_bundle(self, key):
+        return artifacts.current_version(self.cities[key]['root']) is not None
+
+    def build(self, key):
+        """Builds a city's bundle in this thread, without holding the lock, as build.py --city-key does."""
+        entry = self.cities[key]
+        print("No artifact bundle found for %s, building one (run `python build.py --city-key %s` ahead of time to skip this)"
+              % (entry['label'], key))
+        from build import build
+        build(sources=entry['sources'] or None, city=entry['place'], root=entry['root'], city_key=key,
+              passup_types=entry['passup_types'])
+
+    def trim(self, keep):
+        """Evicts least recently used cities until the rest fit the budget."""
+        with self.lock:
+            total = sum(city.memory_bytes() for city in self.loaded.values())
+            for key in list(self.loaded):
+                if total <= self.budget_bytes:
+                    break
+                if key == keep:
+                    continue
+                total -= self.loaded.pop(key).memory_bytes()
+
+    def refresh(self, key, warm=None):
+        """
+        Swaps in the current bundle of a loaded city if it has a new version.
+
+        The new bundle's tables, aggregates and the figures in use, and the
+        CityData built on them, are all made before the swap, off the request path.
+        The swap is a single assignment in self.loaded: requests that already
+        hold the old CityData finish with it, and the next ones get the new one.
+        The live feed is moved onto the new route matrix in the same locked
+        step, only once the swap is done. A bundle that fails to load leaves
+        the old one in place, live feed included.
+
+        Args:
+            key (str): The city key.
+            warm (callable): Called with the new CityData before the swap, to
+                fill the caches of the dashboard (e.g. its page layout).
+
+        Returns:
+            bool: Whether a new bundle was swapped in.
+        """
+        entry = self.cities[key]
+        with self.lock:
+            old = self.loaded.get(key)
+        version = artifacts.current_version(entry['root'])
+        if old is None or version is None or version == old.bundle.version:
+            return False
+        start = time.perf_counter()
+        try:
+            bundle = artifacts.load_bundle(version, entry['root'])
+            # The figures the old bundle had loaded; the rest stay lazy, as they were
+            bundle.warm(figures=list(old.figures))
+            # The live feed keeps feeding the old city until the swap
+            city = CityData(key, entry, bundle, self.live_feeds.get(key), attach=False)
+            if warm is not None:
+                warm(city)
+        except Exception as error:
+            self.refreshes[key] = {'version': version, 'error': repr(error), 'finished': time.time()}
+            return False
+        with self.lock:
+            if key in self.loaded:
+                self.loaded[key] = city
+                city.attach()
+            self.live_feeds[key] = city.live_feed
+        self.refreshes[key] = {'version': version, 'previous': old.bundle.version,
+                               'seconds': round(time.perf_counter() - start, 3), 'finished': time.time()}
+        return True
+
+    def start_refresher(self, interval=REFRESH_SECONDS, warm=None):
+        """
+        Refreshes every loaded city every interval seconds on a daemon thread.
+
+        Safe to call on every request: it starts one thread per process, so a
+        forked worker starts its own rather than relying on its parent's.
+        Every worker checks on its own timer; after each check it records
+        what it serves in worker_states, see status.
+        """
+        if interval <= 0 or (self.refresher is not None and self.refresher[0] == os.getpid()):
+            return
+        with self.lock:
+            if self.refresher is not None and self.refresher[0] == os.getpid():
+                return
+
+            def loop():
+                while True:
+                    time.sleep(interval)
+                    for key in list(self.loaded):
+                        self.refresh(key, warm)
+                    self.report()
+
+            thread = threading.Thread(target=loop, name='bundle-refresher', daemon=True)
+            self.refresher, self.refresh_interval = (os.getpid(), thread), interval
+            thread.start()
+        self.report()
+
+    def report(self):
+        """
+        Records the version and last refresh of every city this process
+        serves in worker_states, and forgets the others. Only processes
+        running a refresher report, so the preloading gunicorn master, which
+        serves nothing, doesn't.
+        """
+        if self.worker_states is None or self.refresher is None or self.refresher[0] != os.getpid():
+            return
+        with self.lock:
+            loaded = {key: city.bundle.version for key, city in self.loaded.items()}
+        for key in self.cities:
+            self.worker_states.record(key, loaded.get(key), self.refreshes.get(key))
+
+    def status(self):
+        """
+        The served and current data version and the last refresh of every city.
+
+        With worker_states, this covers every worker that reported within
+        WORKER_STATE_INTERVALS refresh intervals, so all workers answer the
+        same: 'versions' counts the workers serving each version, 'version'
+        is the one they all serve (None while they are split, for up to one
+        interval after a new bundle, or when none has the city loaded), and
+        'last_refresh' is the latest refresh of any of them.
+        """
+        with self.lock:
+            loaded = {key: city.bundle.version for key, city in self.loaded.items()}
+        if self.worker_states is not None and self.refresh_interval:
+            workers = self.worker_states.read(WORKER_STATE_INTERVALS * self.refresh_interval)
+        else:
+            workers = {key: {os.getpid(): {'version': version, 'last_refresh': self.refreshes.get(key)}}
+                       for key, version in loaded.items()}
+        status = {}
+        for key, entry in self.cities.items():
+            states = list(workers.get(key, {}).values())
+            versions = collections.Counter(state['version'] for state in states)
+            refreshes = [state['last_refresh'] for state in states if state['last_refresh']]
+            status[key] = {'version': next(iter(versions)) if len(versions) == 1 else None, 'versions': dict(versions),
+                           'current': artifacts.current_version(entry['root']),
+                           'last_refresh': max(refreshes, key=lambda refresh: refresh['finished'], default=None)}
+        return status
+
+    def by_version(self, version):
+        """
+        The city whose artifact root has a bundle of this data version, or None.
+
+        The city comes with its current bundle, which is a newer one when the
+        version was swapped out by a refresh while a page still asked for it.
+        """
+        with self.lock:
+            for city in self.loaded.values():
+                if city.bundle.version == version:
+                    return city
+        for key, entry in self.cities.items():
+            path = artifacts.bundle_dir(version, entry['root'])
+            if path is not None and os.path.isdir(path):
+                return self.get(key)
+        return None
+
+    def root_of(self, version):
+        """The bundle directory of a data version in any city, or None."""
+        for entry in self.cities.values():
+            path = artifacts.bundle_dir(version, entry['root'])
+            if path is not None and os.path.isdir(path):
+                return path
+        return None
+
+    def options(self):
+        return [{'label': entry['label'], 'value': key} for key, entry in self.cities.items()]
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Server-side kernel density rasters.
+
+Points are binned on a regular lat/lon grid and convolved with a Gaussian
+kernel using FFT, then coloured and encoded as PNG. The heat maps show the
+PNG as a mapbox image layer, so their payload no longer grows with the
+number of points. Only numpy is needed.
+"""
+
+import math
+import struct
+import zlib
+
+import numpy as np
+
+# Metres per degree of latitude
+METRES_PER_DEGREE = 111320.0
+
+# Raster widths (pixels) written to the bundle for every layer
+RESOLUTIONS = {'low': 512, 'medium': 1024, 'high': 2048}
+DEFAULT_RESOLUTION = 'medium'
+
+
+def raster_bounds(boundary, pad=0.02):
+    """
+    Bounding box of the boundary trace, padded by a fraction of its size.
+
+    Args:
+        boundary (list): The administrative boundary trace, see pipeline.boundary_trace.
+        pad (float): Padding as a fraction of the box width and height.
+
+    Returns:
+        tuple: (west, south, east, north) in degrees.
+    """
+    lats = np.concatenate([ring['lat'] for ring in boundary])
+    lons = np.concatenate([ring['lon'] for ring in boundary])
+    west, east, south, north = lons.min(), lons.max(), lats.min(), lats.max()
+    dx, dy = (east - west) * pad, (north - south) * pad
+    return float(west - dx), float(south - dy), float(east + dx), float(north + dy)
+
+
+def grid_shape(bounds, width):
+    # Keep pixels square on the ground at the centre latitude
+    west, south, east, north = bounds
+    mid_lat = math.radians((south + north) / 2)
+    height = int(round(width * (north - south) / ((east - west) * math.cos(mid_lat))))
+    return max(height, 1), width
+
+
+def grid_points(lat, lon, bounds, shape, weights=None):
+    """
+    Sums the points (or their weights) per grid cell.
+
+    Args:
+        lat (array): Latitudes.
+        lon (array): Longitudes.
+        bounds (tuple): (west, south, east, north).
+        shape (tuple): (height, width) of the grid.
+        weights (array): Optional weight per point.
+
+    Returns:
+        np.ndarray: Grid of shape `shape`, row 0 at the north edge.
+    """
+    west, south, east, north = bounds
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    keep = np.isfinite(lat) & np.isfinite(lon)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+        keep &= np.isfinite(weights)
+        weights = weights[keep]
+    grid, _, _ = np.histogram2d(lat[keep], lon[keep], bins=shape,
+                                range=[[south, north], [west, east]], weights=weights)
+    return grid[::-1]
+
+
+def gaussian_blur(grid, sigma_px):
+    """
+    Convolves the grid with a Gaussian kernel using FFT.
+
+    The grid is zero-padded by 3 sigma so that mass near an edge doesn't wrap
+    around to the opposite edge.
+
+    Args:
+        grid (np.ndarray): 2D grid.
+        sigma_px (float): Kernel standard deviation in pixels.
+
+    Returns:
+        np.ndarray: The smoothed grid, same shape as the input.
+    """
+    pad = int(math.ceil(3 * sigma_px))
+    height, width = grid.shape
+    shape = (height + 2 * pad, width + 2 * pad)
+
+    # Kernel centred on pixel (0, 0) with wrap-around offsets
+    ky = np.fft.fftfreq(shape[0]) * shape[0]
+    kx = np.fft.fftfreq(shape[1]) * shape[1]
+    kernel = np.exp(-(ky[:, None] ** 2 + kx[None, :] ** 2) / (2 * sigma_px ** 2))
+    kernel /= kernel.sum()
+
+    padded = np.zeros(shape)
+    padded[pad:pad + height, pad:pad + width] = grid
+    smoothed = np.fft.irfft2(np.fft.rfft2(padded) * np.fft.rfft2(kernel), s=shape)
+    return np.clip(smoothed[pad:pad + height, pad:pad + width], 0, None)
+
+
+def metres_per_pixel(bounds, width):
+    west, south, east, north = bounds
+    return (north - south) * METRES_PER_DEGREE / grid_shape(bounds, width)[0]
+
+
+def density_grid(lat, lon, bounds, width, sigma_m, weights=None):
+    """
+    Kernel density of the points on a grid `width` pixels wide.
+
+    Args:
+        lat (array): Latitudes.
+        lon (array): Longitudes.
+        bounds (tuple): (west, south, east, north).
+        width (int): Grid width in pixels.
+        sigma_m (float): Kernel standard deviation in metres.
+        weights (array): Optional weight per point, e.g. Total_15_Density.
+
+    Returns:
+        np.ndarray: The density grid, row 0 at the north edge.
+    """
+    shape = grid_shape(bounds, width)
+    grid = grid_points(lat, lon, bounds, shape, weights)
+    return gaussian_blur(grid, max(sigma_m / metres_per_pixel(bounds, width), 0.5))
+
+
+def colour_lut(colorscale):
+    """
+    256-entry RGB lookup table interpolated from a plotly colorscale.
+
+    Args:
+        colorscale (list): Colours as '#rrggbb' or 'rgb(r, g, b)' strings.
+
+    Returns:
+        np.ndarray: uint8 array of shape (256, 3).
+    """
+    def to_rgb(colour):
+        if colour.startswith('#'):
+            return [int(colour[i:i + 2], 16) for i in (1, 3, 5)]
+        return [float(c) for c in colour[colour.index('(') + 1:colour.index(')')].split(',')[:3]]
+
+    stops = np.array([to_rgb(c) for c in colorscale], dtype=float)
+    positions = np.linspace(0, 1, len(stops))
+    x = np.linspace(0, 1, 256)
+    return np.stack([np.interp(x, positions, stops[:, i]) for i in range(3)], axis=1).astype(np.uint8)
+
+
+def colorize(grid, lut, opacity=1.0, vmax=None):
+    """
+    Maps a density grid to RGBA. Empty cells are transparent and alpha ramps
+    up with density, so the base map shows through thin areas.
+
+    Args:
+        grid (np.ndarray): The density grid.
+        lut (np.ndarray): Colour lookup table, see colour_lut.
+        opacity (float): Maximum alpha, 0 to 1.
+        vmax (float): Value mapped to the top of the scale; defaults to the grid maximum.
+
+    Returns:
+        np.ndarray: uint8 array of shape (height, width, 4).
+    """
+    vmax = vmax or float(grid.max()) or 1.0
+    scaled = np.clip(grid / vmax, 0, 1)
+    rgba = np.empty(grid.shape + (4,), dtype=np.uint8)
+    rgba[..., :3] = lut[(scaled * 255).astype(np.uint8)]
+    rgba[..., 3] = (np.clip(scaled * 4, 0, 1) * opacity * 255).astype(np.uint8)
+    return rgba
+
+
+def encode_png(rgba):
+    """
+    Encodes an RGBA array as PNG bytes.
+
+    Args:
+        rgba (np.ndarray): uint8 array of shape (height, width, 4).
+
+    Returns:
+        bytes: The PNG file.
+    """
+    height, width = rgba.shape[:2]
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    # Filter type 0 (none) in front of every row
+    rows = np.concatenate([np.zeros((height, 1), dtype=np.uint8), rgba.reshape(height, width * 4)], axis=1)
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows.tobytes(), 6))
+            + chunk(b'IEND', b''))
+
+
+def image_coordinates(bounds):
+    # Corner order expected by mapbox image layers: top-left, top-right, bottom-right, bottom-left
+    west, south, east, north = bounds
+    return [[west, north], [east, north], [east, south], [west, south]]
+
+
+def render_layer(lat, lon, bounds, sigma_m, colorscale, opacity=1.0, weights=None, resolutions=None):
+    """
+    Renders one heat layer at several resolutions.
+
+    Args:
+        lat (array): Latitudes.
+        lon (array): Longitudes.
+        bounds (tuple): (west, south, east, north).
+        sigma_m (float): Kernel standard deviation in metres.
+        colorscale (list): plotly colorscale colours.
+        opacity (float): Maximum alpha of the overlay.
+        weights (array): Optional weight per point.
+        resolutions (dict): Raster widths keyed by name; defaults to RESOLUTIONS.
+
+    Returns:
+        tuple: ({resolution: png bytes}, metadata dict with bounds, coordinates and
+        the per-resolution peak values, per pixel and per km2).
+    """
+    lut = colour_lut(colorscale)
+    pngs, peaks, peaks_per_km2 = {}, {}, {}
+    for name, width in (resolutions or RESOLUTIONS).items():
+        grid = density_grid(lat, lon, bounds, width, sigma_m, weights)
+        peaks[name] = float(grid.max())
+        peaks_per_km2[name] = peaks[name] / (metres_per_pixel(bounds, width) / 1000) ** 2
+        pngs[name] = encode_png(colorize(grid, lut, opacity))
+    meta = {
+        'bounds': list(bounds),
+        'coordinates': image_coordinates(bounds),
+        'sigma_m': sigma_m,
+        'opacity': opacity,
+        'weighted': weights is not None,
+        'peaks': peaks,
+        'peaks_per_km2': peaks_per_km2,
+    }
+    return pngs, meta
+
+
+# Heat layers of the dashboard: source table, optional weight column, kernel size and overlay opacity
+HEAT_LAYERS = {
+    'stops': {'table': 'stops', 'weight': None, 'sigma_m': 250, 'opacity': 0.5},
+    'passups': {'table': 'passups', 'weight': None, 'sigma_m': 250, 'opacity': 0.5},
+    'teens_total': {'table': 'census', 'weight': 'Total_15_Density', 'sigma_m': 1500, 'opacity': 1.0},
+    'teens_men': {'table': 'census', 'weight': 'Men_15_Density', 'sigma_m': 1500, 'opacity': 1.0},
+    'teens_women': {'table': 'census', 'weight': 'Women_15_Density', 'sigma_m': 1500, 'opacity': 1.0},
+}
+
+
+def raster_name(layer, resolution):
+    return '%s_%s.png' % (layer, resolution)
+
+
+def build_rasters(tables, boundary, colorscale):
+    """
+    Renders every heat layer at every resolution.
+
+    Args:
+        tables (dict): 'stops', 'passups' and 'census' dataframes.
+        boundary (list): The administrative boundary trace.
+        colorscale (list): plotly colorscale colours.
+
+    Returns:
+        tuple: ({file name: png bytes}, {layer: metadata}).
+    """
+    bounds = raster_bounds(boundary)
+    files, meta = {}, {}
+    for layer, spec in HEAT_LAYERS.items():
+        df = tables[spec['table']]
+        weights = df[spec['weight']] if spec['weight'] else None
+        pngs, meta[layer] = render_layer(df['Lat'], df['Long'], bounds, spec['sigma_m'], colorscale,
+                                         spec['opacity'], weights)
+        for resolution, png in pngs.items():
+            files[raster_name(layer, resolution)] = png
+    return files, meta
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Teen transit equity score of every census point.
+
+The score ranks neighbourhoods by how much they need reliable service: many
+teens, many pass-ups nearby and few stops within walking distance. Each of
+the three is turned into a percentile over all census points and the score
+is their mean, from 0 to 100.
+
+Pass-ups and stops are counted around all census points in one batch: both
+are binned once into a grid of GRID_METERS cells, and the count around a
+point is the sum of the cells of a precomputed disk of offsets, gathered
+for every point at once.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Cell size of the counting grid
+GRID_METERS = 50
+# Pass-ups within this distance of a census point count towards its intensity
+PASSUP_RADIUS = 500
+# Stops within this distance count as covering a census point
+STOP_RADIUS = 400
+
+METERS_PER_DEGREE = 111320.0
+
+EQUITY_COLUMNS = ['Rank', 'DAUID', 'Teens', 'Teen Density', 'Pass-ups / yr (500 m)', 'Stops (400 m)',
+                  'Walk to Stop (m)', 'Equity Score']
+
+
+class CountGrid:
+    """Points binned into square cells on a local metre plane around an origin."""
+
+    def __init__(self, lat, lon, lat0, lon0, cell=GRID_METERS):
+        self.lat0, self.lon0, self.cell = lat0, lon0, cell
+        self.scale = np.cos(np.radians(lat0))
+        cx, cy = self.cells(lat, lon)
+        ok = ~(np.isnan(lat) | np.isnan(lon))
+        cx, cy = cx[ok], cy[ok]
+        self.x0, self.y0 = (int(cx.min()), int(cy.min())) if len(cx) else (0, 0)
+        shape = (int(cy.max()) - self.y0 + 1, int(cx.max()) - self.x0 + 1) if len(cx) else (1, 1)
+        self.counts = np.bincount((cy - self.y0) * shape[1] + (cx - self.x0), minlength=shape[0] * shape[1]).reshape(shape)
+
+    def cells(self, lat, lon):
+        x = (np.asarray(lon, dtype=float) - self.lon0) * self.scale * METERS_PER_DEGREE
+        y = (np.asarray(lat, dtype=float) - self.lat0) * METERS_PER_DEGREE
+        with np.errstate(invalid='ignore'):
+            return np.floor(x / self.cell).astype(np.int64), np.floor(y / self.cell).astype(np.int64)
+
+    def within(self, lat, lon, radius):
+        """Points within radius of every query point (to the resolution of the grid)."""
+        reach = int(np.ceil(radius / self.cell))
+        dy, dx = np.mgrid[-reach:reach + 1, -reach:reach + 1]
+        disk = np.hypot(dx, dy) * self.cell <= radius
+        dx, dy = dx[disk], dy[disk]
+        cx, cy = self.cells(lat, lon)
+        # (points, offsets) cell positions, all gathered in one go
+        gx = cx[:, None] + dx[None, :] - self.x0
+        gy = cy[:, None] + dy[None, :] - self.y0
+        inside = (gx >= 0) & (gx < self.counts.shape[1]) & (gy >= 0) & (gy < self.counts.shape[0])
+        values = self.counts[np.where(inside, gy, 0), np.where(inside, gx, 0)]
+        return np.where(inside, values, 0).sum(axis=1)
+
+
+def equity_scores(census_within, passup_within, stops_within, walk_access=None):
+    """
+    The equity score table.
+
+    Args:
+        census_within (pd.DataFrame): The census points within the city.
+        passup_within (pd.DataFrame): The cleaned pass-ups within the city.
+        stops_within (pd.DataFrame): The stops within the city.
+        walk_access (pd.DataFrame): Walking distances of the census points,
+            see walk.walk_access; used for display when the build had a walk graph.
+
+    Returns:
+        pd.DataFrame: EQUITY_COLUMNS, one row per census point, best ranked first.
+    """
+    lat, lon = census_within['Lat'].to_numpy(dtype=float), census_within['Long'].to_numpy(dtype=float)
+    lat0, lon0 = float(np.nanmean(lat)), float(np.nanmean(lon))
+
+    passups = CountGrid(passup_within['Lat'].to_numpy(dtype=float), passup_within['Long'].to_numpy(dtype=float), lat0, lon0)
+    stops = CountGrid(stops_within['Lat'].to_numpy(dtype=float), stops_within['Long'].to_numpy(dtype=float), lat0, lon0)
+    times = pd.to_datetime(passup_within['Time'])
+    years = max((times.max() - times.min()) / pd.Timedelta(days=365.25), 1) if len(times) else 1
+
+    table = pd.DataFrame({
+        'DAUID': census_within['DAUID'].to_numpy(),
+        'Teens': census_within['Total_15_to_19_years'].to_numpy(),
+        'Teen Density': census_within['Total_15_Density'].round(1).to_numpy(),
+        'Pass-ups / yr (500 m)': (passups.within(lat, lon, PASSUP_RADIUS) / years).round(1),
+        'Stops (400 m)': stops.within(lat, lon, STOP_RADIUS),
+        'Walk to Stop (m)': (walk_access['Walk to Stop (m)'].reindex(census_within.index).to_numpy()
+                             if walk_access is not None else np.nan),
+    })
+
+    # Need grows with teens and pass-ups, and shrinks with the stops in reach
+    need = (table['Teen Density'].rank(pct=True).fillna(0)
+            + table['Pass-ups / yr (500 m)'].rank(pct=True)
+            + 1 - table['Stops (400 m)'].rank(pct=True))
+    table['Equity Score'] = (100 * need / 3).round(1)
+    table = table.sort_values('Equity Score', ascending=False, kind='stable', ignore_index=True)
+    table['Rank'] = np.arange(1, len(table) + 1)
+    return table[EQUITY_COLUMNS]
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming export of filtered pass-ups as CSV or Parquet.
+
+The filters of a request (route, year, hour range, time period, pass-up type
+and bounding box) become one pyarrow dataset filter over the bundle's
+pass-up table, so row groups are read one batch at a time, rows that don't
+match are dropped before they reach pandas, and every batch is encoded and
+handed to the response before the next is read. Memory stays at one batch
+however large the export is:
+
+    curl -o school.csv 'http://localhost:8050/api/passups/export.csv?route=11,60&hours=7-9&year=2019'
+"""
+
+import argparse
+import os
+import sys
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import artifacts
+
+# Rows read, filtered and written at a time
+EXPORT_BATCH_ROWS = 50000
+
+EXPORT_COLUMNS = ['Pass-Up ID', 'Pass-Up Type', 'Time', 'Route', 'Route Number', 'Route Name', 'Route Destination',
+                  'Location', 'Lat', 'Long', 'Year', 'Hour', 'Time_Period']
+
+EXPORT_FORMATS = {'csv': 'text/csv', 'parquet': 'application/vnd.apache.parquet'}
+
+
+class ExportError(ValueError):
+    """A filter value that can't be read."""
+
+
+def split_values(value):
+    return [part.strip() for part in value.split(',') if part.strip()]
+
+
+def export_filter(args):
+    """
+    The dataset filter of the request arguments.
+
+    Args:
+        args (dict): Query arguments, all optional:
+            'route'  comma-separated route labels, e.g. '11,60';
+            'year'   comma-separated years;
+            'hours'  an hour range 'from-to', inclusive, wrapping past midnight if from > to;
+            'period' comma-separated Time_Period values;
+            'type'   comma-separated pass-up types;
+            'bbox'   'west,south,east,north' in degrees.
+
+    Returns:
+        pyarrow.compute.Expression: The filter, or None for every row.
+    """
+    clauses = []
+    try:
+        if args.get('route'):
+            clauses.append(pc.field('Route').isin(split_values(args['route'])))
+        if args.get('year'):
+            clauses.append(pc.field('Year').isin([int(year) for year in split_values(args['year'])]))
+        if args.get('hours'):
+            start, end = (int(hour) for hour in args['hours'].split('-'))
+            hour = pc.field('Hour')
+            if start <= end:
+                clauses.append((hour >= start) & (hour <= end))
+            else:
+                clauses.append((hour >= start) | (hour <= end))
+        if args.get('period'):
+            clauses.append(pc.field('Time_Period').isin(split_values(args['period'])))
+        if args.get('type'):
+            clauses.append(pc.field('Pass-Up Type').isin(split_values(args['type'])))
+        if args.get('bbox'):
+            west, south, east, north = (float(value) for value in args['bbox'].split(','))
+            clauses.append((pc.field('Long') >= west) & (pc.field('Long') <= east)
+                           & (pc.field('Lat') >= south) & (pc.field('Lat') <= north))
+    except ValueError as error:
+        raise ExportError(str(error))
+
+    expression = None
+    for clause in clauses:
+        expression = clause if expression is None else expression & clause
+    return expression
+
+
+def export_batches(bundle, args, batch_rows=EXPORT_BATCH_ROWS):
+    """
+    The matching pass-ups, read lazily.
+
+    Returns:
+        tuple: (schema of the exported columns, iterator of record batches).
+    """
+    dataset = ds.dataset(os.path.join(bundle.path, 'tables', 'passups.parquet'), format='parquet')
+    columns = [column for column in EXPORT_COLUMNS if column in dataset.schema.names]
+    schema = pa.schema([dataset.schema.field(column) for column in columns])
+    return schema, dataset.to_batches(columns=columns, filter=export_filter(args), batch_size=batch_rows)
+
+
+class ChunkSink:
+    """A write-only file whose bytes are taken out as soon as they are written."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_csv(batches):
+    header = True
+    for batch in batches:
+        if batch.num_rows:
+            yield batch.to_pandas().to_csv(index=False, header=header, date_format='%Y-%m-%d %H:%M:%S').encode()
+            header = False
+
+
+def stream_parquet(batches, schema):
+    sink = ChunkSink()
+    # One row group per batch, each sent as soon as it's written
+    with pq.ParquetWriter(sink, schema) as writer:
+        for batch in batches:
+            if batch.num_rows:
+                writer.write_table(pa.Table.from_batches([batch], schema))
+                yield sink.take()
+    yield sink.take()
+
+
+def export_stream(bundle, args, fmt='csv', batch_rows=EXPORT_BATCH_ROWS):
+    """
+    The encoded export, chunk by chunk.
+
+    Args:
+        bundle (artifacts.Bundle): The bundle to export from.
+        args (dict): The filters, see export_filter.
+        fmt (str): 'csv' or 'parquet'.
+        batch_rows (int): Rows read and encoded at a time.
+
+    Returns:
+        generator: bytes chunks; the filters are checked before the first one.
+    """
+    schema, batches = export_batches(bundle, args, batch_rows)
+    return stream_csv(batches) if fmt == 'csv' else stream_parquet(batches, schema)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export the pass-ups of the current bundle matching the filters.')
+    parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='csv')
+    parser.add_argument('--out', help='output file; stdout if not given')
+    for name in ('route', 'year', 'hours', 'period', 'type', 'bbox'):
+        parser.add_argument('--' + name, help='see export_filter')
+    args = parser.parse_args(argv)
+
+    filters = {name: getattr(args, name) for name in ('route', 'year', 'hours', 'period', 'type', 'bbox')}
+    out = open(args.out, 'wb') if args.out else sys.stdout.buffer
+    try:
+        for chunk in export_stream(artifacts.load_bundle(), filters, args.format):
+            out.write(chunk)
+    finally:
+        if args.out:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
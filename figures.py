@@ -0,0 +1,654 @@
+# -*- coding: utf-8 -*-
+"""
+Maps and charts of the dashboard.
+
+Figures are built once by build.py and stored as JSON in the artifact bundle.
+"""
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+from plotly.colors import make_colorscale, qualitative, sample_colorscale, sequential
+from plotly.subplots import make_subplots
+
+from density import DEFAULT_RESOLUTION
+from frames import frame_grid
+from tiles import tile_url
+from spikes import spike_passups
+from timeseries import PEAK_PERIODS
+
+HOVER_PASSUP = ['Route Name', 'Route Number', 'Pass-Up Type', 'Time']
+HOVER_CENSUS = ['Total_15_to_19_years', 'Men_15_to_19_years', 'Women_15_to_19_years', 'Shape_Area(km^2)',
+                'Total_15_Density', 'Men_15_Density', 'Women_15_Density']
+ZOOM_LEVEL = 9
+MAPBOX_STYLE = "carto-positron"
+
+# Point scatter maps: source table, colour grouping, hover and title
+SCATTER_VIEWS = {
+    'fig': {'table': 'stops', 'color': None, 'hover_name': 'stop_name', 'hover_data': 'stop_url',
+            'title': '<br>Winnipeg Public Transport Stops'},
+    'fig_pass': {'table': 'passups', 'color': None, 'hover_name': 'Pass-Up ID', 'hover_data': HOVER_PASSUP,
+                 'title': '<br>Winnipeg Public Transport Pass-up Data'},
+    'fig_RN': {'table': 'passups', 'color': 'Route Number', 'hover_name': 'Pass-Up ID', 'hover_data': HOVER_PASSUP,
+               'title': '<br>Winnipeg Public Transport Pass-up Data by Route Number'},
+    'fig_YR': {'table': 'passups', 'color': 'Year', 'hover_name': 'Pass-Up ID', 'hover_data': HOVER_PASSUP,
+               'title': '<br>Pass-ups data in Winnipeg by year'},
+    'fig_TR': {'table': 'passups', 'color': 'Time_Period', 'hover_name': 'Pass-Up ID', 'hover_data': HOVER_PASSUP,
+               'title': '<br>Pass-ups data in Winnipeg by Time Period'},
+    'fig_HR': {'table': 'passups', 'color': 'Hour', 'hover_name': 'Pass-Up ID', 'hover_data': HOVER_PASSUP,
+               'title': '<br>Pass-ups data in Winnipeg by Hour'},
+    'fig_TP': {'table': 'passups', 'color': 'Pass-Up Type', 'hover_name': 'Pass-Up ID', 'hover_data': HOVER_PASSUP,
+               'title': '<br>Pass-ups data in Winnipeg by Pass-up Type'},
+}
+# Tables whose views share one points trace, so switching views only changes colours
+RECOLOURED_TABLES = {'passups'}
+
+
+def add_boundary(fig, boundary):
+    # plotly.express is imported where it's used; the web process rarely needs it
+    import plotly.express as px
+
+    # Just use the Winnipeg's boundary (lines)
+    for ring in boundary:
+        fig.add_trace(px.line_mapbox(lat=ring['lat'], lon=ring['lon']).data[0])
+
+
+# Function for creating Scatter Maps
+def create_scatter_mapbox(df, lat, lon, color, hover_name, hover_data, title, zoom_level, center_lat, center_lon, mapbox_style, boundary, **kwargs):
+    """
+    Creates an interactive scatter mapbox plot using plotly_express.
+
+    Args:
+        df (pd.DataFrame): The dataframe containing the data.
+        lat(str): The name of the column containing latitude values.
+        lon(str): The name of the column containing longitude values.
+        hover_name (str): The name of the column to use for hover name.
+        hover_data (list): A list of column names to include in the hover data.
+        title (str): The title of the plot.
+        zoom_level (int): The zoom level of the map.
+        center_lat (float): The latitude of the center of the map.
+        center_lon (float): The longitude of the center of the map.
+        mapbox_style (str): The style of the mapbox.
+        boundary (list): The administrative boundary trace, see pipeline.boundary_trace.
+        **kwargs: Passed on to px.scatter_mapbox (e.g. fixed colour maps).
+
+    Returns:
+        plotly.graph_objects.Figure: The plotly figure object.
+    """
+    import plotly.express as px
+
+    fig = px.scatter_mapbox(
+        df,
+        lat=lat,
+        lon=lon,
+        color=color,
+        hover_name=hover_name,
+        hover_data=hover_data,
+        title=title,
+        zoom=zoom_level,
+        center=dict(lat=center_lat, lon=center_lon),
+        mapbox_style=mapbox_style,
+        color_discrete_sequence=qualitative.Light24,
+        **kwargs,
+    )
+    add_boundary(fig, boundary)
+
+    # update the margin to fit the screen
+    fig.update_layout(
+        margin={"r": 0, "t": 0, "l": 0, "b": 0},
+    )
+
+    return fig
+
+
+# Function for creating Heat Maps
+def create_density_raster_mapbox(raster, opacity, title, zoom_level, center_lat, center_lon, mapbox_style, color_continuous_scale, boundary):
+    """
+    Creates a heat map showing server-rendered density rasters as a mapbox layer.
+
+    Args:
+        raster (dict): 'layer' (mapbox layer: xyz tiles or a single image) and
+            'cmax' (peak density for the colour bar), see density_rasters.
+        opacity (float): The opacity of the layer.
+        title (str): The title of the plot.
+        zoom_level (int): The zoom level of the map.
+        center_lat (float): The latitude of the center of the map.
+        center_lon (float): The longitude of the center of the map.
+        mapbox_style (str): The style of the mapbox.
+        color_continuous_scale (str): The color scale the raster was coloured with, for the colour bar.
+        boundary (list): The administrative boundary trace, see pipeline.boundary_trace.
+
+    Returns:
+        plotly.graph_objects.Figure: The plotly figure object.
+    """
+    fig = go.Figure()
+
+    # A single transparent marker, only there to draw the colour bar
+    fig.add_trace(go.Scattermapbox(
+        lat=[center_lat], lon=[center_lon], mode='markers', hoverinfo='skip', showlegend=False,
+        marker=dict(size=0, opacity=0, color=[0], cmin=0, cmax=raster['cmax'], showscale=True,
+                    colorscale=color_continuous_scale, colorbar=dict(title='per km²')),
+    ))
+    add_boundary(fig, boundary)
+
+    fig.update_layout(
+        title=title,
+        mapbox=dict(
+            style=mapbox_style,
+            zoom=zoom_level,
+            center=dict(lat=center_lat, lon=center_lon),
+            layers=[dict(raster['layer'], opacity=opacity, below='traces')],
+        ),
+        margin={"r": 0, "t": 0, "l": 0, "b": 0},
+    )
+
+    return fig
+
+
+# Function for creating animated Heat Maps from per-period grid counts
+def create_animated_density_mapbox(frames, meta, radius, title, zoom_level, center_lat, center_lon, mapbox_style, color_continuous_scale, boundary):
+    """
+    Creates a heat map with a play button and a slider over precomputed frames.
+
+    Args:
+        frames (np.ndarray): Counts of shape (periods, cells), see frames.build_frames.
+        meta (dict): Frame metadata: 'labels' and the grid 'bounds' and 'shape'.
+        radius (int): The radius of the density circles.
+        title (str): The title of the plot.
+        zoom_level (int): The zoom level of the map.
+        center_lat (float): The latitude of the center of the map.
+        center_lon (float): The longitude of the center of the map.
+        mapbox_style (str): The style of the mapbox.
+        color_continuous_scale (str): The color scale to use for the counts.
+        boundary (list): The administrative boundary trace, see pipeline.boundary_trace.
+
+    Returns:
+        plotly.graph_objects.Figure: The plotly figure object.
+    """
+    grid = frame_grid(meta['bounds'], meta['shape'][1])
+    zmax = max(int(frames.max()), 1) if frames.size else 1
+
+    def frame_trace(counts):
+        # Only the cells with pass-ups go over the wire
+        cells = np.flatnonzero(counts)
+        return go.Densitymapbox(
+            lat=np.round(grid['lat'][cells], 5), lon=np.round(grid['lon'][cells], 5), z=counts[cells],
+            radius=radius, zmin=0, zmax=zmax, colorscale=color_continuous_scale,
+            hovertemplate='%{z} pass-ups<extra></extra>',
+        )
+
+    labels = meta['labels']
+    fig = go.Figure(
+        data=[frame_trace(frames[0]) if len(labels) else go.Densitymapbox()],
+        frames=[go.Frame(name=label, data=[frame_trace(frames[i])], traces=[0]) for i, label in enumerate(labels)],
+    )
+    add_boundary(fig, boundary)
+
+    play = dict(frame=dict(duration=400, redraw=True), fromcurrent=True, transition=dict(duration=0))
+    fig.update_layout(
+        title=title,
+        mapbox=dict(style=mapbox_style, zoom=zoom_level, center=dict(lat=center_lat, lon=center_lon)),
+        updatemenus=[dict(type='buttons', direction='left', x=0.02, y=0.02, xanchor='left', yanchor='bottom', buttons=[
+            dict(label='Play', method='animate', args=[None, play]),
+            dict(label='Pause', method='animate', args=[[None], dict(frame=dict(duration=0, redraw=False), mode='immediate')]),
+        ])],
+        sliders=[dict(x=0.15, y=0.02, len=0.8, yanchor='bottom', currentvalue=dict(prefix=''), steps=[
+            dict(label=label, method='animate', args=[[label], dict(mode='immediate', frame=dict(duration=0, redraw=True))])
+            for label in labels
+        ])],
+        margin={"r": 0, "t": 0, "l": 0, "b": 0},
+    )
+
+    return fig
+
+
+# Function for creating a line layer of per-segment counts
+def create_segment_line_mapbox(segments, column, classes, title, zoom_level, center_lat, center_lon, mapbox_style, color_continuous_scale, boundary):
+    """
+    Creates a map of route shape segments coloured by a count column.
+
+    A mapbox line trace has one colour, so the segments are binned into
+    colour classes and every class is one trace of polylines separated by
+    gaps.
+
+    Args:
+        segments (pd.DataFrame): Segments with 'lat' and 'lon' polylines, see shapes.EdgeIndex.segment_counts.
+        column (str): The column to colour by.
+        classes (int): Number of colour classes above zero.
+        title (str): The title of the plot.
+        zoom_level (int): The zoom level of the map.
+        center_lat (float): The latitude of the center of the map.
+        center_lon (float): The longitude of the center of the map.
+        mapbox_style (str): The style of the mapbox.
+        color_continuous_scale (list): The colours to sample the classes from.
+        boundary (list): The administrative boundary trace, see pipeline.boundary_trace.
+
+    Returns:
+        plotly.graph_objects.Figure: The plotly figure object.
+    """
+    fig = go.Figure()
+    add_boundary(fig, boundary)
+
+    values = segments[column].to_numpy(dtype=float)
+    # Class 0 holds the segments without pass-ups, the rest split the others by quantile
+    edges = np.unique(np.quantile(values[values > 0], np.linspace(0, 1, classes + 1))) if (values > 0).any() else np.array([0.0])
+    codes = np.where(values > 0, np.searchsorted(edges[1:-1], values, side='right') + 1, 0)
+    colours = sample_colorscale(color_continuous_scale, max(len(edges) - 1, 1))
+    for code in range(len(edges)):
+        rows = segments[codes == code]
+        if not len(rows):
+            continue
+        lat, lon, text = [], [], []
+        for line_lat, line_lon, label in zip(rows['lat'], rows['lon'], rows['Route'].astype(str) + ': ' + rows[column].astype(str)):
+            lat += list(np.round(line_lat, 5)) + [None]
+            lon += list(np.round(line_lon, 5)) + [None]
+            text += [label] * len(line_lat) + [None]
+        if code == 0:
+            name, colour, width = 'No pass-ups', '#c8c8c8', 1.5
+        else:
+            name, colour, width = '%g - %g' % (edges[code - 1], edges[code]), colours[code - 1], 2 + code
+        fig.add_trace(go.Scattermapbox(lat=lat, lon=lon, mode='lines', name=name, line=dict(color=colour, width=width),
+                                       text=None if code == 0 else text, hoverinfo='skip' if code == 0 else 'text'))
+
+    fig.update_layout(
+        title=title,
+        legend_title_text=column,
+        mapbox=dict(style=mapbox_style, zoom=zoom_level, center=dict(lat=center_lat, lon=center_lon)),
+        margin={"r": 0, "t": 0, "l": 0, "b": 0},
+    )
+    return fig
+
+
+def map_center(df):
+    # Layout pre-setting, to show all the city boundary
+    return df['Lat'].mean() - 0.025, df['Long'].mean()
+
+
+# Function for creating Scatter Maps whose colouring can be swapped in place
+def create_coloured_scatter_mapbox(df, view, colors, zoom_level, center_lat, center_lon, mapbox_style, boundary):
+    """
+    Creates a scatter map with all points in one trace, coloured by codes.
+
+    Unlike px.scatter_mapbox, the points don't depend on the colour column:
+    the marker colours are small codes into a stepped colorscale and the
+    legend is a set of empty traces after the points. Views of one table
+    then differ only in the points trace's marker, the legend traces and
+    the titles, see view_marker.
+
+    Args:
+        df (pd.DataFrame): The rows to plot.
+        view (dict): The entry of SCATTER_VIEWS.
+        colors (dict): Colour settings of the whole table, see view_colors.
+        zoom_level (int): The zoom level of the map.
+        center_lat (float): The latitude of the center of the map.
+        center_lon (float): The longitude of the center of the map.
+        mapbox_style (str): The style of the mapbox.
+        boundary (list): The administrative boundary trace, see pipeline.boundary_trace.
+
+    Returns:
+        plotly.graph_objects.Figure: The boundary traces, the points trace and the legend traces.
+    """
+    fig = go.Figure()
+    add_boundary(fig, boundary)
+
+    hover_data = view['hover_data']
+    lines = ['%s=%%{customdata[%d]}' % (column, i) for i, column in enumerate(hover_data)]
+    marker, legend = view_marker(df, view['color'], colors)
+    fig.add_trace(go.Scattermapbox(
+        lat=df['Lat'], lon=df['Long'], mode='markers', marker=marker, showlegend=False, name='',
+        hovertext=df[view['hover_name']], customdata=df[hover_data],
+        hovertemplate='<b>%{hovertext}</b><br><br>' + '<br>'.join(lines + ['Lat=%{lat}', 'Long=%{lon}']) + '<extra></extra>',
+    ))
+    fig.add_traces(legend)
+
+    fig.update_layout(
+        title=view['title'],
+        legend_title_text=view['color'],
+        mapbox=dict(style=mapbox_style, zoom=zoom_level, center=dict(lat=center_lat, lon=center_lon)),
+        margin={"r": 0, "t": 0, "l": 0, "b": 0},
+    )
+    return fig
+
+
+def view_marker(df, color, colors):
+    """
+    Marker of the points trace and legend traces of a coloured view.
+
+    Args:
+        df (pd.DataFrame): The rows on the map.
+        color (str): The colour column, or None.
+        colors (dict): Colour settings of the whole table, see view_colors.
+
+    Returns:
+        tuple: (marker dict, list of legend traces).
+    """
+    palette = qualitative.Light24
+    if color is None:
+        return dict(color=palette[0]), []
+    if 'range_color' in colors:
+        cmin, cmax = colors['range_color']
+        marker = dict(color=df[color], colorscale=make_colorscale(sequential.Plasma),
+                      cmin=cmin, cmax=cmax, showscale=True, colorbar=dict(title=dict(text=color)))
+        return marker, []
+
+    categories = colors['category_orders'][color]
+    if not categories:
+        return dict(color=palette[0]), []
+    # Code i sits in the middle of the i-th colour step; unknown values have no code
+    codes = pd.Categorical(df[color], categories=categories).codes.astype(float)
+    codes[codes < 0] = np.nan
+    k = len(categories)
+    colorscale = []
+    for i, category in enumerate(categories):
+        colorscale += [[i / k, colors['color_discrete_map'][category]], [(i + 1) / k, colors['color_discrete_map'][category]]]
+    marker = dict(color=codes, colorscale=colorscale, cmin=-0.5, cmax=k - 0.5, showscale=False)
+    legend = [go.Scattermapbox(lat=[None], lon=[None], mode='markers', name=str(category), legendgroup=str(category),
+                               marker=dict(color=colors['color_discrete_map'][category]))
+              for category in categories]
+    return marker, legend
+
+
+def scatter_view(name, df, center_lat, center_lon, boundary, zoom_level=ZOOM_LEVEL, **kwargs):
+    """
+    Creates one of the SCATTER_VIEWS.
+
+    Args:
+        name (str): The figure name, a key of SCATTER_VIEWS.
+        df (pd.DataFrame): The rows to plot.
+        center_lat (float): The latitude of the center of the map.
+        center_lon (float): The longitude of the center of the map.
+        boundary (list): The administrative boundary trace.
+        zoom_level (float): The zoom level of the map.
+        **kwargs: Colour settings, see view_colors; computed from df if not given.
+
+    Returns:
+        plotly.graph_objects.Figure: The plotly figure object.
+    """
+    view = SCATTER_VIEWS[name]
+    if view['table'] in RECOLOURED_TABLES:
+        return create_coloured_scatter_mapbox(
+            df=df, view=view, colors=kwargs or view_colors(df, view['color']), zoom_level=zoom_level,
+            center_lat=center_lat, center_lon=center_lon, mapbox_style=MAPBOX_STYLE, boundary=boundary,
+        )
+    return create_scatter_mapbox(
+        df=df, lat='Lat', lon='Long', color=view['color'],
+        hover_name=view['hover_name'], hover_data=view['hover_data'], title=view['title'],
+        zoom_level=zoom_level, center_lat=center_lat, center_lon=center_lon,
+        mapbox_style=MAPBOX_STYLE, boundary=boundary, **kwargs,
+    )
+
+
+def view_colors(df, color):
+    """
+    Colour settings that make a subset of df coloured like the whole of it.
+
+    px assigns discrete colours in order of first appearance and scales
+    continuous colours to the data range, so a subset needs both pinned.
+
+    Args:
+        df (pd.DataFrame): The full table.
+        color (str): The colour column, or None.
+
+    Returns:
+        dict: Keyword arguments for px.scatter_mapbox.
+    """
+    if color is None:
+        return {}
+    values = df[color]
+    if pd.api.types.is_numeric_dtype(values):
+        return {'range_color': [values.min(), values.max()]}
+    categories = list(pd.unique(values.dropna()))
+    palette = qualitative.Light24
+    return {
+        'color_discrete_map': {value: palette[i % len(palette)] for i, value in enumerate(categories)},
+        'category_orders': {color: categories},
+    }
+
+
+def build_stop_figures(stops_within, boundary, rasters):
+    center_lat, center_lon = map_center(stops_within)
+
+    # Scatter Map
+    fig = scatter_view('fig', stops_within, center_lat, center_lon, boundary)
+
+    # Heat Map
+    fig_heat = create_density_raster_mapbox(
+        raster=rasters['stops'], opacity=1,
+        title='<br>Winnipeg Public Transport Stops Density',
+        zoom_level=ZOOM_LEVEL, center_lat=center_lat, center_lon=center_lon,
+        mapbox_style=MAPBOX_STYLE, color_continuous_scale="Plasma", boundary=boundary,
+    )
+
+    return {'fig': fig, 'fig_heat': fig_heat}
+
+
+def build_passup_figures(passup_within, aggregates, boundary, rasters, frames=None):
+    import plotly.express as px
+
+    center_lat, center_lon = map_center(passup_within)
+
+    def count_bar(counts, column, title, **kwargs):
+        fig_bar = px.bar(
+            counts,
+            title=title,
+            labels={'Count': 'Pass-up Times'},
+            text='Count',
+            color=column,
+            **kwargs,
+        )
+        fig_bar.update_traces(textposition='outside')
+        return fig_bar
+
+    figures = {
+        'fig_pass': scatter_view('fig_pass', passup_within, center_lat, center_lon, boundary),
+        'fig_passheat': create_density_raster_mapbox(
+            raster=rasters['passups'], opacity=1,
+            title='<br>Winnipeg Public Transport Pass-up Data',
+            zoom_level=ZOOM_LEVEL, center_lat=center_lat, center_lon=center_lon,
+            mapbox_style=MAPBOX_STYLE, color_continuous_scale="Plasma", boundary=boundary,
+        ),
+        'fig_RN': scatter_view('fig_RN', passup_within, center_lat, center_lon, boundary),
+        'fig_YR': scatter_view('fig_YR', passup_within, center_lat, center_lon, boundary),
+        'fig_TR': scatter_view('fig_TR', passup_within, center_lat, center_lon, boundary),
+        'fig_HR': scatter_view('fig_HR', passup_within, center_lat, center_lon, boundary),
+        'fig_TP': scatter_view('fig_TP', passup_within, center_lat, center_lon, boundary),
+    }
+
+    # Animated Heat Maps
+    for period, name, title in (('month', 'fig_passmonth', '<br>Pass-up hotspots in Winnipeg by Month'),
+                                ('hour', 'fig_passhour', '<br>Pass-up hotspots in Winnipeg by Hour of Day')):
+        if frames is not None:
+            figures[name] = create_animated_density_mapbox(
+                frames['arrays']['frames_' + period], frames['meta'][period], radius=15,
+                title=title, zoom_level=ZOOM_LEVEL, center_lat=center_lat, center_lon=center_lon,
+                mapbox_style=MAPBOX_STYLE, color_continuous_scale="Plasma", boundary=boundary,
+            )
+
+    # Spike windows found by spikes.SpikeDetector: their pass-ups on the map, and the count per route
+    spikes = aggregates.get('spikes')
+    if spikes is not None:
+        figures['fig_spikes'] = create_scatter_mapbox(
+            df=spike_passups(passup_within, spikes), lat='Lat', lon='Long', color='Route',
+            hover_name='Pass-Up ID', hover_data=HOVER_PASSUP + ['Time_Period', 'Expected', 'Z'],
+            title='<br>Pass-up spikes in Winnipeg by Route',
+            zoom_level=ZOOM_LEVEL, center_lat=center_lat, center_lon=center_lon,
+            mapbox_style=MAPBOX_STYLE, boundary=boundary,
+        )
+        spike_counts = spikes.groupby(['Route', 'Time_Period']).size().reset_index(name='Count')
+        figures['fig_spikebar'] = px.bar(spike_counts, x='Route', y='Count', color='Time_Period',
+                                         title='Pass-up spikes per Route and Time Period',
+                                         labels={'Count': 'Spike days'})
+
+    # Pass-ups snapped onto the GTFS route shapes, see shapes.py; only built with a feed
+    segments = aggregates.get('corridors')
+    if segments is not None:
+        figures['fig_corridors'] = create_segment_line_mapbox(
+            segments, column='Per km', classes=5,
+            title='<br>Pass-ups per km along the Winnipeg transit routes',
+            zoom_level=ZOOM_LEVEL, center_lat=center_lat, center_lon=center_lon,
+            mapbox_style=MAPBOX_STYLE, color_continuous_scale=sequential.Plasma, boundary=boundary,
+        )
+        worst = segments.nlargest(20, 'Per km').assign(Segment=lambda df: df['Route'] + ' @ ' + (df['Start (m)'] / 1000).round(2).astype(str) + ' km')
+        figures['fig_corridorbar'] = px.bar(worst, x='Per km', y='Segment', color='Route', orientation='h',
+                                            title='Route segments with the most pass-ups per km',
+                                            labels={'Per km': 'Pass-ups per km'})
+
+    figures['fig_RNbar'] = count_bar(aggregates['route_counts'], 'Route Number',
+                                     'Pass-ups per Route Number in the past decade',
+                                     x='Route Number', y='Count')
+    figures['fig_YRbar'] = count_bar(aggregates['year_counts'], 'Year',
+                                     '<br>Pass-up times in Winnipeg by Year',
+                                     x='Year', y='Count')
+    figures['fig_HRbar'] = count_bar(aggregates['hour_counts'], 'Hour',
+                                     '<br>Pass-up times in Winnipeg by Hour',
+                                     x='Hour', y='Count')
+    figures['fig_TRbar'] = count_bar(aggregates['time_counts'], 'Time_Period',
+                                     'Pass-up times in Winnipeg by Time Period',
+                                     y='Time_Period', x='Count', orientation='h',
+                                     color_discrete_sequence=qualitative.Light24)
+    figures['fig_TPbar'] = count_bar(aggregates['type_counts'], 'Pass-Up Type',
+                                     '<br>Pass-up times in Winnipeg per Pass-Up Type',
+                                     y='Pass-Up Type', x='Count', orientation='h',
+                                     color_discrete_sequence=qualitative.Light24)
+    return figures
+
+
+def build_census_figures(census_within, df_census, boundary, rasters):
+    import plotly.express as px
+
+    center_lat, center_lon = map_center(census_within)
+
+    # Scatter Map
+    fig_total = create_scatter_mapbox(
+        df=df_census, lat='Lat', lon='Long', color='Total_15_Density',
+        hover_name='OBJECTID', hover_data=HOVER_CENSUS,
+        title='<br>Total Teenager Density in Winnipeg (2021)',
+        zoom_level=ZOOM_LEVEL, center_lat=center_lat, center_lon=center_lon,
+        mapbox_style=MAPBOX_STYLE, boundary=boundary,
+    )
+
+    # Update marker sizes by limits group
+    fig_total.update_traces(marker={'size': census_within['Marker_Size']})
+
+    # Box chart
+    fig_csbox = px.box(df_census, x=['Total_15_to_19_years', 'Men_15_to_19_years', 'Women_15_to_19_years', "Total_15_Density", "Men_15_Density", "Women_15_Density"],
+                       title="Teenager Density in Winnipeg (2021)", orientation='h')
+    fig_csbox.update_layout(xaxis_type="log")
+
+    # Heat Maps
+    def census_heat(layer, title):
+        return create_density_raster_mapbox(
+            raster=rasters[layer], opacity=1,
+            title=title,
+            zoom_level=ZOOM_LEVEL, center_lat=center_lat, center_lon=center_lon,
+            mapbox_style=MAPBOX_STYLE, color_continuous_scale="Plasma", boundary=boundary,
+        )
+
+    return {
+        'fig_total': fig_total,
+        'fig_csbox': fig_csbox,
+        'fig_totalheat': census_heat('teens_total', '<br>Total Teenager Density in Winnipeg (2021)'),
+        'fig_men': census_heat('teens_men', '<br>Men Teenager Density in Winnipeg (2021)'),
+        'fig_women': census_heat('teens_women', '<br>Women Teenager Density in Winnipeg (2021)'),
+    }
+
+
+def build_figures(tables, aggregates, boundary, rasters, frames=None):
+    """
+    Builds every figure of the dashboard.
+
+    Args:
+        tables (dict): 'stops', 'passups', 'census' and 'census_all' dataframes.
+        aggregates (dict): The count tables from pipeline.compute_aggregates.
+        boundary (list): The administrative boundary trace.
+        rasters (dict): Density raster per heat layer, see create_density_raster_mapbox.
+        frames (dict): 'arrays' and 'meta' of the animation frames, see frames.build_all_frames.
+
+    Returns:
+        dict: plotly figures keyed by name (fig, fig_heat, fig_pass, ...).
+    """
+    figures = {}
+    figures.update(build_stop_figures(tables['stops'], boundary, rasters))
+    figures.update(build_passup_figures(tables['passups'], aggregates, boundary, rasters, frames))
+    figures.update(build_census_figures(tables['census'], tables['census_all'], boundary, rasters))
+    return figures
+
+
+def route_timeseries_figure(matrix, route, freq='W'):
+    """
+    Pass-up history of one route: counts with their rolling mean and spread,
+    the peak-period split, and the seasonal profile.
+
+    Args:
+        matrix (timeseries.RouteDayMatrix): The route x day counts.
+        route (str): A route label, including routes grouped into 'Other' on the maps.
+        freq (str): 'D' for daily or 'W' for weekly counts.
+
+    Returns:
+        plotly.graph_objects.Figure: The plotly figure object.
+    """
+    series = matrix.series(route, freq)
+    by_month, by_weekday = matrix.seasonality(route)
+    step = 'Daily' if freq == 'D' else 'Weekly'
+
+    fig = make_subplots(
+        rows=3, cols=2, specs=[[{'colspan': 2}, None], [{'colspan': 2}, None], [{}, {}]],
+        row_heights=[0.45, 0.3, 0.25], vertical_spacing=0.08,
+        subplot_titles=['%s pass-ups' % step, 'Peak periods', 'Average per day by month', 'Average per day by weekday'],
+    )
+
+    # Counts with the rolling mean and a band of one standard deviation
+    upper = series['Rolling Mean'] + series['Rolling Std']
+    lower = (series['Rolling Mean'] - series['Rolling Std']).clip(lower=0)
+    fig.add_trace(go.Scatter(x=series.index, y=upper, mode='lines', line=dict(width=0), showlegend=False, hoverinfo='skip'), row=1, col=1)
+    fig.add_trace(go.Scatter(x=series.index, y=lower, mode='lines', line=dict(width=0), fill='tonexty',
+                             fillcolor='rgba(99, 110, 250, 0.2)', name='Rolling ± 1 std', hoverinfo='skip'), row=1, col=1)
+    fig.add_trace(go.Scatter(x=series.index, y=series['Count'], mode='lines', line=dict(width=1, color='#b0b0b0'), name='Count'), row=1, col=1)
+    fig.add_trace(go.Scatter(x=series.index, y=series['Rolling Mean'], mode='lines', line=dict(color='#636efa'), name='Rolling Mean'), row=1, col=1)
+
+    # Peak periods (school commute) against the rest of the day
+    for column in PEAK_PERIODS + ['Off-peak']:
+        fig.add_trace(go.Bar(x=series.index, y=series[column], name=column), row=2, col=1)
+
+    fig.add_trace(go.Bar(x=['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'],
+                         y=by_month.reindex(range(1, 13)).fillna(0), showlegend=False, marker_color='#636efa'), row=3, col=1)
+    fig.add_trace(go.Bar(x=['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'],
+                         y=by_weekday.reindex(range(7)).fillna(0), showlegend=False, marker_color='#636efa'), row=3, col=2)
+
+    fig.update_layout(
+        title='Route %s: %d pass-ups' % (route, int(series['Count'].sum())),
+        barmode='stack', height=800, hovermode='x unified',
+        legend=dict(orientation='h', yanchor='bottom', y=1.02, xanchor='right', x=1),
+    )
+    return fig
+
+
+def density_rasters(version, raster_meta, tiled=True, resolution=None, city=None):
+    """
+    Mapbox layer settings of every heat layer.
+
+    Args:
+        version (str): The data version, part of the raster urls.
+        raster_meta (dict): Metadata per layer, see density.build_rasters.
+        tiled (bool): Use the /tiles xyz endpoint, so the map only pulls the
+            visible tiles; otherwise show the bundle's city-wide image.
+        resolution (str): Which of density.RESOLUTIONS to show when not tiled.
+        city (str): The city key, part of the tile urls.
+
+    Returns:
+        dict: Per layer, 'layer' (mapbox layer) and 'cmax' (peak density per km2).
+    """
+    resolution = resolution or DEFAULT_RESOLUTION
+    rasters = {}
+    for layer, meta in raster_meta.items():
+        if tiled:
+            mapbox_layer = dict(sourcetype='raster', source=[tile_url(layer, version, city)])
+        else:
+            mapbox_layer = dict(sourcetype='image', source=density_url(version, layer, resolution),
+                                coordinates=meta['coordinates'])
+        rasters[layer] = {'layer': mapbox_layer, 'cmax': meta['peaks_per_km2'][DEFAULT_RESOLUTION]}
+    return rasters
+
+
+def density_url(version, layer, resolution):
+    return '/density/%s/%s/%s.png' % (version, layer, resolution)
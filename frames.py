@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Per-period grid aggregates of the pass-ups, the frames of the animated maps.
+
+Every pass-up gets a grid cell and a period index, and all frames come out of
+a single np.bincount over (period, cell), so a frame is a small array of
+counts per cell instead of a subset of the raw points.
+"""
+
+import numpy as np
+
+# Cells across the city box; rows follow from the box's aspect ratio
+GRID_COLUMNS = 80
+
+PERIODS = ('month', 'hour')
+
+
+def frame_grid(bounds, columns=GRID_COLUMNS):
+    """
+    The aggregation grid over a lat/lon box.
+
+    Args:
+        bounds (tuple): (west, south, east, north).
+        columns (int): Number of cells across.
+
+    Returns:
+        dict: 'bounds', 'shape' (rows, columns) and the cell centre
+        coordinates 'lat' and 'lon' (flattened, row-major from the north).
+    """
+    west, south, east, north = bounds
+    mid_lat = np.radians((south + north) / 2)
+    rows = max(1, int(round(columns * (north - south) / ((east - west) * np.cos(mid_lat)))))
+    lat = north - (np.arange(rows) + 0.5) * (north - south) / rows
+    lon = west + (np.arange(columns) + 0.5) * (east - west) / columns
+    lat_grid, lon_grid = np.meshgrid(lat, lon, indexing='ij')
+    return {'bounds': list(bounds), 'shape': [rows, columns],
+            'lat': lat_grid.ravel(), 'lon': lon_grid.ravel()}
+
+
+def cell_index(lat, lon, grid):
+    # Flat cell of every point; -1 outside the grid
+    west, south, east, north = grid['bounds']
+    rows, columns = grid['shape']
+    row = np.floor((north - np.asarray(lat, dtype=float)) / (north - south) * rows)
+    col = np.floor((np.asarray(lon, dtype=float) - west) / (east - west) * columns)
+    inside = (row >= 0) & (row < rows) & (col >= 0) & (col < columns)
+    return np.where(inside, row * columns + col, -1).astype(np.int64)
+
+
+def period_index(times, period):
+    """
+    Period number and labels of every timestamp.
+
+    Args:
+        times (pd.Series): Datetimes, NaT allowed.
+        period (str): 'month' (every calendar month between the first and the
+            last pass-up) or 'hour' (hour of day).
+
+    Returns:
+        tuple: (int array, -1 for NaT; list of period labels).
+    """
+    valid = times.notna().to_numpy()
+    if period == 'hour':
+        index = np.where(valid, times.dt.hour.fillna(0).to_numpy(dtype=np.int64), -1)
+        return index, ['%02d:00' % hour for hour in range(24)]
+    months = (times.dt.year * 12 + times.dt.month - 1).to_numpy(dtype=float)
+    if not valid.any():
+        return np.full(len(times), -1, dtype=np.int64), []
+    first, last = int(np.nanmin(months)), int(np.nanmax(months))
+    index = np.where(valid, np.nan_to_num(months - first), -1).astype(np.int64)
+    labels = ['%d-%02d' % (month // 12, month % 12 + 1) for month in range(first, last + 1)]
+    return index, labels
+
+
+def build_frames(passup_within, bounds, period):
+    """
+    Counts per period and grid cell, in one vectorized pass.
+
+    Args:
+        passup_within (pd.DataFrame): The cleaned pass-ups within the city.
+        bounds (tuple): (west, south, east, north) of the grid.
+        period (str): One of PERIODS.
+
+    Returns:
+        tuple: (uint32 array of shape (periods, cells), metadata dict with
+        'labels' and the grid 'bounds' and 'shape').
+    """
+    grid = frame_grid(bounds)
+    cells = grid['shape'][0] * grid['shape'][1]
+    cell = cell_index(passup_within['Lat'], passup_within['Long'], grid)
+    periods, labels = period_index(passup_within['Time'], period)
+    keep = (cell >= 0) & (periods >= 0)
+    counts = np.bincount(periods[keep] * cells + cell[keep], minlength=len(labels) * cells)
+    frames = counts.reshape(len(labels), cells).astype(np.uint32)
+    return frames, {'labels': labels, 'bounds': grid['bounds'], 'shape': grid['shape']}
+
+
+def build_all_frames(passup_within, bounds):
+    """Frames for every period kind: arrays keyed 'frames_<period>' and their metadata."""
+    arrays, meta = {}, {}
+    for period in PERIODS:
+        arrays['frames_' + period], meta[period] = build_frames(passup_within, bounds, period)
+    return arrays, meta
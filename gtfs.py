@@ -0,0 +1,498 @@
+# -*- coding: utf-8 -*-
+"""
+Scheduled service from a GTFS feed, and pass-ups per 100 scheduled trips.
+
+stop_times.txt of a city feed runs to millions of rows, so it is never
+loaded whole. It is read in chunks of the four columns needed, with the
+trip and stop ids parsed straight into categoricals of trips.txt and
+stops.txt, and every chunk is reduced with np.unique to departure counts
+per (stop, route, hour, service) cell before the next one is read. Memory
+is bounded by the chunk size and the number of served cells, never by the
+length of the feed.
+
+The services are resolved against calendar.txt and calendar_dates.txt for
+one reference week, giving scheduled departures per day for every stop,
+route, hour and weekday. Pass-ups carry no stop id, so each is snapped to
+the nearest stop its route serves, counted into the same cells and divided
+by the trips scheduled over the days of the pass-up history:
+
+    python gtfs.py --feed data/google_transit.zip
+"""
+
+import argparse
+import datetime
+import hashlib
+import os
+import resource
+import time
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+import artifacts
+from timeseries import day_numbers
+
+# Rows of stop_times.txt per chunk
+CHUNK_ROWS = 500000
+
+# Scheduled times run past midnight (e.g. 25:10:00) for trips of the previous service day
+SERVICE_HOURS = 48
+
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+# Files whose content goes into Feed.digest; shapes.txt is read by shapes.corridor_counts
+DIGEST_FILES = {'stops.txt', 'routes.txt', 'trips.txt', 'stop_times.txt', 'calendar.txt', 'calendar_dates.txt', 'shapes.txt'}
+
+# Pass-ups farther than this from every stop of their route are left unmatched
+MAX_SNAP_METERS = 400
+
+RATE_COLUMNS = ['Departures', 'Trips', 'Pass-Ups', 'Pass-Ups per 100 Trips']
+
+
+class Feed:
+    """
+    A GTFS feed in a directory or a zip file.
+
+    Args:
+        path (str): The feed directory or zip.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.zip = None if os.path.isdir(path) else zipfile.ZipFile(path)
+
+    def names(self):
+        if self.zip is None:
+            return set(os.listdir(self.path))
+        # Some feeds nest their files in a folder inside the zip
+        return {os.path.basename(name) for name in self.zip.namelist()}
+
+    def open(self, name):
+        if self.zip is None:
+            return open(os.path.join(self.path, name), 'rb')
+        member = next(member for member in self.zip.namelist() if os.path.basename(member) == name)
+        return self.zip.open(member)
+
+    def read(self, name, **kwargs):
+        with self.open(name) as f:
+            return pd.read_csv(f, skipinitialspace=True, **kwargs)
+
+    def digest(self):
+        """Content hash of the files the loaders read (those of DIGEST_FILES present), for artifacts.data_version."""
+        sha = hashlib.sha1()
+        for name in sorted(self.names() & DIGEST_FILES):
+            sha.update(name.encode())
+            with self.open(name) as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(block)
+        return sha.digest()
+
+
+def feed_stops(feed):
+    """
+    The stops of the feed with 'stop_id' (str), 'Lat' and 'Long'.
+
+    The repo's own data/stops.txt has its coordinates renamed to Lat/Long;
+    both spellings are accepted.
+    """
+    stops = feed.read('stops.txt', dtype={'stop_id': str})
+    stops = stops.rename(columns={'stop_lat': 'Lat', 'stop_lon': 'Long'})
+    return stops.drop_duplicates('stop_id').reset_index(drop=True)
+
+
+def route_labels(routes):
+    # The label pass-ups use for a route: its short name, else its id
+    short = routes['route_short_name'] if 'route_short_name' in routes else pd.Series(pd.NA, index=routes.index)
+    return short.astype('string').str.strip().replace('', pd.NA).fillna(routes['route_id'].astype(str))
+
+
+def week_services(feed, services, reference=None):
+    """
+    The weekdays each service runs on in one reference week.
+
+    Args:
+        feed (Feed): The feed.
+        services (list): service_id of every trip service, in code order.
+        reference (datetime.date): A day of the week to use; defaults to the
+            latest start_date of calendar.txt, or the first date of
+            calendar_dates.txt for feeds without one.
+
+    Returns:
+        tuple: (bool np.ndarray of shape (services, 7), Monday first, and
+        the Monday of the reference week).
+    """
+    names = feed.names()
+    calendar = feed.read('calendar.txt', dtype={'service_id': str}) if 'calendar.txt' in names else None
+    exceptions = feed.read('calendar_dates.txt', dtype={'service_id': str}) if 'calendar_dates.txt' in names else None
+    if reference is None:
+        if calendar is not None and len(calendar):
+            reference = pd.to_datetime(calendar['start_date'].astype(str), format='%Y%m%d').max().date()
+        elif exceptions is not None and len(exceptions):
+            reference = pd.to_datetime(exceptions['date'].astype(str), format='%Y%m%d').min().date()
+        else:
+            reference = datetime.date.today()
+    monday = reference - datetime.timedelta(days=reference.weekday())
+    days = [monday + datetime.timedelta(days=offset) for offset in range(7)]
+
+    index = {service: code for code, service in enumerate(services)}
+    mask = np.zeros((len(services), 7), dtype=bool)
+    if calendar is not None:
+        calendar = calendar[calendar['service_id'].isin(index)]
+        rows = calendar['service_id'].map(index).to_numpy()
+        start = pd.to_datetime(calendar['start_date'].astype(str), format='%Y%m%d').dt.date.to_numpy()
+        end = pd.to_datetime(calendar['end_date'].astype(str), format='%Y%m%d').dt.date.to_numpy()
+        for weekday, day in enumerate(days):
+            running = (calendar[WEEKDAYS[weekday]].to_numpy() == 1) & (start <= day) & (day <= end)
+            mask[rows[running], weekday] = True
+    if exceptions is not None:
+        exceptions = exceptions[exceptions['service_id'].isin(index)]
+        dates = pd.to_datetime(exceptions['date'].astype(str), format='%Y%m%d').dt.date
+        for weekday, day in enumerate(days):
+            today = exceptions[(dates == day).to_numpy()]
+            rows = today['service_id'].map(index).to_numpy()
+            # exception_type 1 adds the service on that date, 2 removes it
+            mask[rows[today['exception_type'].to_numpy() == 1], weekday] = True
+            mask[rows[today['exception_type'].to_numpy() == 2], weekday] = False
+    return mask, monday
+
+
+def departure_hours(times):
+    # 'H:MM:SS' or 'HH:MM:SS' to the hour, NaN for the empty times of non-timepoint stops
+    return pd.to_numeric(times.astype('string').str.strip().str.slice(stop=-6), errors='coerce')
+
+
+def reduce_cells(keys, counts):
+    # Sums the counts of equal keys
+    cells, inverse = np.unique(keys, return_inverse=True)
+    return cells, np.bincount(inverse, weights=counts, minlength=len(cells)).astype(np.int64)
+
+
+def week_cells(mask, services, service_hours):
+    """
+    Spreads cells of a service over the weekdays it runs on.
+
+    Times past 24:00 fall on the next weekday.
+
+    Returns:
+        tuple: (positions into the input cells, weekday, hour), one entry per
+        running (cell, weekday).
+    """
+    day_shift, hours = np.divmod(service_hours, 24)
+    positions, weekdays = np.nonzero(mask[services])
+    return positions, (weekdays + day_shift[positions]) % 7, hours[positions]
+
+
+def window_days(days):
+    # Number of each weekday (Monday = 0) between the first and last day
+    if not len(days):
+        return np.zeros(7, dtype=np.int64)
+    return np.bincount((np.arange(days.min(), days.max() + 1) + 3) % 7, minlength=7)  # 1970-01-01 was a Thursday
+
+
+class ScheduledService:
+    """
+    Scheduled service per day of every stop, route, weekday and hour.
+
+    Only served cells are kept, as sorted arrays of linear cell keys and
+    counts; see stop_key and route_key for the layouts.
+
+    Attributes:
+        stops (pd.DataFrame): The stops of the feed, one per stop code.
+        routes (list): Route labels, one per route code.
+        stop_keys, departures (np.ndarray): Departures per day of every
+            (stop, route, weekday, hour) cell.
+        route_keys, trips (np.ndarray): Trips in service per day of every
+            (route, weekday, hour) cell; a trip counts in every hour from its
+            first to its last stop time.
+        week (datetime.date): The Monday of the reference week.
+        stats (dict): Rows read, rows skipped, cells and load time.
+    """
+
+    def __init__(self, stops, routes, stop_keys, departures, route_keys, trips, week, stats=None):
+        self.stops = stops
+        self.routes = list(routes)
+        self.route_index = {route: code for code, route in enumerate(self.routes)}
+        self.stop_keys = stop_keys
+        self.departures = departures
+        self.route_keys = route_keys
+        self.trips = trips
+        self.week = week
+        self.stats = stats or {}
+
+    def route_key(self, route, weekday, hour):
+        return (np.asarray(route, dtype=np.int64) * 7 + weekday) * 24 + hour
+
+    def stop_key(self, stop, route, weekday, hour):
+        return np.asarray(stop, dtype=np.int64) * len(self.routes) * 168 + self.route_key(route, weekday, hour)
+
+    def decode(self, keys):
+        """(stop, route, weekday, hour) codes of stop cell keys; stop is 0 for route keys."""
+        rest, hour = np.divmod(keys, 24)
+        rest, weekday = np.divmod(rest, 7)
+        stop, route = np.divmod(rest, len(self.routes))
+        return stop, route, weekday, hour
+
+    @classmethod
+    def from_feed(cls, feed, reference=None, chunk_rows=CHUNK_ROWS):
+        """
+        Streams stop_times.txt of a feed into departure and trip counts.
+
+        Args:
+            feed (Feed or str): The feed, or the path of its directory or zip.
+            reference (datetime.date): A day of the reference week, see week_services.
+            chunk_rows (int): Rows of stop_times.txt per chunk.
+
+        Returns:
+            ScheduledService: The service of the reference week.
+        """
+        feed = feed if isinstance(feed, Feed) else Feed(feed)
+        start = time.perf_counter()
+
+        # Small tables first: every trip gets a route and a service code
+        stops = feed_stops(feed)
+        routes = feed.read('routes.txt', dtype={'route_id': str, 'route_short_name': str})
+        route_codes, route_names = pd.factorize(route_labels(routes))
+        route_of = dict(zip(routes['route_id'], route_codes))
+        trips = feed.read('trips.txt', usecols=['route_id', 'service_id', 'trip_id'], dtype=str)
+        trips = trips.drop_duplicates('trip_id').reset_index(drop=True)
+        trip_route = trips['route_id'].map(route_of).fillna(-1).to_numpy(dtype=np.int64)
+        trip_service, services = pd.factorize(trips['service_id'])
+        # First and last service hour of every trip, over all chunks
+        trip_first = np.full(len(trips), SERVICE_HOURS, dtype=np.int64)
+        trip_last = np.full(len(trips), -1, dtype=np.int64)
+
+        # Departures per (stop, route, service hour, service), one chunk at a time
+        n_routes, n_services = len(route_names), len(services)
+        keys, counts = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        stats = {'rows': 0, 'skipped': 0, 'chunks': 0}
+        dtype = {'trip_id': pd.CategoricalDtype(trips['trip_id']), 'stop_id': pd.CategoricalDtype(stops['stop_id']),
+                 'arrival_time': str, 'departure_time': str}
+        with feed.open('stop_times.txt') as f:
+            for chunk in pd.read_csv(f, usecols=list(dtype), dtype=dtype, skipinitialspace=True, chunksize=chunk_rows):
+                trip = chunk['trip_id'].cat.codes.to_numpy(dtype=np.int64)
+                stop = chunk['stop_id'].cat.codes.to_numpy(dtype=np.int64)
+                hour = departure_hours(chunk['departure_time'].fillna(chunk['arrival_time'])).to_numpy(dtype=float, na_value=np.nan)
+                keep = (trip >= 0) & (stop >= 0) & (hour < SERVICE_HOURS)
+                keep[keep] = trip_route[trip[keep]] >= 0
+                trip, stop, hour = trip[keep], stop[keep], hour[keep].astype(np.int64)
+                np.minimum.at(trip_first, trip, hour)
+                np.maximum.at(trip_last, trip, hour)
+                chunk_keys = ((stop * n_routes + trip_route[trip]) * SERVICE_HOURS + hour) * n_services + trip_service[trip]
+                cells, added = np.unique(chunk_keys, return_counts=True)
+                keys, counts = reduce_cells(np.concatenate([keys, cells]), np.concatenate([counts, added]))
+                stats['rows'] += len(chunk)
+                stats['skipped'] += int((~keep).sum())
+                stats['chunks'] += 1
+
+        mask, monday = week_services(feed, list(services), reference)
+        service = cls(stops, list(route_names), None, None, None, None, monday, stats)
+
+        # Departures: spread every service's cells over the weekdays it runs on
+        rest, cell_service = np.divmod(keys, n_services)
+        rest, cell_hour = np.divmod(rest, SERVICE_HOURS)
+        cell_stop, cell_route = np.divmod(rest, n_routes)
+        positions, weekday, hour = week_cells(mask, cell_service, cell_hour)
+        service.stop_keys, service.departures = reduce_cells(
+            service.stop_key(cell_stop[positions], cell_route[positions], weekday, hour), counts[positions])
+
+        # Trips in service: one count in every hour a trip spans
+        ran = np.nonzero(trip_last >= 0)[0]
+        spans = trip_last[ran] - trip_first[ran] + 1
+        trip = np.repeat(ran, spans)
+        trip_hour = trip_first[trip] + np.arange(len(trip)) - np.repeat(np.cumsum(spans) - spans, spans)
+        positions, weekday, hour = week_cells(mask, trip_service[trip], trip_hour)
+        service.route_keys, service.trips = reduce_cells(
+            service.route_key(trip_route[trip[positions]], weekday, hour), np.ones(len(positions)))
+
+        stats['cells'] = len(service.stop_keys)
+        stats['seconds'] = time.perf_counter() - start
+        return service
+
+    def stop_frame(self):
+        """Departures as a dataframe with stop_id, Route, Weekday, Hour and Departures."""
+        stop, route, weekday, hour = self.decode(self.stop_keys)
+        return pd.DataFrame({'stop_id': self.stops['stop_id'].to_numpy()[stop],
+                             'Route': np.asarray(self.routes, dtype=object)[route],
+                             'Weekday': weekday, 'Hour': hour, 'Departures': self.departures})
+
+    def route_frame(self):
+        """Trips in service as a dataframe with Route, Weekday, Hour and Departures."""
+        _, route, weekday, hour = self.decode(self.route_keys)
+        return pd.DataFrame({'Route': np.asarray(self.routes, dtype=object)[route],
+                             'Weekday': weekday, 'Hour': hour, 'Departures': self.trips})
+
+    def route_stops(self):
+        """Stop codes served by every route code."""
+        stop, route, _, _ = self.decode(self.stop_keys)
+        pairs = np.unique(route * len(self.stops) + stop)
+        route_codes, stop_codes = np.divmod(pairs, len(self.stops))
+        bounds = np.searchsorted(route_codes, np.arange(len(self.routes) + 1))
+        return [stop_codes[bounds[code]:bounds[code + 1]] for code in range(len(self.routes))]
+
+
+def snap_to_stops(passups, service, routes, max_meters=MAX_SNAP_METERS):
+    """
+    The nearest stop served by each pass-up's route.
+
+    Args:
+        passups (pd.DataFrame): Pass-ups with 'Lat' and 'Long'.
+        service (ScheduledService): The scheduled service.
+        routes (np.ndarray): Route code of every pass-up, -1 for routes not in the feed.
+        max_meters (float): Farthest snap distance.
+
+    Returns:
+        np.ndarray: Stop codes, -1 where unmatched.
+    """
+    lat, lon = passups['Lat'].to_numpy(dtype=float), passups['Long'].to_numpy(dtype=float)
+    stop_lat, stop_lon = service.stops['Lat'].to_numpy(dtype=float), service.stops['Long'].to_numpy(dtype=float)
+    # Equirectangular metres are close enough at city scale
+    scale = np.cos(np.radians(np.nanmean(stop_lat))) if len(stop_lat) else 1.0
+
+    stops = np.full(len(passups), -1, dtype=np.int64)
+    served = service.route_stops()
+    for code in np.unique(routes[routes >= 0]):
+        candidates = served[code]
+        if not len(candidates):
+            continue
+        rows = np.nonzero(routes == code)[0]
+        ys, xs = stop_lat[candidates], stop_lon[candidates] * scale
+        # Blocks of rows, so the rows x stops distance arrays stay small
+        for start in range(0, len(rows), 2000):
+            block = rows[start:start + 2000]
+            d2 = (lat[block, None] - ys) ** 2 + (lon[block, None] * scale - xs) ** 2
+            nearest = d2.argmin(axis=1)
+            close = np.sqrt(d2[np.arange(len(block)), nearest]) * 111320.0 <= max_meters
+            stops[block[close]] = candidates[nearest[close]]
+    return stops
+
+
+def count_cells(keys, cell_keys):
+    # Counts keys into the sorted cell_keys; returns the counts and how many keys had no cell
+    cells, counts = np.unique(keys, return_counts=True)
+    position = np.searchsorted(cell_keys, cells).clip(max=max(len(cell_keys) - 1, 0))
+    found = cell_keys[position] == cells if len(cell_keys) else np.zeros(len(cells), dtype=bool)
+    per_cell = np.zeros(len(cell_keys), dtype=np.int64)
+    per_cell[position[found]] = counts[found]
+    return per_cell, int(counts[~found].sum())
+
+
+def passup_rates(passups, service, level='route', route_column='Route', start=None, end=None):
+    """
+    Pass-ups per 100 scheduled trips of every served cell.
+
+    The reference week's schedule is assumed to run on every day between
+    the first and last pass-up (or start and end), so 'Trips' is the daily
+    count times the number of such weekdays in that window. At the 'route'
+    level a trip counts once in every hour it is in service; at the 'stop'
+    level every departure from the stop is a trip, and pass-ups are first
+    snapped to the nearest stop of their route.
+
+    Args:
+        passups (pd.DataFrame): The cleaned pass-ups, with route_column,
+            'Time' and 'Hour' (and 'Lat' and 'Long' for the stop level).
+        service (ScheduledService): The scheduled service.
+        level (str): 'route' for (Route, Weekday, Hour) cells or 'stop' for
+            (stop_id, Route, Weekday, Hour) cells.
+        route_column (str): Column with the ungrouped route labels.
+        start, end (str or pd.Timestamp): The window of pass-ups to count.
+
+    Returns:
+        tuple: (pd.DataFrame with the cell columns and RATE_COLUMNS; dict of match statistics).
+    """
+    days = day_numbers(passups['Time'])
+    keep = days >= 0
+    if start is not None:
+        keep &= days >= day_numbers([start])[0]
+    if end is not None:
+        keep &= days <= day_numbers([end])[0]
+    passups, days = passups[keep], days[keep]
+
+    routes = passups[route_column].astype('string').map(service.route_index).fillna(-1).to_numpy(dtype=np.int64)
+    weekdays = (days + 3) % 7
+    hours = passups['Hour'].to_numpy(dtype=np.int64)
+    stats = {'passups': len(passups), 'unknown_route': int((routes < 0).sum()), 'too_far': 0}
+    if level == 'stop':
+        stops = snap_to_stops(passups, service, routes)
+        stats['too_far'] = int(((routes >= 0) & (stops < 0)).sum())
+        matched = stops >= 0
+        keys = service.stop_key(stops[matched], routes[matched], weekdays[matched], hours[matched])
+        rates, cell_keys = service.stop_frame(), service.stop_keys
+    else:
+        matched = routes >= 0
+        keys = service.route_key(routes[matched], weekdays[matched], hours[matched])
+        rates, cell_keys = service.route_frame(), service.route_keys
+    passup_counts, stats['unscheduled'] = count_cells(keys, cell_keys)
+    stats['counted'] = int(passup_counts.sum())
+
+    rates['Trips'] = rates['Departures'] * window_days(days)[rates['Weekday'].to_numpy()]
+    rates['Pass-Ups'] = passup_counts
+    rates['Pass-Ups per 100 Trips'] = per_100(rates['Pass-Ups'], rates['Trips'])
+    return rates, stats
+
+
+def per_100(passups, trips):
+    return (100 * passups / trips.where(trips > 0)).round(3)
+
+
+def rate_summary(rates, by):
+    """
+    Pass-ups per 100 scheduled trips, summed over everything but the columns in by.
+
+    Args:
+        rates (pd.DataFrame): The cell rates, see passup_rates.
+        by (list): Grouping columns, e.g. ['Route'] or ['Route', 'Hour'].
+
+    Returns:
+        pd.DataFrame: by, 'Trips', 'Pass-Ups' and 'Pass-Ups per 100 Trips', highest rate first.
+    """
+    summary = rates.groupby(by, as_index=False)[['Trips', 'Pass-Ups']].sum()
+    summary['Pass-Ups per 100 Trips'] = per_100(summary['Pass-Ups'], summary['Trips'])
+    return summary.sort_values('Pass-Ups per 100 Trips', ascending=False, ignore_index=True)
+
+
+def service_aggregates(passups, feed, reference=None):
+    """
+    The bundle aggregates of a feed, for build.py.
+
+    Returns:
+        tuple: ({'route_hour_rates', 'stop_rates'} dataframes, manifest entry).
+    """
+    service = ScheduledService.from_feed(feed, reference)
+    route_rates, route_stats = passup_rates(passups, service, 'route')
+    stop_rates, stop_stats = passup_rates(passups, service, 'stop')
+    stop_rates = rate_summary(stop_rates, ['stop_id']).merge(service.stops[['stop_id', 'Lat', 'Long']], on='stop_id')
+    aggregates = {'route_hour_rates': rate_summary(route_rates, ['Route', 'Hour']), 'stop_rates': stop_rates}
+    meta = {'week': service.week.isoformat(), 'load': service.stats, 'route_match': route_stats, 'stop_match': stop_stats}
+    return aggregates, meta
+
+
+def peak_memory_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pass-ups per 100 scheduled trips from a GTFS feed and the current bundle.')
+    parser.add_argument('--feed', required=True, help='GTFS feed directory or zip')
+    parser.add_argument('--week', help='a date (YYYY-MM-DD) in the reference week of the schedule')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help='rows of stop_times.txt per chunk')
+    parser.add_argument('--by', default='Route', help='comma separated grouping columns (stop_id, Route, Weekday, Hour)')
+    parser.add_argument('--top', type=int, default=20, help='number of rows to print')
+    args = parser.parse_args(argv)
+
+    reference = datetime.date.fromisoformat(args.week) if args.week else None
+    service = ScheduledService.from_feed(args.feed, reference, args.chunk_rows)
+    stats = service.stats
+    print("Read %d stop times in %d chunks (%d skipped) in %.2fs: %d served cells, week of %s, peak memory %.0f MB" % (
+        stats['rows'], stats['chunks'], stats['skipped'], stats['seconds'], stats['cells'], service.week, peak_memory_mb()))
+
+    by = args.by.split(',')
+    rates, match = passup_rates(artifacts.load_bundle().table('passups'), service, 'stop' if 'stop_id' in by else 'route')
+    print("Counted %(counted)d of %(passups)d pass-ups (%(unknown_route)d on routes not in the feed, "
+          "%(too_far)d too far from a stop, %(unscheduled)d outside scheduled service)" % match)
+    print(rate_summary(rates, by).head(args.top).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
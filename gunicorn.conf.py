@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn settings of the web app, read by `gunicorn app:server` from this directory.
+
+The app is preloaded: the master imports app.py once and writes the Arrow
+files of every city's tables (artifacts.Bundle.prepare) before it forks the
+workers. Workers then share the master's imported modules copy-on-write and
+memory-map the tables read-only, so each extra worker adds its own Python
+objects and caches but not another copy of the data:
+
+    gunicorn app:server
+    WEB_CONCURRENCY=8 gunicorn app:server
+"""
+
+import os
+
+import artifacts
+from cities import load_cities
+
+bind = '0.0.0.0:%s' % os.environ.get('PORT', 8050)
+workers = int(os.environ.get('WEB_CONCURRENCY', 4))
+threads = int(os.environ.get('WTC_WORKER_THREADS', 4))
+preload_app = True
+
+
+def on_starting(server):
+    # Once, before any worker exists, so workers never race to write the same files
+    for entry in load_cities().values():
+        bundle = artifacts.load_bundle(root=entry['root'])
+        if bundle is not None:
+            bundle.prepare()
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+Live pass-up ingestion.
+
+New pass-ups are POSTed to the web app as JSON lines, one record per line
+with the columns of the pass-up csv:
+
+    {"Pass-Up ID": 1, "Pass-Up Type": "Full Bus Pass-Up", "Time": "2024-05-01T08:10:00",
+     "Route Number": 16, "Route Name": "...", "Lat": 49.84, "Long": -97.16}
+
+Times are local, like those of the csv; a time with a zone or UTC offset
+(e.g. "2024-05-01T13:10:00Z") is rejected rather than guessed into the
+city's day and hour. Records are validated, filtered to the city boundary and logged
+with running count deltas per aggregate. Every record gets a sequence
+number, so a dashboard can ask for just the records and counts that changed
+since the last number it has seen. Under gunicorn the log is kept in the
+shared cache's SQLite file (see shared_cache.SharedLiveLog), so every worker
+process serves the same records, counts and sequence numbers.
+"""
+
+import collections
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from timeseries import PERIODS, period_codes
+
+REQUIRED_FIELDS = ['Pass-Up ID', 'Pass-Up Type', 'Time', 'Route Number', 'Lat', 'Long']
+OPTIONAL_FIELDS = ['Route Name', 'Route Destination', 'Location']
+# Pass-Up Type labels of Winnipeg's export; other agencies' are set per city, see cities.py
+PASSUP_TYPES = ['Full Bus Pass-Up', 'Wheelchair User Pass-Up']
+
+# Records kept for dashboards to catch up on
+LIVE_BUFFER_SIZE = int(os.environ.get('WTC_LIVE_BUFFER', 10000))
+# Largest request body accepted by the ingestion endpoint
+MAX_INGEST_BYTES = int(os.environ.get('WTC_MAX_INGEST_MB', 8)) * 1024 * 1024
+
+# Aggregate tables of pipeline.compute_aggregates and the column each one counts
+AGGREGATE_COLUMNS = {
+    'route_counts': 'Route Number',
+    'year_counts': 'Year',
+    'hour_counts': 'Hour',
+    'time_counts': 'Time_Period',
+    'type_counts': 'Pass-Up Type',
+}
+
+# A time ending in a zone or UTC offset: Z, UTC, +05, -05:00, +0530
+ZONED_TIME = r'\d:\d{2}(?:\.\d+)?\s*(?:[zZ]|UTC|[+-]\d{2}(?::?\d{2})?)$'
+
+
+def points_in_boundary(lat, lon, boundary):
+    """
+    Even-odd point in polygon test against the boundary trace.
+
+    Like the trace itself this only knows the exterior rings, so points in a
+    hole of the city polygon count as inside.
+
+    Args:
+        lat (np.ndarray): Latitudes.
+        lon (np.ndarray): Longitudes.
+        boundary (list): The administrative boundary trace, see pipeline.boundary_trace.
+
+    Returns:
+        np.ndarray: Boolean array, True for points inside.
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    inside = np.zeros(len(lat), dtype=bool)
+    for ring in boundary:
+        ys, xs = np.asarray(ring['lat']), np.asarray(ring['lon'])
+        y0, x0, y1, x1 = ys, xs, np.roll(ys, 1), np.roll(xs, 1)
+        # Blocks of points, so the points x edges arrays stay small
+        for start in range(0, len(lat), 1000):
+            py, px = lat[start:start + 1000, None], lon[start:start + 1000, None]
+            # Edges crossing the horizontal line through each point, right of the point
+            crosses = (y0 > py) != (y1 > py)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x_cross = x0 + (py - y0) * (x1 - x0) / (y1 - y0)
+            inside[start:start + 1000] ^= (crosses & (px < x_cross)).sum(axis=1) % 2 == 1
+    return inside
+
+
+def parse_lines(body):
+    """
+    Splits a JSON lines body into records.
+
+    Returns:
+        tuple: (list of record dicts, list of {'line', 'reason'} rejections).
+    """
+    records, rejected = [], []
+    for number, line in enumerate(body.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            rejected.append({'line': number, 'reason': 'invalid json'})
+            continue
+        if not isinstance(record, dict):
+            rejected.append({'line': number, 'reason': 'not an object'})
+            continue
+        missing = [field for field in REQUIRED_FIELDS if record.get(field) in (None, '')]
+        if missing:
+            rejected.append({'line': number, 'reason': 'missing ' + ', '.join(missing)})
+            continue
+        record['_line'] = number
+        records.append(record)
+    return records, rejected
+
+
+def enrich(records, route_labels, passup_types=PASSUP_TYPES):
+    """
+    Cleans the records like pipeline.validate_passups and pipeline.add_time_columns.
+
+    Args:
+        records (list): Parsed records, see parse_lines.
+        route_labels (set): Route Number labels shown on the dashboard; other
+            routes are counted as 'Other', like pipeline.group_rare_routes.
+        passup_types (list): The Pass-Up Type labels of the city's agency.
+
+    Returns:
+        tuple: (pd.DataFrame of valid pass-ups, list of rejections).
+    """
+    df = pd.DataFrame(records, columns=REQUIRED_FIELDS + OPTIONAL_FIELDS + ['_line'])
+    df['Lat'] = pd.to_numeric(df['Lat'], errors='coerce')
+    df['Long'] = pd.to_numeric(df['Long'], errors='coerce')
+    # Zoned times can't be mixed with local ones in one parse, and are rejected anyway
+    times = df['Time'].astype(str)
+    df['Time'] = pd.to_datetime(times.mask(times.str.contains(ZONED_TIME)), format='mixed', errors='coerce')
+
+    # The rules of pipeline.validate_passups; the route is checked by parse_lines
+    reasons = pd.Series('', index=df.index)
+    reasons[~df['Pass-Up Type'].isin(passup_types)] = 'unknown pass-up type'
+    reasons[df['Time'].isna()] = 'invalid time'
+    reasons[df['Lat'].isna() | df['Long'].isna() | (df['Lat'] == 0) | (df['Long'] == 0)
+            | (df['Lat'].abs() > 90) | (df['Long'].abs() > 180)] = 'invalid coordinates'
+    bad = reasons != ''
+    rejected = [{'line': int(line), 'reason': reason} for line, reason in zip(df.loc[bad, '_line'], reasons[bad])]
+
+    df = df[~bad].copy()
+    df['Year'] = df['Time'].dt.year
+    df['Date'] = df['Time'].dt.date
+    df['Hour'] = df['Time'].dt.hour
+    df['Time_Period'] = np.asarray(PERIODS)[period_codes(df['Hour'])]
+    df['Route'] = df['Route Number'].map(category_key)
+    df['Route Number'] = df['Route'].where(df['Route'].isin(route_labels), 'Other')
+    return df, rejected
+
+
+class LiveLog:
+    """
+    The live pass-ups of one city in this process's memory.
+
+    The web app uses shared_cache.SharedLiveLog instead, which has the same
+    methods and keeps the log in a file every worker process reads.
+
+    Args:
+        size (int): Most records kept; the counts include the dropped ones.
+    """
+
+    def __init__(self, size=LIVE_BUFFER_SIZE):
+        self.rows = collections.deque(maxlen=size)
+        self.seq = 0
+        self.pruned = 0
+        self.totals = {name: collections.Counter() for name in AGGREGATE_COLUMNS}
+        self.lock = threading.Lock()
+
+    def append(self, records, counts):
+        """Logs records under the next sequence numbers and adds counts ({aggregate: Counter}) to the totals."""
+        with self.lock:
+            for record in records:
+                self.seq += 1
+                if len(self.rows) == self.rows.maxlen:
+                    self.pruned = self.rows[0][0]
+                self.rows.append((self.seq, record))
+            for name, counter in counts.items():
+                self.totals[name].update(counter)
+
+    def read(self, after):
+        """
+        Records logged after sequence number after.
+
+        Returns:
+            tuple: (list of (seq, record) in order, the last sequence number dropped from the log).
+        """
+        with self.lock:
+            rows = []
+            for seq, record in reversed(self.rows):
+                if seq <= after:
+                    break
+                rows.append((seq, record))
+            return rows[::-1], self.pruned
+
+    def counts(self, aggregate):
+        """Logged pass-ups per category_key of an aggregate."""
+        with self.lock:
+            return dict(self.totals[aggregate])
+
+
+class LiveFeed:
+    """
+    Bounded ring buffer of live pass-ups with running count deltas.
+
+    Accepted records go to a log (LiveLog, or shared_cache.SharedLiveLog
+    under gunicorn) that numbers them; every process then syncs its buffer,
+    route matrix and spike detector from the log, so a record POSTed to one
+    worker reaches the dashboards polling any other, and sequence numbers
+    mean the same in every worker.
+
+    Args:
+        boundary (list): The administrative boundary trace.
+        route_labels (iterable): Route Number labels of the bundle's route_counts.
+        matrix (timeseries.RouteDayMatrix): Updated with every accepted record, if given.
+        detector (spikes.SpikeDetector): Fed with every accepted record, if given.
+        size (int): Most records kept in the buffer.
+        log (LiveLog): Where accepted records are stored; a LiveLog of this process by default.
+        passup_types (list): The Pass-Up Type labels of the city's agency.
+    """
+
+    def __init__(self, boundary, route_labels, matrix=None, detector=None, size=LIVE_BUFFER_SIZE, log=None,
+                 passup_types=PASSUP_TYPES):
+        self.boundary = boundary
+        self.route_labels = set(map(category_key, route_labels))
+        self.passup_types = passup_types
+        self.matrix = matrix
+        self.detector = detector
+        self.log = log if log is not None else LiveLog(size)
+        self.buffer = collections.deque(maxlen=size)
+        # The last record synced from the log, and the last one this buffer will never have
+        self.seq = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def attach(self, matrix, detector):
+        """
+        Switches to a freshly loaded matrix and detector, and replays the
+        buffered records into them, e.g. after the city was evicted and reloaded.
+        """
+        with self.lock:
+            self.matrix, self.detector = matrix, detector
+            records = pd.DataFrame([record for _, record in self.buffer])
+            if len(records):
+                self.detector.observe_frame(records)
+                self.matrix.add(records)
+
+    def sync(self):
+        """
+        Applies the records logged since the last sync, by any process.
+
+        Returns:
+            list: The spikes they raised.
+        """
+        with self.lock:
+            rows, pruned = self.log.read(self.seq)
+            # Records pruned from the log before this process read them are gone for good
+            self.dropped = max(self.dropped, pruned)
+            if not rows:
+                return []
+            df = pd.DataFrame([record for _, record in rows])
+            spikes = self.detector.observe_frame(df) if self.detector is not None else []
+            if self.matrix is not None:
+                self.matrix.add(df)
+            for seq, record in rows:
+                if len(self.buffer) == self.buffer.maxlen:
+                    self.dropped = self.buffer[0][0]
+                self.buffer.append((seq, record))
+            self.seq = rows[-1][0]
+        return spikes
+
+    def ingest(self, body):
+        """
+        Validates, boundary-filters and logs a JSON lines body.
+
+        Returns:
+            dict: 'accepted', 'outside' (valid but outside the city), 'rejected'
+            (line numbers and reasons), 'spikes' (new spikes) and 'seq'.
+        """
+        records, rejected = parse_lines(body)
+        df, invalid = enrich(records, self.route_labels, self.passup_types)
+        rejected += invalid
+        inside = points_in_boundary(df['Lat'], df['Long'], self.boundary)
+        df = df[inside].sort_values('Time', kind='stable').drop(columns='_line')
+
+        counts = {name: collections.Counter(map(category_key, df[column].dropna())) for name, column in AGGREGATE_COLUMNS.items()}
+        self.log.append(df.to_dict('records'), counts)
+        spikes = self.sync()
+
+        return {'accepted': len(df), 'outside': int((~inside).sum()), 'rejected': sorted(rejected, key=lambda r: r['line']),
+                'spikes': [dict(spike, Date=spike['Date'].isoformat()) for spike in spikes], 'seq': self.seq}
+
+    def latest(self):
+        """The sequence number of the newest record, after a sync."""
+        self.sync()
+        return self.seq
+
+    def since(self, seq):
+        """
+        Records added after sequence number seq.
+
+        Returns:
+            tuple: (current sequence number, pd.DataFrame of the records still
+            in the buffer, {aggregate: set of changed category keys}; None for a
+            caller too far behind the buffer, which should refresh all counts).
+        """
+        self.sync()
+        with self.lock:
+            rows = []
+            for number, record in reversed(self.buffer):
+                if number <= seq:
+                    break
+                rows.append(record)
+            caught_up = self.dropped <= seq
+            current = self.seq
+        df = pd.DataFrame(rows[::-1])
+        if not caught_up:
+            return current, df, None
+        changed = {name: set(map(category_key, df[column].dropna())) if len(df) else set()
+                   for name, column in AGGREGATE_COLUMNS.items()}
+        return current, df, changed
+
+    def records(self):
+        """All buffered records, oldest first."""
+        self.sync()
+        with self.lock:
+            return pd.DataFrame([record for _, record in self.buffer])
+
+    def count_deltas(self, aggregate):
+        """Live pass-ups per category of an aggregate, keyed by category_key."""
+        return self.log.counts(aggregate)
+
+
+def category_key(value):
+    # Bar categories come back from JSON as numbers or strings; 2019, 2019.0 and '2019' are one key
+    if isinstance(value, (int, float, np.integer, np.floating)) and float(value).is_integer():
+        return str(int(value))
+    return str(value)
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+Server-side paging, sorting and filtering of bundle tables for dash DataTables.
+
+A DataTable with page_action, sort_action and filter_action set to 'custom'
+sends its page, sort_by and filter_query to a callback, which answers with
+just the rows of the visible page. Sorting never sorts the table at request
+time: the build stores an ascending permutation of every sortable column
+in the bundle, so a single-column sort is a slice of a permutation and a
+multi-column sort refines one with stable passes over dense ranks.
+Low-cardinality columns are stored as codes into their sorted categories,
+so a filter on them is evaluated once per category and looked up per row.
+The row order of the last few sort and filter combinations is kept, so
+paging through one costs only the slice.
+"""
+
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# One clause of a DataTable filter_query, e.g. '{Teen Density} s> 100' or '{DAUID} contains 4611';
+# an 'i' prefix makes the comparison case-insensitive, 's' (or none) case-sensitive
+FILTER_CLAUSE = re.compile(
+    r'^\s*\{(?P<column>[^}]+)\}\s*(?P<case>[is]?)(?P<op>contains|datestartswith|eq|ne|gt|ge|lt|le|>=|<=|!=|=|>|<)\s*(?P<value>.*?)\s*$'
+)
+OPERATORS = {'eq': '=', 'ne': '!=', 'gt': '>', 'ge': '>=', 'lt': '<', 'le': '<='}
+
+# Sort and filter combinations whose row order is kept per table
+ORDER_CACHE_SIZE = 16
+
+# The pass-up record explorer: the columns shown and those indexed by category
+PASSUP_RECORD_COLUMNS = ['Pass-Up ID', 'Route Name', 'Route Number', 'Pass-Up Type', 'Time']
+PASSUP_RECORD_CATEGORIES = ['Route Name', 'Route Number', 'Pass-Up Type']
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def sort_orders(df, columns):
+    """
+    Ascending permutation of every column, to store in the bundle.
+
+    Returns:
+        np.ndarray: int32 array of shape (len(columns), len(df)); NaN sorts last.
+    """
+    orders = np.zeros((len(columns), len(df)), dtype=np.int32)
+    for i, column in enumerate(columns):
+        orders[i] = df[column].reset_index(drop=True).sort_values(kind='stable', na_position='last').index.to_numpy()
+    return orders
+
+
+def category_codes(df, columns):
+    """
+    Codes of columns into their sorted categories, to store in the bundle.
+
+    Returns:
+        tuple: (int32 array of shape (len(columns), len(df)), -1 where missing;
+        dict of the category list of every column).
+    """
+    codes = np.zeros((len(columns), len(df)), dtype=np.int32)
+    categories = {}
+    for i, column in enumerate(columns):
+        categorical = pd.Categorical(df[column])
+        codes[i] = categorical.codes
+        categories[column] = categorical.categories.tolist()
+    return codes, categories
+
+
+def table_indexes(name, df, columns, categorical=(), table=None):
+    """
+    The bundle arrays and manifest['paging'] entry of a paged table.
+
+    Args:
+        name (str): The paged table name.
+        df (pd.DataFrame): The rows.
+        columns (list): The columns shown, all sortable.
+        categorical (list): Columns indexed by category codes.
+        table (str): The bundle table holding the rows; by default the aggregate called name.
+
+    Returns:
+        tuple: (dict of arrays, manifest entry).
+    """
+    arrays = {'orders_' + name: sort_orders(df, columns)}
+    codes, categories = category_codes(df, list(categorical))
+    if categorical:
+        arrays['codes_' + name] = codes
+    return arrays, {'columns': list(columns), 'categories': categories, 'table': table}
+
+
+def parse_filter(filter_query):
+    """
+    Splits a DataTable filter_query into (column, operator, value, case sensitive)
+    clauses; values stay strings until they meet their column.
+
+    Clauses that don't parse are skipped, like the DataTable does for
+    half-typed filters.
+    """
+    clauses = []
+    for part in (filter_query or '').split(' && '):
+        match = FILTER_CLAUSE.match(part)
+        if not match or match.group('value') == '':
+            continue
+        value = match.group('value')
+        if len(value) > 1 and value[0] == value[-1] and value[0] in '\'"`':
+            value = value[1:-1].replace('\\' + value[0], value[0])
+        op = OPERATORS.get(match.group('op'), match.group('op'))
+        clauses.append((match.group('column'), op, value, match.group('case') != 'i'))
+    return clauses
+
+
+def date_range(prefix):
+    """The [start, end) timestamps of a date prefix such as '2019', '2019-05' or '2019-05-03 17'."""
+    start = pd.Timestamp(prefix)
+    digits = len(re.sub(r'\D', '', prefix))
+    step = {4: pd.DateOffset(years=1), 6: pd.DateOffset(months=1), 8: pd.DateOffset(days=1),
+            10: pd.DateOffset(hours=1), 12: pd.DateOffset(minutes=1)}.get(digits, pd.DateOffset(seconds=1))
+    return start, start + step
+
+
+def is_text(series):
+    return not (pd.api.types.is_numeric_dtype(series) or pd.api.types.is_datetime64_any_dtype(series))
+
+
+def clause_mask(series, op, value, sensitive=True, text=None):
+    """
+    Rows of one column matching one filter clause.
+
+    Args:
+        text (pd.Series): The column as strings, if already at hand.
+    """
+    if pd.api.types.is_datetime64_any_dtype(series):
+        # Dates compare as dates, and a prefix is a range rather than a string match
+        try:
+            if op == 'datestartswith':
+                start, end = date_range(value)
+                return ((series >= start) & (series < end)).to_numpy(dtype=bool)
+            if op != 'contains':
+                value = pd.Timestamp(value)
+        except ValueError:
+            return np.zeros(len(series), dtype=bool)
+
+    if op in ('contains', 'datestartswith'):
+        text = series.astype('string') if text is None else text
+        if op == 'datestartswith':
+            return text.str.startswith(str(value)).fillna(False).to_numpy(dtype=bool)
+        return text.str.contains(str(value), case=sensitive, regex=False).fillna(False).to_numpy(dtype=bool)
+
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        value = pd.to_numeric(value, errors='coerce')
+        if pd.isna(value):
+            return np.zeros(len(series), dtype=bool)
+    elif is_text(series):
+        series = series.astype('string') if text is None else text
+        if not sensitive:
+            series, value = series.str.lower(), value.lower()
+    compare = {'=': series.__eq__, '!=': series.__ne__, '>': series.__gt__, '>=': series.__ge__,
+               '<': series.__lt__, '<=': series.__le__}[op]
+    result = compare(value)
+    return pd.Series(result).fillna(False).to_numpy(dtype=bool)
+
+
+class PagedTable:
+    """
+    A table answering DataTable page requests.
+
+    Args:
+        df (pd.DataFrame): The rows, in their default order.
+        columns (list): The sortable columns, in the order of orders.
+        orders (np.ndarray): Ascending permutations per column, see
+            sort_orders; computed here if not given.
+        codes (np.ndarray): Codes of the categorical columns, see category_codes.
+        categories (dict): Category list of every categorical column, in the order of codes.
+    """
+
+    def __init__(self, df, columns=None, orders=None, codes=None, categories=None):
+        self.df = df.reset_index(drop=True)
+        self.columns = list(columns if columns is not None else df.columns)
+        self.orders = orders if orders is not None else sort_orders(self.df, self.columns)
+        self.position = {column: i for i, column in enumerate(self.columns)}
+        self.categories = {column: pd.Series(values, dtype=self.df[column].dtype)
+                           for column, values in (categories or {}).items()}
+        self.codes = {column: codes[i] for i, column in enumerate(categories or {})}
+        self._ranks = {}
+        self._text = {}
+        self._missing = {}
+        # Shared by the threads of a worker, so the move and eviction of an entry are one step
+        self._row_orders = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_bundle(cls, bundle, name):
+        """The table of manifest['paging'][name], with its 'orders_<name>' and 'codes_<name>' arrays."""
+        meta = bundle.manifest['paging'][name]
+        df = bundle.table(meta['table']) if meta['table'] else bundle.aggregate(name)
+        codes = bundle.array('codes_' + name) if meta['categories'] else None
+        return cls(df[meta['columns']], meta['columns'], bundle.array('orders_' + name), codes, meta['categories'])
+
+    def text(self, column):
+        # String form of a column, made once
+        if column not in self._text:
+            self._text[column] = self.df[column].astype('string')
+        return self._text[column]
+
+    def filter_mask(self, filter_query):
+        """Rows matching every clause, or None for no filter."""
+        mask = None
+        for column, op, value, sensitive in parse_filter(filter_query):
+            if column not in self.df:
+                continue
+            if column in self.categories:
+                # Matched once per category, then looked up per row; code -1 reads the trailing False
+                hits = clause_mask(self.categories[column], op, value, sensitive)
+                clause = np.r_[hits, False][self.codes[column]]
+            else:
+                series = self.df[column]
+                text = self.text(column) if op == 'contains' or is_text(series) else None
+                clause = clause_mask(series, op, value, sensitive, text)
+            mask = clause if mask is None else mask & clause
+        return mask
+
+    def column_order(self, column, direction):
+        """Row positions sorted by one column."""
+        order = np.asarray(self.orders[self.position[column]])
+        if direction == 'desc':
+            # Reversed, but with the NaN rows still at the end
+            if column not in self._missing:
+                self._missing[column] = int(self.df[column].isna().sum())
+            missing = self._missing[column]
+            order = np.r_[order[:len(order) - missing][::-1], order[len(order) - missing:]]
+        return order
+
+    def ranks(self, column):
+        """
+        Dense rank of every row in one column, read off its permutation.
+
+        Returns:
+            tuple: (ranks, the rank of missing values, which is one past the largest value).
+        """
+        if column not in self._ranks:
+            order = np.asarray(self.orders[self.position[column]])
+            values = self.df[column].to_numpy()[order]
+            missing = self.df[column].isna().to_numpy()[order]
+            sorted_ranks = np.cumsum(np.r_[False, values[1:] != values[:-1]] & ~missing)
+            top = int(sorted_ranks[~missing].max()) + 1 if (~missing).any() else 0
+            sorted_ranks[missing] = top
+            ranks = np.empty(len(order), dtype=np.int64)
+            ranks[order] = sorted_ranks
+            self._ranks[column] = (ranks, top)
+        return self._ranks[column]
+
+    def row_order(self, sort_by, mask=None):
+        """
+        Row positions in the order of sort_by (a DataTable sort_by list, main key first).
+
+        Args:
+            mask (np.ndarray): Rows to keep; dropped before the sort passes so they only see the matches.
+        """
+        sorts = [sort for sort in (sort_by or []) if sort['column_id'] in self.position]
+        if not sorts:
+            return np.arange(len(self.df)) if mask is None else np.flatnonzero(mask)
+        # The last key's permutation, refined by the keys before it with stable passes
+        order = self.column_order(sorts[-1]['column_id'], sorts[-1]['direction'])
+        if mask is not None:
+            order = order[mask[order]]
+        for sort in reversed(sorts[:-1]):
+            ranks, top = self.ranks(sort['column_id'])
+            keys = ranks[order]
+            if sort['direction'] == 'desc':
+                keys = np.where(keys == top, top, top - 1 - keys)
+            order = order[np.argsort(keys, kind='stable')]
+        return order
+
+    def page(self, page_current, page_size, sort_by=None, filter_query=''):
+        """
+        One page of the sorted and filtered rows.
+
+        Returns:
+            tuple: (list of row dicts, page count, matching row count).
+        """
+        key = (tuple((sort['column_id'], sort['direction']) for sort in (sort_by or [])), filter_query or '')
+        with self._lock:
+            order = self._row_orders.get(key)
+            if order is not None:
+                self._row_orders.move_to_end(key)
+        if order is None:
+            # Computed outside the lock, so a slow sort doesn't hold up other pages
+            order = self.row_order(sort_by, self.filter_mask(filter_query))
+            with self._lock:
+                self._row_orders[key] = order
+                while len(self._row_orders) > ORDER_CACHE_SIZE:
+                    self._row_orders.popitem(last=False)
+
+        page_current, page_size = page_current or 0, max(page_size or 1, 1)
+        rows = self.df.iloc[order[page_current * page_size:(page_current + 1) * page_size]].copy()
+        for column in rows.columns:
+            if pd.api.types.is_datetime64_any_dtype(rows[column]):
+                rows[column] = rows[column].dt.strftime(TIME_FORMAT)
+        page_count = max(1, -(-len(order) // page_size))
+        return rows.to_dict('records'), page_count, len(order)
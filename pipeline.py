@@ -0,0 +1,565 @@
+# -*- coding: utf-8 -*-
+"""
+Data pipeline: read -> validate -> spatial join -> count.
+
+Pass-ups that break a validation rule or fall outside the city are kept,
+as read and with their reason codes, in the bundle's quarantine table.
+
+This is the only module that needs the geospatial stack (geopandas, shapely,
+osmnx). It is run by build.py, never by the web process, and imports the
+stack only in the stages that use it, so a build answered from the stage
+cache (or a --dry-run) doesn't pay for it.
+"""
+
+import datetime
+import io
+import multiprocessing
+import time
+import urllib.request
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from pandas.tseries.api import guess_datetime_format
+
+from ingest import PASSUP_TYPES, category_key
+from stages import STAGE_CACHE_DIR, StageGraph
+
+CITY = 'Winnipeg, Canada'
+
+# Use the url of the csv I uploaded to github
+SOURCES = {
+    'stops': 'https://raw.githubusercontent.com/xupeitao/winnipegteencommute.github.io/eed46f305bef43e3238668591bda862e8e899799/data/stops.txt',
+    'passups': 'https://raw.githubusercontent.com/xupeitao/winnipegteencommute.github.io/eed46f305bef43e3238668591bda862e8e899799/data/Transit_Pass_ups.csv',
+    'census': 'https://raw.githubusercontent.com/xupeitao/winnipegteencommute.github.io/refs/heads/main/data/Winnipeg_Census_Point.csv',
+}
+
+# Route Numbers with fewer pass-ups than this are grouped into 'Other'
+MIN_ROUTE_COUNT = 1000
+
+# Stages whose values run_pipeline returns
+PIPELINE_TARGETS = ['stops.sjoin', 'passups.routes', 'passups.quarantine', 'census.classes', 'census.parse', 'aggregates',
+                    'boundary.trace']
+
+# Codes of the rules validate_passups checks, in bit order
+PASSUP_REASONS = ['coord_missing', 'coord_non_numeric', 'coord_zero', 'coord_out_of_range',
+                  'time_missing', 'time_invalid', 'route_missing', 'type_unknown']
+# Time formats tried when pandas can't guess one, e.g. 12-hour times with AM/PM
+TIME_FORMATS = ['%m/%d/%Y %I:%M:%S %p', '%Y-%m-%d %H:%M:%S']
+
+# Columns of the count cube behind the counts API
+COUNT_CUBE_COLUMNS = ['Route Number', 'Year', 'Hour', 'Time_Period', 'Pass-Up Type']
+
+# Census density classes used for the marker colours and sizes
+LIMITS = [(0, 50), (50, 100), (100, 200), (200, 500), (500, 2000)]
+COLORS = ["grey", "royalblue", "lightseagreen", "orange", "red"]
+SIZES = [1, 3, 5, 7, 20]
+
+
+def read_source(source):
+    """
+    Reads the raw bytes of a data source.
+
+    Args:
+        source (str): A local path or an http(s) url.
+
+    Returns:
+        bytes: The file content.
+    """
+    if source.startswith(('http://', 'https://')):
+        with urllib.request.urlopen(source) as response:
+            return response.read()
+    with open(source, 'rb') as f:
+        return f.read()
+
+
+def read_csv(raw):
+    return pd.read_csv(io.BytesIO(raw))
+
+
+def load_boundary(city=CITY):
+    """
+    Gets the administrative boundary of the city using OSMnx.
+
+    Args:
+        city (str): The place name to geocode.
+
+    Returns:
+        gpd.GeoDataFrame: The boundary polygon(s) in EPSG:4326.
+    """
+    import osmnx as ox
+
+    admin = ox.geocode_to_gdf(city)
+    return admin.set_crs(4326, allow_override=True)
+
+
+def boundary_trace(admin):
+    """
+    Converts the boundary exteriors to plain lat/lon lists, so the figures can
+    draw the city boundary without geopandas.
+
+    Args:
+        admin (gpd.GeoDataFrame): The GeoDataFrame containing the administrative boundaries.
+
+    Returns:
+        list: One {'lat': [...], 'lon': [...]} dict per boundary polygon.
+    """
+    trace = []
+    for _, row in admin.iterrows():
+        lon, lat = row.geometry.exterior.coords.xy
+        trace.append({'lat': lat.tolist(), 'lon': lon.tolist()})
+    return trace
+
+
+def within_boundary(df, admin):
+    """
+    Spatial join to identify the rows located within the city boundary.
+
+    Args:
+        df (pd.DataFrame): The dataframe with 'Long' and 'Lat' columns.
+        admin (gpd.GeoDataFrame): The GeoDataFrame containing the administrative boundaries.
+
+    Returns:
+        pd.DataFrame: The rows of df within the boundary, with the original columns.
+    """
+    import geopandas as gpd
+
+    gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df['Long'], df['Lat']), crs='EPSG:4326')
+    joined = gpd.sjoin(gdf, admin, how="inner", predicate="within")
+    return pd.DataFrame(joined[df.columns])
+
+
+def parse_times(times, time_format=None):
+    """
+    Parses a column of time strings with one format, which is vectorized.
+
+    Values the format misses are parsed one by one like pd.to_datetime without
+    a format would, so the result is the same, only without per-element
+    parsing of the whole column.
+
+    Args:
+        times (pd.Series): The time strings.
+        time_format (str): The strptime format; inferred from the first time if not given.
+
+    Returns:
+        pd.Series: The times, NaT where a value can't be parsed.
+    """
+    time_format = time_format or infer_time_format(times)
+    if time_format is None:
+        return pd.to_datetime(times, errors='coerce')
+    parsed = pd.to_datetime(times, format=time_format, errors='coerce')
+    missed = parsed.isna() & times.notna()
+    if missed.any():
+        with warnings.catch_warnings():
+            # pandas warns that it parses these one by one, which is the point
+            warnings.simplefilter('ignore', UserWarning)
+            parsed[missed] = pd.to_datetime(times[missed], errors='coerce')
+    return parsed
+
+
+def infer_time_format(times, probe=100):
+    """
+    The format of the first times that pandas, or one of TIME_FORMATS, can read.
+
+    Chunks are parsed with this format so every worker agrees with the serial path.
+    """
+    for value in times.dropna().astype(str).head(probe):
+        time_format = guess_datetime_format(value)
+        if time_format is not None:
+            return time_format
+        for time_format in TIME_FORMATS:
+            try:
+                datetime.datetime.strptime(value, time_format)
+                return time_format
+            except ValueError:
+                pass
+    return None
+
+
+def validate_passups(df_passup, time_format=None, passup_types=PASSUP_TYPES):
+    """
+    Checks every pass-up against every rule at once.
+
+    Coordinates and times are parsed once each, and every rule is one
+    vectorized comparison over the whole column; the rules a row breaks are
+    OR-ed into one bitmask, bit i for PASSUP_REASONS[i]:
+
+        coord_missing       Long or Lat empty
+        coord_non_numeric   Long or Lat not a number, e.g. '#VALUE!'
+        coord_zero          Long or Lat exactly 0
+        coord_out_of_range  not a latitude / longitude at all
+        time_missing        Time empty
+        time_invalid        Time not a date and time
+        route_missing       Route Number empty
+        type_unknown        Pass-Up Type not one of passup_types
+
+    Args:
+        df_passup (pd.DataFrame): The raw pass-up rows.
+        time_format (str): Format of the Time column, see parse_times.
+        passup_types (list): The Pass-Up Type labels of the source's agency.
+
+    Returns:
+        pd.DataFrame: The rows with Long and Lat as floats and Time as
+        datetimes (NaN and NaT where invalid), Route Number as stripped
+        labels ('16', not 16.0), '#VALUE!' cells of the text columns emptied,
+        and a 'Reasons' bitmask that is 0 for valid rows.
+    """
+    df = df_passup.copy()
+    # Spreadsheet error cells of the text columns are empty cells
+    for column in df.columns.difference(['Long', 'Lat', 'Time']):
+        if pd.api.types.is_string_dtype(df[column]):
+            df[column] = df[column].mask(df[column] == '#VALUE!')
+
+    long = pd.to_numeric(df['Long'], errors='coerce')
+    lat = pd.to_numeric(df['Lat'], errors='coerce')
+    time = parse_times(df['Time'], time_format)
+    # A blank cell makes read_csv parse the routes as floats; 16.0 is route '16'
+    route = df['Route Number'].map(category_key, na_action='ignore').str.strip()
+    missing = df['Long'].isna() | df['Lat'].isna()
+
+    checks = {
+        'coord_missing': missing,
+        'coord_non_numeric': ~missing & (long.isna() | lat.isna()),
+        'coord_zero': (long == 0) | (lat == 0),
+        'coord_out_of_range': (long.abs() > 180) | (lat.abs() > 90),
+        'time_missing': df['Time'].isna(),
+        'time_invalid': df['Time'].notna() & time.isna(),
+        'route_missing': route.isna() | (route == ''),
+        'type_unknown': ~df['Pass-Up Type'].isin(passup_types),
+    }
+    reasons = np.zeros(len(df), dtype=np.int64)
+    for bit, reason in enumerate(PASSUP_REASONS):
+        reasons |= checks[reason].fillna(False).to_numpy(dtype=bool).astype(np.int64) << bit
+
+    df['Long'], df['Lat'], df['Time'], df['Route Number'] = long.astype(float), lat.astype(float), time, route
+    df['Reasons'] = reasons
+    return df
+
+
+def valid_passups(validated, verbose=True):
+    """The rows of validate_passups that break no rule, without the 'Reasons' column."""
+    df_passup = validated[validated['Reasons'] == 0].drop(columns='Reasons')
+    if verbose:
+        print("Number of Rows before deleting:", len(validated))
+        print("Number of Rows after deleting:", len(df_passup))
+    return df_passup
+
+
+def quarantine_passups(df_passup, validated, passup_within):
+    """
+    The rejected pass-ups as they were read, with the reasons they were rejected.
+
+    Args:
+        df_passup (pd.DataFrame): The raw pass-up rows.
+        validated (pd.DataFrame): The same rows checked by validate_passups.
+        passup_within (pd.DataFrame): The valid rows within the boundary, in
+            the index of df_passup; valid rows missing from it are 'outside_city'.
+
+    Returns:
+        pd.DataFrame: The raw columns as text and 'Reason', the comma-separated
+        reason codes of each row.
+    """
+    reasons = validated['Reasons'].to_numpy()
+    outside = (reasons == 0) & ~validated.index.isin(passup_within.index)
+    reasons = reasons | (outside.astype(np.int64) << len(PASSUP_REASONS))
+    rejected = reasons != 0
+
+    # One label per distinct bitmask rather than per row
+    names = PASSUP_REASONS + ['outside_city']
+    masks, inverse = np.unique(reasons[rejected], return_inverse=True)
+    labels = np.array([','.join(name for bit, name in enumerate(names) if mask >> bit & 1) for mask in masks], dtype=object)
+    quarantine = df_passup[rejected].astype('string')
+    # Text even when nothing is rejected, so quarantine_counts can split it
+    quarantine['Reason'] = pd.Series(labels[inverse.reshape(-1)] if len(masks) else [], index=quarantine.index, dtype='string')
+    return quarantine
+
+
+def quarantine_counts(quarantine):
+    """Rejected rows per reason code; a row with several reasons counts for each."""
+    codes = quarantine['Reason'].str.split(',').explode()
+    return {reason: int(count) for reason, count in codes.value_counts().items()}
+
+
+def time_period(hour):
+    """
+    Distinguish time periods:
+    6-9am: Represents the time students go to school in the morning.
+    3-6pm: Represents the time students leave school in the afternoon.
+    Others: Covers times out of peak hours.
+    """
+    if 0 <= hour < 6:
+        return '0-6am'
+    elif 6 <= hour < 9:
+        return '6-9am'
+    elif 9 <= hour < 12:
+        return '9-12am'
+    elif 12 <= hour < 15:
+        return '12-3pm'
+    elif 15 <= hour < 18:
+        return '3-6pm'
+    else:
+        return '6-12pm'
+
+
+def add_time_columns(df_passup, time_format=None):
+    # A copy, since the input is the memoized output of another stage
+    df_passup = df_passup.copy()
+
+    # Convert 'Time' column to datetime type
+    df_passup['Time'] = pd.to_datetime(df_passup['Time'], format=time_format, errors='coerce')
+
+    # Extraction year, date, and hour
+    df_passup['Year'] = df_passup['Time'].dt.year
+    df_passup['Date'] = df_passup['Time'].dt.date
+    df_passup['Hour'] = df_passup['Time'].dt.hour
+
+    df_passup['Time_Period'] = df_passup['Hour'].apply(time_period)
+    return df_passup
+
+
+def group_rare_routes(passup_within, min_count=MIN_ROUTE_COUNT):
+    # A copy, since passups.quarantine reads the same input on another thread
+    passup_within = passup_within.copy()
+
+    # Count the occurrences of each Route Number
+    route_counts = passup_within['Route Number'].value_counts()
+
+    # Replace Route Numbers with counts less than min_count with 'Other'
+    rare = route_counts.index[route_counts < min_count]
+    route_number = passup_within['Route Number']
+    route_number = route_number.where(~route_number.isin(rare), 'Other')
+
+    # Keep route numbers as labels, so numeric and named routes share one column type;
+    # the ungrouped label stays in 'Route' for the per-route time series
+    route = passup_within['Route Number']
+    passup_within['Route'] = route.where(route.isna(), route.astype(str))
+    passup_within['Route Number'] = route_number.where(route_number.isna(), route_number.astype(str))
+    return passup_within
+
+
+def compute_aggregates(passup_within):
+    """
+    Number counted by different parameters.
+
+    Args:
+        passup_within (pd.DataFrame): The cleaned pass-ups within the city.
+
+    Returns:
+        dict: Count tables keyed 'route_counts', 'year_counts', 'hour_counts',
+        'time_counts' and 'type_counts', and 'count_cube' by all five columns.
+    """
+    # Calculate Route Number counts after replacement
+    route_counts = passup_within['Route Number'].value_counts().reset_index()
+    route_counts.columns = ['Route Number', 'Count']
+
+    # Calculate number by Year
+    year_counts = passup_within['Year'].value_counts().reset_index()
+    year_counts.columns = ['Year', 'Count']
+
+    # Calculate number by hour
+    hour_counts = passup_within['Hour'].value_counts().reset_index()
+    hour_counts.columns = ['Hour', 'Count']
+    hour_counts['Hour'] = hour_counts['Hour'].astype(int)
+    hour_counts = hour_counts.sort_values(by='Hour')
+
+    # Calculate number by Time Period
+    time_counts = passup_within['Time_Period'].value_counts().reset_index()
+    time_counts.columns = ['Time_Period', 'Count']
+
+    # Calculate number by Pass-Up Type
+    type_counts = passup_within['Pass-Up Type'].value_counts().reset_index()
+    type_counts.columns = ['Pass-Up Type', 'Count']
+
+    # Counts by all of them at once, for the counts API to filter and regroup
+    count_cube = passup_within.groupby(COUNT_CUBE_COLUMNS, dropna=False, observed=True).size().reset_index(name='Count')
+    count_cube[['Year', 'Hour']] = count_cube[['Year', 'Hour']].astype('Int64')
+
+    return {
+        'route_counts': route_counts,
+        'year_counts': year_counts,
+        'hour_counts': hour_counts,
+        'time_counts': time_counts,
+        'type_counts': type_counts,
+        'count_cube': count_cube,
+    }
+
+
+def add_census_classes(census_within):
+    # A copy, so the memoized census.sjoin output stays as it was
+    census_within = census_within.copy()
+
+    # Create a new column for color categories based on the limits
+    census_within['Color_Category'] = pd.cut(census_within['Total_15_Density'], bins=[limit[0] for limit in LIMITS] + [LIMITS[-1][1]],
+                                             labels=COLORS, right=False)
+
+    # Marker sizes by limits group
+    size_map = {color: size for color, size in zip(COLORS, SIZES)}
+    census_within['Marker_Size'] = census_within['Color_Category'].map(size_map).astype(float)
+    census_within['Marker_Size'] = census_within['Marker_Size'].fillna(5)
+    return census_within
+
+
+# Boundary of the current pool worker, set once per process by init_passup_worker
+_worker_admin = None
+
+
+def init_passup_worker(admin):
+    global _worker_admin
+    _worker_admin = admin
+
+
+def prepare_passup_chunk(chunk):
+    return within_boundary(add_time_columns(chunk), _worker_admin)
+
+
+def prepare_passups_parallel(df_passup, admin, processes, chunks_per_process=4):
+    """
+    Time enrichment and boundary filtering of the valid pass-ups on a process pool.
+
+    df_passup is split into contiguous row chunks. The boundary is sent once
+    to each worker through the pool initializer instead of with every task,
+    and the results are concatenated in chunk order, so the output is the
+    same as the serial path.
+
+    Args:
+        df_passup (pd.DataFrame): The valid pass-up rows, see valid_passups.
+        admin (gpd.GeoDataFrame): The GeoDataFrame containing the administrative boundaries.
+        processes (int): Number of worker processes.
+        chunks_per_process (int): Chunks per worker, for load balancing.
+
+    Returns:
+        pd.DataFrame: The enriched pass-ups within the boundary.
+    """
+    n_chunks = max(1, min(len(df_passup), processes * chunks_per_process))
+    bounds = [len(df_passup) * i // n_chunks for i in range(n_chunks + 1)]
+    chunks = [df_passup.iloc[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    # spawn, since this usually runs on one of run_pipeline's threads and forking a threaded process is unsafe
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context,
+                             initializer=init_passup_worker, initargs=(admin,)) as pool:
+        parts = list(pool.map(prepare_passup_chunk, chunks))
+
+    passup_within = pd.concat(parts)
+    print("Number of Rows within the boundary:", len(passup_within))
+    return passup_within
+
+
+def pipeline_graph(sources=None, city=CITY, processes=None, cache_dir=STAGE_CACHE_DIR, passup_types=None):
+    """
+    The pipeline stages, memoized on disk by content hash (see stages.py).
+
+    The sources are read on every run and keyed by their bytes; every other
+    stage is loaded from the cache when its function, parameters and inputs
+    are unchanged, so e.g. a new census CSV reruns only the census stages.
+
+    Args:
+        sources (dict): Paths or urls for 'stops', 'passups' and 'census'; defaults to SOURCES.
+        city (str): The place name of the city boundary.
+        processes (int): If more than 1, the time enrichment and boundary
+            filter of the pass-ups run as one stage on a pool of this many
+            processes; validation and cleaning stay in their own stages.
+        cache_dir (str): Directory of the memoized outputs; None recomputes everything.
+        passup_types (list): Pass-Up Type labels of the source's agency; PASSUP_TYPES by default.
+
+    Returns:
+        stages.StageGraph: The graph, with the stages named like PIPELINE_TARGETS
+        and 'boundary.trace'.
+    """
+    graph = StageGraph(cache_dir)
+    graph.add('boundary', load_boundary, params={'city': city})
+    graph.add('boundary.trace', boundary_trace, ['boundary'])
+    for name, source in {**SOURCES, **(sources or {})}.items():
+        graph.add(name + '.read', read_source, args=(source,), memo=False)
+
+    graph.add('stops.parse', read_csv, ['stops.read'])
+    graph.add('stops.sjoin', within_boundary, ['stops.parse', 'boundary'])
+
+    graph.add('passups.parse', read_csv, ['passups.read'])
+    graph.add('passups.validate', validate_passups, ['passups.parse'], params={'passup_types': list(passup_types or PASSUP_TYPES)})
+    graph.add('passups.clean', valid_passups, ['passups.validate'])
+    if processes and processes > 1:
+        graph.add('passups.parallel', prepare_passups_parallel, ['passups.clean', 'boundary'], args=(processes,))
+        within = 'passups.parallel'
+    else:
+        graph.add('passups.time', add_time_columns, ['passups.clean'])
+        graph.add('passups.sjoin', within_boundary, ['passups.time', 'boundary'])
+        within = 'passups.sjoin'
+    graph.add('passups.routes', group_rare_routes, [within], params={'min_count': MIN_ROUTE_COUNT})
+    graph.add('passups.quarantine', quarantine_passups, ['passups.parse', 'passups.validate', within])
+
+    graph.add('census.parse', read_csv, ['census.read'])
+    graph.add('census.sjoin', within_boundary, ['census.parse', 'boundary'])
+    graph.add('census.classes', add_census_classes, ['census.sjoin'])
+
+    graph.add('aggregates', compute_aggregates, ['passups.routes'])
+    return graph
+
+
+def run_pipeline(sources=None, city=CITY, workers=4, processes=None, graph=None):
+    """
+    Runs the whole pipeline once.
+
+    The stages run on a thread pool as soon as their inputs are ready, so the
+    stops, pass-up and census branches run in parallel and the wall time is
+    bounded by the slowest branch rather than the sum of them; memoized
+    stages are loaded instead of run.
+
+    Args:
+        sources (dict): Paths or urls for 'stops', 'passups' and 'census'; defaults to SOURCES.
+        city (str): The place name of the city boundary.
+        workers (int): Size of the thread pool; 1 runs the stages one after another.
+        processes (int): If more than 1, the pass-up time enrichment and
+            boundary filter run on a pool of this many processes.
+        graph (stages.StageGraph): The pipeline graph to run, e.g. extended by
+            build.py; pipeline_graph(sources, city, processes) by default.
+
+    Returns:
+        dict: 'raw' (source bytes), 'tables' (stops, passups, census, census_all
+        and quarantine, the rejected pass-ups, see quarantine_passups),
+        'aggregates', 'boundary' (lat/lon trace), 'timings' (seconds per stage)
+        and the 'graph'.
+    """
+    graph = graph or pipeline_graph(sources, city, processes)
+    timings = {}
+    start = time.perf_counter()
+    values = graph.run(PIPELINE_TARGETS, workers, timings)
+    timings['total'] = time.perf_counter() - start
+
+    return {
+        'raw': {name[:-len('.read')]: value for name, value in graph.values.items() if name.endswith('.read')},
+        'tables': {
+            'stops': values['stops.sjoin'],
+            'passups': values['passups.routes'],
+            'census': values['census.classes'],
+            'census_all': values['census.parse'],
+            'quarantine': values['passups.quarantine'],
+        },
+        'aggregates': values['aggregates'],
+        'boundary': values['boundary.trace'],
+        'timings': timings,
+        'graph': graph,
+    }
+
+
+def report_timings(timings):
+    """
+    Prints the per-stage timing breakdown and the critical path of each branch.
+
+    Args:
+        timings (dict): Seconds per stage, as returned by run_pipeline.
+    """
+    for stage in sorted(timings):
+        print("  %-18s %7.2fs" % (stage, timings[stage]))
+
+    # A branch starts once both its source and the boundary are loaded
+    paths = {}
+    for name in ('stops', 'passups', 'census'):
+        steps = sum(seconds for stage, seconds in timings.items()
+                    if stage.startswith(name + '.') and stage != name + '.read')
+        paths[name] = max(timings.get(name + '.read', 0), timings.get('boundary', 0)) + steps
+    slowest = max(paths, key=paths.get)
+    serial = sum(seconds for stage, seconds in timings.items() if stage != 'total')
+    print("  critical path: %s branch %.2fs; wall %.2fs vs %.2fs if run serially" % (
+        slowest, paths[slowest], timings['total'], serial))
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+Linear referencing of pass-ups onto the GTFS route shapes.
+
+Every route gets the shape its trips use most (one per direction), and the
+shapes are cut into edges between consecutive shape points. The edges go
+into a grid index keyed by (route, cell), so a pass-up is only compared with
+the edges of its own route in the cells around it. Snapping projects every
+pass-up onto all of its candidate edges at once with array arithmetic and
+keeps the nearest, which gives its distance along the shape. The pass-ups
+are then counted per stretch of SEGMENT_METERS along each shape, the
+segments of the corridor map:
+
+    python shapes.py --feed data/google_transit.zip
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+import artifacts
+from gtfs import MAX_SNAP_METERS, Feed, route_labels
+
+# Length of the stretches of a shape that pass-ups are counted in
+SEGMENT_METERS = 250
+# Cell size of the edge index; a pass-up looks at the cells within max_meters of it
+INDEX_CELL_METERS = 250
+# Pass-ups projected per block, so the (pass-up, edge) pairs stay bounded
+BLOCK_POINTS = 100000
+
+METERS_PER_DEGREE = 111320.0
+
+SEGMENT_COLUMNS = ['Route', 'shape_id', 'Segment', 'Start (m)', 'Length (m)', 'Count', 'Per km', 'lat', 'lon']
+
+
+def route_shapes(feed):
+    """
+    The most used shape of every route and direction.
+
+    Args:
+        feed (gtfs.Feed): The feed, with shapes.txt and shape_id in trips.txt.
+
+    Returns:
+        pd.DataFrame: Shape points with 'Route', 'shape_id', 'Lat' and 'Long',
+        in sequence order within each shape.
+    """
+    routes = feed.read('routes.txt', dtype={'route_id': str, 'route_short_name': str})
+    labels = dict(zip(routes['route_id'], route_labels(routes)))
+    trips = feed.read('trips.txt', dtype={'route_id': str, 'shape_id': str})
+    trips['Route'] = trips['route_id'].map(labels)
+    if 'direction_id' not in trips:
+        trips['direction_id'] = 0
+    trips = trips.dropna(subset=['Route', 'shape_id'])
+    used = trips.groupby(['Route', 'direction_id', 'shape_id']).size().reset_index(name='trips')
+    chosen = used.sort_values('trips', ascending=False, kind='stable').drop_duplicates(['Route', 'direction_id'])
+
+    points = feed.read('shapes.txt', dtype={'shape_id': str})
+    points = points[points['shape_id'].isin(chosen['shape_id'])].sort_values(['shape_id', 'shape_pt_sequence'])
+    points = points.rename(columns={'shape_pt_lat': 'Lat', 'shape_pt_lon': 'Long'})
+    # Routes sharing a shape get their own copy of it
+    return chosen[['Route', 'shape_id']].drop_duplicates().merge(points[['shape_id', 'Lat', 'Long']], on='shape_id')
+
+
+class EdgeIndex:
+    """
+    The edges of route shapes with a (route, cell) grid index.
+
+    Coordinates are projected to metres on a local equirectangular plane,
+    which is accurate to well under a percent across a city.
+
+    Attributes:
+        routes (list): Route labels, one per route code.
+        edges (pd.DataFrame): One row per edge: 'route' (code), 'shape_id',
+            'x0', 'y0', 'x1', 'y1' (metres), 'start' (metres along the shape)
+            and 'length'.
+        shapes (pd.DataFrame): The shape points, see route_shapes, with their
+            'shape' (code of the route and shape pair) and 'measure' along it.
+    """
+
+    def __init__(self, shapes, cell_meters=INDEX_CELL_METERS):
+        self.cell = float(cell_meters)
+        self.lat0 = float(shapes['Lat'].mean())
+        self.lon0 = float(shapes['Long'].mean())
+        self.scale = np.cos(np.radians(self.lat0))
+
+        route_codes, routes = pd.factorize(shapes['Route'].astype(str))
+        self.routes = list(routes)
+        self.route_index = {route: code for code, route in enumerate(self.routes)}
+        shape_codes = pd.factorize(pd.Series(route_codes).astype(str) + '|' + shapes['shape_id'].to_numpy())[0]
+        x, y = self.project(shapes['Lat'].to_numpy(dtype=float), shapes['Long'].to_numpy(dtype=float))
+
+        # Consecutive points of one shape make an edge
+        same = shape_codes[1:] == shape_codes[:-1]
+        first = np.nonzero(same)[0]
+        length = np.hypot(x[first + 1] - x[first], y[first + 1] - y[first])
+        # Distance along the shape: cumulative edge length, restarting at every shape
+        step = np.zeros(len(x))
+        step[first + 1] = length
+        total = np.cumsum(step)
+        starts = np.r_[0, np.nonzero(~same)[0] + 1]
+        measure = total - np.repeat(total[starts], np.diff(np.r_[starts, len(x)]))
+
+        self.shapes = shapes.assign(shape=shape_codes, measure=measure).reset_index(drop=True)
+        self.edges = pd.DataFrame({
+            'route': route_codes[first], 'shape': shape_codes[first], 'shape_id': shapes['shape_id'].to_numpy()[first],
+            'x0': x[first], 'y0': y[first], 'x1': x[first + 1], 'y1': y[first + 1],
+            'start': measure[first], 'length': length,
+        })
+        self.build_grid()
+
+    def project(self, lat, lon):
+        return (lon - self.lon0) * self.scale * METERS_PER_DEGREE, (lat - self.lat0) * METERS_PER_DEGREE
+
+    def build_grid(self):
+        # Every edge is listed in all cells its bounding box touches
+        e = self.edges
+        cx0 = np.floor(np.minimum(e['x0'], e['x1']).to_numpy() / self.cell).astype(np.int64)
+        cx1 = np.floor(np.maximum(e['x0'], e['x1']).to_numpy() / self.cell).astype(np.int64)
+        cy0 = np.floor(np.minimum(e['y0'], e['y1']).to_numpy() / self.cell).astype(np.int64)
+        cy1 = np.floor(np.maximum(e['y0'], e['y1']).to_numpy() / self.cell).astype(np.int64)
+        self.cx_min = int(cx0.min()) - 2 if len(e) else 0
+        self.cy_min = int(cy0.min()) - 2 if len(e) else 0
+        self.nx = int(cx1.max()) - self.cx_min + 3 if len(e) else 1
+        self.ny = int(cy1.max()) - self.cy_min + 3 if len(e) else 1
+
+        wide, high = cx1 - cx0 + 1, cy1 - cy0 + 1
+        cells = wide * high
+        edge = np.repeat(np.arange(len(e)), cells)
+        k = np.arange(len(edge)) - np.repeat(np.cumsum(cells) - cells, cells)
+        keys = self.cell_key(e['route'].to_numpy()[edge], cx0[edge] + k % wide[edge], cy0[edge] + k // wide[edge])
+        order = np.argsort(keys, kind='stable')
+        self.cell_keys, self.cell_starts = np.unique(keys[order], return_index=True)
+        self.cell_ends = np.r_[self.cell_starts[1:], len(order)]
+        self.cell_edges = edge[order]
+
+    def cell_key(self, route, cx, cy):
+        cx = np.clip(cx - self.cx_min, 0, self.nx - 1)
+        cy = np.clip(cy - self.cy_min, 0, self.ny - 1)
+        return (np.asarray(route, dtype=np.int64) * self.ny + cy) * self.nx + cx
+
+    def candidates(self, route, x, y, reach):
+        """(point, edge) pairs of the points' own-route edges in the cells within reach."""
+        cx, cy = np.floor(x / self.cell).astype(np.int64), np.floor(y / self.cell).astype(np.int64)
+        points, edges = [], []
+        for dx in range(-reach, reach + 1):
+            for dy in range(-reach, reach + 1):
+                keys = self.cell_key(route, cx + dx, cy + dy)
+                slot = np.searchsorted(self.cell_keys, keys).clip(max=max(len(self.cell_keys) - 1, 0))
+                hit = self.cell_keys[slot] == keys if len(self.cell_keys) else np.zeros(len(keys), dtype=bool)
+                hit &= route >= 0
+                lens = np.where(hit, self.cell_ends[slot] - self.cell_starts[slot], 0)
+                point = np.repeat(np.arange(len(route)), lens)
+                offset = np.arange(len(point)) - np.repeat(np.cumsum(lens) - lens, lens)
+                points.append(point)
+                edges.append(self.cell_edges[self.cell_starts[slot][point] + offset])
+        return np.concatenate(points), np.concatenate(edges)
+
+    def snap(self, passups, route_column='Route', max_meters=MAX_SNAP_METERS):
+        """
+        Projects pass-ups onto the nearest edge of their route's shapes.
+
+        Args:
+            passups (pd.DataFrame): Pass-ups with route_column, 'Lat' and 'Long'.
+            route_column (str): Column with the ungrouped route labels.
+            max_meters (float): Farthest snap distance.
+
+        Returns:
+            pd.DataFrame: Per pass-up, in order: 'edge' (-1 if unmatched),
+            'measure' (metres along the shape) and 'distance' (metres off it).
+        """
+        route = passups[route_column].astype('string').map(self.route_index).fillna(-1).to_numpy(dtype=np.int64)
+        x, y = self.project(passups['Lat'].to_numpy(dtype=float), passups['Long'].to_numpy(dtype=float))
+        reach = int(np.ceil(max_meters / self.cell))
+        e = {column: self.edges[column].to_numpy() for column in ('x0', 'y0', 'x1', 'y1', 'start', 'length')}
+
+        edge = np.full(len(route), -1, dtype=np.int64)
+        measure = np.full(len(route), np.nan)
+        distance = np.full(len(route), np.nan)
+        for begin in range(0, len(route), BLOCK_POINTS):
+            block = slice(begin, begin + BLOCK_POINTS)
+            point, cand = self.candidates(route[block], x[block], y[block], reach)
+            if not len(point):
+                continue
+            px, py = x[block][point], y[block][point]
+            ax, ay = e['x0'][cand], e['y0'][cand]
+            dx, dy = e['x1'][cand] - ax, e['y1'][cand] - ay
+            # Position of the projection along the edge, clamped to its ends
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = np.clip(((px - ax) * dx + (py - ay) * dy) / (dx * dx + dy * dy), 0, 1)
+            t = np.nan_to_num(t)
+            d = np.hypot(ax + t * dx - px, ay + t * dy - py)
+            # Nearest candidate of every point
+            order = np.lexsort((d, point))
+            nearest = order[np.unique(point[order], return_index=True)[1]]
+            close = nearest[d[nearest] <= max_meters]
+            rows = begin + point[close]
+            edge[rows] = cand[close]
+            measure[rows] = e['start'][cand[close]] + t[close] * e['length'][cand[close]]
+            distance[rows] = d[close]
+        return pd.DataFrame({'edge': edge, 'measure': measure, 'distance': distance}, index=passups.index)
+
+    def segment_counts(self, snapped, segment_meters=SEGMENT_METERS):
+        """
+        Snapped pass-ups counted per stretch of segment_meters along each shape.
+
+        Args:
+            snapped (pd.DataFrame): The output of snap.
+            segment_meters (float): Length of the stretches.
+
+        Returns:
+            pd.DataFrame: SEGMENT_COLUMNS, one row per stretch of every shape,
+            with the stretch's polyline in 'lat' and 'lon' (lists).
+        """
+        shapes = self.shapes
+        lengths = shapes.groupby('shape')['measure'].max().to_numpy()
+        pieces = np.ceil(lengths / segment_meters).astype(np.int64).clip(min=1)
+        base = np.r_[0, np.cumsum(pieces)[:-1]]
+
+        matched = snapped['edge'].to_numpy() >= 0
+        shape = self.edges['shape'].to_numpy()[snapped['edge'].to_numpy()[matched]]
+        piece = np.minimum(snapped['measure'].to_numpy()[matched] // segment_meters, pieces[shape] - 1).astype(np.int64)
+        counts = np.bincount(base[shape] + piece, minlength=int(pieces.sum()))
+
+        # Polyline of every stretch: its cut points at both ends and the shape points between them
+        lat_lines, lon_lines = [], []
+        for code, group in shapes.groupby('shape', sort=True):
+            measure, lat, lon = group['measure'].to_numpy(), group['Lat'].to_numpy(), group['Long'].to_numpy()
+            cuts = np.minimum(np.arange(pieces[code] + 1) * float(segment_meters), lengths[code])
+            cut_lat, cut_lon = np.interp(cuts, measure, lat), np.interp(cuts, measure, lon)
+            inner = np.searchsorted(measure, cuts, side='right')
+            for i in range(pieces[code]):
+                between = slice(inner[i], np.searchsorted(measure, cuts[i + 1], side='left'))
+                lat_lines.append([cut_lat[i], *lat[between], cut_lat[i + 1]])
+                lon_lines.append([cut_lon[i], *lon[between], cut_lon[i + 1]])
+
+        shape_of = np.repeat(np.arange(len(pieces)), pieces)
+        first = shapes.drop_duplicates('shape').set_index('shape').reindex(shape_of)
+        segment = np.arange(len(shape_of)) - base[shape_of]
+        start = segment * float(segment_meters)
+        length = np.minimum(lengths[shape_of] - start, segment_meters).clip(min=0)
+        table = pd.DataFrame({
+            'Route': first['Route'].to_numpy(),
+            'shape_id': first['shape_id'].to_numpy(),
+            'Segment': segment,
+            'Start (m)': start.round(1),
+            'Length (m)': length.round(1),
+            'Count': counts,
+            'lat': lat_lines,
+            'lon': lon_lines,
+        })
+        with np.errstate(divide='ignore', invalid='ignore'):
+            table['Per km'] = np.where(length > 0, counts / (length / 1000), 0).round(2)
+        return table[SEGMENT_COLUMNS]
+
+
+def corridor_counts(passups, feed, route_column='Route', segment_meters=SEGMENT_METERS):
+    """
+    Pass-ups per shape segment, for build.py.
+
+    Returns:
+        tuple: (pd.DataFrame of segments, see EdgeIndex.segment_counts; manifest entry).
+    """
+    feed = feed if isinstance(feed, Feed) else Feed(feed)
+    start = time.perf_counter()
+    index = EdgeIndex(route_shapes(feed))
+    snapped = index.snap(passups, route_column)
+    segments = index.segment_counts(snapped, segment_meters)
+    meta = {'edges': len(index.edges), 'segments': len(segments), 'segment_meters': segment_meters,
+            'snapped': int((snapped['edge'] >= 0).sum()), 'passups': len(passups),
+            'seconds': time.perf_counter() - start}
+    return segments, meta
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Snap the pass-ups of the current bundle onto the GTFS route shapes.')
+    parser.add_argument('--feed', required=True, help='GTFS feed directory or zip')
+    parser.add_argument('--segment-meters', type=float, default=SEGMENT_METERS, help='length of the counted stretches')
+    parser.add_argument('--top', type=int, default=20, help='number of segments to print')
+    args = parser.parse_args(argv)
+
+    passups = artifacts.load_bundle().table('passups')
+    start = time.perf_counter()
+    index = EdgeIndex(route_shapes(Feed(args.feed)))
+    indexed = time.perf_counter()
+    snapped = index.snap(passups)
+    snapped_at = time.perf_counter()
+    segments = index.segment_counts(snapped, args.segment_meters)
+    matched = snapped['edge'] >= 0
+    print("Indexed %d edges of %d routes in %.2fs; snapped %d of %d pass-ups in %.2fs (median %.0f m off the shape)" % (
+        len(index.edges), len(index.routes), indexed - start, matched.sum(), len(passups), snapped_at - indexed,
+        snapped.loc[matched, 'distance'].median()))
+    columns = [column for column in SEGMENT_COLUMNS if column not in ('lat', 'lon')]
+    print(segments.sort_values('Per km', ascending=False)[columns].head(args.top).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+A result cache shared by every worker process of the web app.
+
+Callback and API results are stored in one SQLite file under
+SHARED_CACHE_PATH, keyed by a hash of a namespace, the data version and the
+query parameters, so a slice computed by one gunicorn worker is reused by
+the others and survives restarts, and a new data version never sees the
+results of an old one. Every write is one transaction, so readers see a
+whole entry or none; a hit is a plain read, so hits of several workers
+don't queue behind each other. Entries are evicted least recently used
+first once their total size passes the budget (access times are kept to
+the minute), and hits and misses are counted in the same file for all
+workers, flushed every few seconds by each. The same file holds the live
+pass-up log, so a POST to one worker reaches the dashboards of all of them
+(see SharedLiveLog), and the data version every worker serves, so any of
+them reports the same status (see SharedWorkerStates):
+
+    python shared_cache.py            # print the counters
+    python shared_cache.py --clear
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+SHARED_CACHE_PATH = os.environ.get('WTC_SHARED_CACHE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'shared.sqlite'))
+# Total size of the stored values before the least recently used are dropped
+SHARED_CACHE_BYTES = int(os.environ.get('WTC_SHARED_CACHE_BYTES', 256 * 1024 ** 2))
+# Seconds a worker waits for another one's write to finish
+LOCK_TIMEOUT = 10
+# Seconds a hit's access time may lag, so a hit only writes once per entry and interval
+ACCESS_RESOLUTION = 60
+# Seconds a process keeps its hit and miss counts before adding them to the file
+COUNTER_FLUSH_SECONDS = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, namespace TEXT, version TEXT, value BLOB, size INTEGER, accessed REAL);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, count INTEGER);
+INSERT OR IGNORE INTO counters VALUES ('hits', 0), ('misses', 0), ('evictions', 0);
+CREATE TABLE IF NOT EXISTS live (seq INTEGER PRIMARY KEY AUTOINCREMENT, city TEXT, record BLOB);
+CREATE INDEX IF NOT EXISTS live_city ON live (city, seq);
+CREATE TABLE IF NOT EXISTS live_counts (city TEXT, aggregate TEXT, category TEXT, count INTEGER, PRIMARY KEY (city, aggregate, category));
+CREATE TABLE IF NOT EXISTS live_pruned (city TEXT PRIMARY KEY, seq INTEGER);
+CREATE TABLE IF NOT EXISTS workers (pid INTEGER, city TEXT, version TEXT, refresh TEXT, updated REAL, PRIMARY KEY (pid, city));
+"""
+
+# Returned by get for keys that aren't stored, since None is a valid value
+MISSING = object()
+
+
+def cache_key(namespace, version, params):
+    """Hash of a namespace, data version and JSON-serializable parameters, independent of dict order."""
+    text = json.dumps([namespace, version, params], sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+class SharedCache:
+    """
+    Pickled results in a SQLite file, safe across threads and processes.
+
+    Args:
+        path (str): The SQLite file; its directory is created if needed.
+        max_bytes (int): Budget of the stored values.
+    """
+
+    def __init__(self, path=SHARED_CACHE_PATH, max_bytes=SHARED_CACHE_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        # Hits and misses of this process not yet in the file, see flush
+        self.counts = {'hits': 0, 'misses': 0}
+        self.counts_pid = os.getpid()
+        self.flushed = time.monotonic()
+        self.counts_lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self.connection() as db:
+            db.executescript(SCHEMA)
+
+    def connection(self):
+        # One connection per thread and process; a forked worker must not reuse its parent's
+        if getattr(self.local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db, self.local.pid = db, os.getpid()
+        return self.local.db
+
+    def transaction(self):
+        return Transaction(self.connection())
+
+    def get(self, namespace, version, params):
+        """The stored value, or MISSING."""
+        key = cache_key(namespace, version, params)
+        db = self.connection()
+        row = db.execute('SELECT value, accessed FROM entries WHERE key = ?', (key,)).fetchone()
+        self.count('misses' if row is None else 'hits')
+        if row is None:
+            return MISSING
+        now = time.time()
+        if now - row[1] > ACCESS_RESOLUTION:
+            with self.transaction() as db:
+                db.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+        return pickle.loads(row[0])
+
+    def count(self, name):
+        with self.counts_lock:
+            if self.counts_pid != os.getpid():
+                # A forked worker starts from zero; its parent's counts are its parent's to flush
+                self.counts, self.counts_pid = {'hits': 0, 'misses': 0}, os.getpid()
+            self.counts[name] += 1
+        if time.monotonic() - self.flushed > COUNTER_FLUSH_SECONDS:
+            self.flush()
+
+    def flush(self):
+        """Adds this process's hit and miss counts to the file."""
+        with self.counts_lock:
+            counts, self.flushed = self.counts, time.monotonic()
+            self.counts = {'hits': 0, 'misses': 0}
+        if self.counts_pid != os.getpid() or not any(counts.values()):
+            return
+        with self.transaction() as db:
+            db.executemany('UPDATE counters SET count = count + ? WHERE name = ?',
+                           [(count, name) for name, count in counts.items()])
+
+    def put(self, namespace, version, params, value):
+        """Stores a value, then evicts down to the budget."""
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(blob) > self.max_bytes:
+            return
+        key = cache_key(namespace, version, params)
+        with self.transaction() as db:
+            db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                       (key, namespace, version, blob, len(blob), time.time()))
+            total = db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            if total > self.max_bytes:
+                evicted = []
+                for old_key, size in db.execute('SELECT key, size FROM entries ORDER BY accessed'):
+                    if total <= self.max_bytes:
+                        break
+                    evicted.append((old_key,))
+                    total -= size
+                db.executemany('DELETE FROM entries WHERE key = ?', evicted)
+                db.execute("UPDATE counters SET count = count + ? WHERE name = 'evictions'", (len(evicted),))
+
+    def get_or_compute(self, namespace, version, params, compute):
+        """
+        The stored value, or compute() stored for the next caller.
+
+        Two workers missing at once both compute; the later write wins with the same value.
+        """
+        value = self.get(namespace, version, params)
+        if value is MISSING:
+            value = compute()
+            self.put(namespace, version, params, value)
+        return value
+
+    def stats(self):
+        """Hit, miss and eviction counts of all processes, and the entries and bytes stored."""
+        self.flush()
+        db = self.connection()
+        stats = dict(db.execute('SELECT name, count FROM counters').fetchall())
+        stats['entries'], stats['bytes'] = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else None
+        return stats
+
+    def live_log(self, city, size):
+        """The live pass-up log of a city in this file, see SharedLiveLog."""
+        return SharedLiveLog(self, city, size)
+
+    def worker_states(self):
+        """The data versions served by the worker processes, see SharedWorkerStates."""
+        return SharedWorkerStates(self)
+
+    def clear(self):
+        with self.counts_lock:
+            self.counts = {'hits': 0, 'misses': 0}
+        with self.transaction() as db:
+            db.execute('DELETE FROM entries')
+            db.execute('UPDATE counters SET count = 0')
+
+
+class SharedLiveLog:
+    """
+    The live pass-ups of one city in the shared cache's file, with the methods of ingest.LiveLog.
+
+    Records are numbered by one sequence for the whole file, so numbers
+    mean the same in every worker; a city's numbers grow but skip those of
+    other cities. Only the last size records of a city are kept, while its
+    counts keep every record logged. clear() leaves the log alone.
+
+    Args:
+        cache (SharedCache): The cache whose file holds the log.
+        city (str): The city key.
+        size (int): Most records kept.
+    """
+
+    def __init__(self, cache, city, size):
+        self.cache = cache
+        self.city = city
+        self.size = size
+
+    def append(self, records, counts):
+        """Logs records under the next sequence numbers and adds counts ({aggregate: Counter}) to the totals."""
+        rows = [(self.city, pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)) for record in records]
+        totals = [(self.city, name, category, count) for name, counter in counts.items() for category, count in counter.items()]
+        with self.cache.transaction() as db:
+            db.executemany('INSERT INTO live (city, record) VALUES (?, ?)', rows)
+            db.executemany('INSERT INTO live_counts VALUES (?, ?, ?, ?) ON CONFLICT (city, aggregate, category) '
+                           'DO UPDATE SET count = count + excluded.count', totals)
+            oldest = db.execute('SELECT seq FROM live WHERE city = ? ORDER BY seq DESC LIMIT 1 OFFSET ?',
+                                (self.city, self.size)).fetchone()
+            if oldest is not None:
+                db.execute('DELETE FROM live WHERE city = ? AND seq <= ?', (self.city, oldest[0]))
+                db.execute('INSERT OR REPLACE INTO live_pruned VALUES (?, ?)', (self.city, oldest[0]))
+
+    def read(self, after):
+        """
+        Records logged after sequence number after.
+
+        Returns:
+            tuple: (list of (seq, record) in order, the last sequence number dropped from the log).
+        """
+        db = self.cache.connection()
+        rows = db.execute('SELECT seq, record FROM live WHERE city = ? AND seq > ? ORDER BY seq', (self.city, after)).fetchall()
+        # Read after the rows, so it is never older than them
+        pruned = db.execute('SELECT seq FROM live_pruned WHERE city = ?', (self.city,)).fetchone()
+        return [(seq, pickle.loads(record)) for seq, record in rows], pruned[0] if pruned else 0
+
+    def counts(self, aggregate):
+        """Logged pass-ups per category_key of an aggregate."""
+        db = self.cache.connection()
+        return dict(db.execute('SELECT category, count FROM live_counts WHERE city = ? AND aggregate = ?',
+                               (self.city, aggregate)).fetchall())
+
+
+class SharedWorkerStates:
+    """
+    The data version and last refresh of every loaded city in every worker
+    process, in the shared cache's file.
+
+    Every worker refreshes its cities on its own timer (see
+    cities.CityRegistry.start_refresher), so for up to one interval after a
+    new bundle some workers serve it and some the old one. Each records what
+    it serves here, so the status of any worker shows the same split.
+
+    Args:
+        cache (SharedCache): The cache whose file holds the states.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def record(self, city, version, refresh=None):
+        """Records what this process serves of a city; a version of None forgets the city."""
+        with self.cache.transaction() as db:
+            if version is None:
+                db.execute('DELETE FROM workers WHERE pid = ? AND city = ?', (os.getpid(), city))
+            else:
+                db.execute('INSERT OR REPLACE INTO workers VALUES (?, ?, ?, ?, ?)',
+                           (os.getpid(), city, version, json.dumps(refresh), time.time()))
+
+    def read(self, max_age):
+        """
+        The states recorded in the last max_age seconds; older ones are of
+        workers that stopped, and are deleted.
+
+        Returns:
+            dict: {city: {pid: {'version', 'last_refresh'}}}.
+        """
+        oldest = time.time() - max_age
+        with self.cache.transaction() as db:
+            db.execute('DELETE FROM workers WHERE updated < ?', (oldest,))
+            rows = db.execute('SELECT pid, city, version, refresh FROM workers').fetchall()
+        states = {}
+        for pid, city, version, refresh in rows:
+            states.setdefault(city, {})[pid] = {'version': version, 'last_refresh': json.loads(refresh)}
+        return states
+
+
+class Transaction:
+    """BEGIN IMMEDIATE ... COMMIT, rolled back on error; immediate so concurrent writers queue instead of deadlocking."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, kind, error, traceback):
+        self.db.execute('COMMIT' if kind is None else 'ROLLBACK')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Counters of the shared result cache.')
+    parser.add_argument('--path', default=SHARED_CACHE_PATH, help='SQLite file of the cache')
+    parser.add_argument('--clear', action='store_true', help='drop every entry and reset the counters')
+    args = parser.parse_args(argv)
+
+    cache = SharedCache(args.path)
+    if args.clear:
+        cache.clear()
+    print(json.dumps(cache.stats(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Online spike detection of pass-ups per route and time period.
+
+Every (route, time period) pair keeps a constant-size baseline of its daily
+pass-up count: an EWMA level, one additive EWMA offset per weekday and an
+EWMA of the squared residuals. A day's count is a spike when it exceeds the
+expected count (level + weekday offset) by more than Z_THRESHOLD standard
+deviations.
+
+Records are consumed in time order with SpikeDetector.observe, which flags a
+window as soon as its running count crosses the threshold and folds each day
+into the baselines when the next day starts. SpikeDetector.backfill replays
+a whole history from a timeseries.RouteDayMatrix one day at a time, with all
+routes and periods updated together as arrays:
+
+    python spikes.py --top 20
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+import artifacts
+from timeseries import RouteDayMatrix, PERIODS, day_numbers, period_codes
+
+# Smoothing of the level and variance, and of the weekday offsets (per week)
+ALPHA = 0.05
+GAMMA = 0.1
+# A spike is at least Z_THRESHOLD standard deviations and MIN_SPIKE_COUNT pass-ups
+Z_THRESHOLD = 4.0
+MIN_SPIKE_COUNT = 3
+# Days of history before a baseline may flag anything
+WARMUP_DAYS = 28
+# Floor of the standard deviation, so quiet baselines don't flag every pass-up
+MIN_STD = 1.0
+
+SPIKE_COLUMNS = ['Route', 'Time_Period', 'Date', 'Count', 'Expected', 'Z']
+
+
+class SpikeDetector:
+    """
+    Streaming EWMA/seasonal spike detector.
+
+    The state is a handful of (routes, periods) arrays, so memory only grows
+    with the number of routes, never with the number of records.
+    """
+
+    def __init__(self, routes=(), z_threshold=Z_THRESHOLD, min_count=MIN_SPIKE_COUNT):
+        self.z_threshold = z_threshold
+        self.min_count = min_count
+        self.routes = []
+        self.index = {}
+        self.level = np.zeros((0, len(PERIODS)))
+        self.season = np.zeros((7, 0, len(PERIODS)))
+        self.var = np.zeros((0, len(PERIODS)))
+        self.seen = np.zeros(0, dtype=np.int64)
+        # Running counts of the open day
+        self.day = None
+        self.counts = np.zeros((0, len(PERIODS)), dtype=np.int64)
+        self.flagged = np.zeros((0, len(PERIODS)), dtype=bool)
+        self.spikes = []
+        for route in routes:
+            self.route_row(route)
+
+    def route_row(self, route):
+        row = self.index.get(route)
+        if row is None:
+            row = self.index[route] = len(self.routes)
+            self.routes.append(route)
+            periods = len(PERIODS)
+            self.level = np.vstack([self.level, np.zeros((1, periods))])
+            self.season = np.concatenate([self.season, np.zeros((7, 1, periods))], axis=1)
+            self.var = np.vstack([self.var, np.zeros((1, periods))])
+            self.seen = np.append(self.seen, 0)
+            self.counts = np.vstack([self.counts, np.zeros((1, periods), dtype=np.int64)])
+            self.flagged = np.vstack([self.flagged, np.zeros((1, periods), dtype=bool)])
+        return row
+
+    def expected(self, day):
+        """Expected count and standard deviation of every route and period on a day."""
+        weekday = (day + 3) % 7  # 1970-01-01 was a Thursday
+        return self.level + self.season[weekday], np.maximum(np.sqrt(self.var), MIN_STD)
+
+    def threshold(self, day):
+        expected, std = self.expected(day)
+        limit = np.maximum(expected + self.z_threshold * std, self.min_count)
+        # Baselines still warming up never flag
+        limit[self.seen < WARMUP_DAYS] = np.inf
+        return limit
+
+    def record(self, row, column, day, count, expected, std):
+        # expected and std are the baseline before the day was folded in
+        spike = {
+            'Route': self.routes[row],
+            'Time_Period': PERIODS[column],
+            'Date': pd.Timestamp(int(day), unit='D'),
+            'Count': int(count),
+            'Expected': round(float(expected[row, column]), 2),
+            'Z': round(float((count - expected[row, column]) / std[row, column]), 2),
+        }
+        self.spikes.append(spike)
+        return spike
+
+    def close_day(self, day, counts):
+        """
+        Folds one day's counts into the baselines.
+
+        Args:
+            day (int): Day number (days since 1970-01-01).
+            counts (np.ndarray): Counts of shape (routes, periods).
+
+        Returns:
+            tuple: Boolean (routes, periods) array of the spikes of the day,
+            and the expected counts and standard deviations they were judged by.
+        """
+        expected, std = self.expected(day)
+        spikes = counts > self.threshold(day)
+        weekday = (day + 3) % 7
+        season = self.season[weekday]
+        residual = counts - self.level - season
+        self.var += ALPHA * (residual ** 2 - self.var)
+        self.level += ALPHA * (counts - season - self.level)
+        self.season[weekday] = season + GAMMA * (counts - self.level - season)
+        self.seen += 1
+        return spikes, expected, std
+
+    def skip_days(self, first, stop):
+        # Days without any record are days of zero pass-ups for every baseline
+        zeros = np.zeros_like(self.counts)
+        for day in range(first, stop):
+            self.close_day(day, zeros)
+
+    def advance(self, day):
+        if self.day is not None and day > self.day:
+            # Spikes of the open day were flagged as they crossed the threshold
+            self.close_day(self.day, self.counts)
+            self.skip_days(self.day + 1, day)
+            self.counts[:] = 0
+            self.flagged[:] = False
+        if self.day is None or day > self.day:
+            self.day = day
+
+    def observe(self, route, time, hour):
+        """
+        Counts one pass-up. Records must arrive in time order; a record
+        older than the open day is ignored.
+
+        Args:
+            route (str): The route label.
+            time (pd.Timestamp): When the pass-up happened.
+            hour (int): Its hour of day.
+
+        Returns:
+            dict: The spike, with the SPIKE_COLUMNS keys, if this pass-up made
+            its route and period cross the threshold for the day, else None.
+        """
+        day = int(np.datetime64(pd.Timestamp(time), 'D').astype(np.int64))
+        row = self.route_row(str(route))
+        self.advance(day)
+        if day < self.day:
+            return None
+        column = int(period_codes([hour])[0])
+        self.counts[row, column] += 1
+        count = self.counts[row, column]
+        if not self.flagged[row, column] and count > self.threshold(day)[row, column]:
+            self.flagged[row, column] = True
+            return self.record(row, column, day, count, *self.expected(day))
+        return None
+
+    def observe_frame(self, passups, route_column='Route'):
+        """Feeds the rows of a dataframe in time order; returns the new spikes."""
+        days = day_numbers(passups['Time'])
+        keep = passups[route_column].notna().to_numpy() & (days >= 0)
+        rows = passups[keep].sort_values('Time', kind='stable')
+        spikes = []
+        for route, time, hour in zip(rows[route_column], rows['Time'], rows['Hour']):
+            spike = self.observe(route, time, hour)
+            if spike is not None:
+                spikes.append(spike)
+        return spikes
+
+    @classmethod
+    def backfill(cls, matrix, **kwargs):
+        """
+        Replays a whole history, one day of all routes at a time.
+
+        The last day of the matrix is left open, so observe can carry on
+        from where the history ends.
+
+        Args:
+            matrix (timeseries.RouteDayMatrix): Counts per route, day and period.
+            **kwargs: Passed on to SpikeDetector.
+
+        Returns:
+            SpikeDetector: The detector, with the spikes found in .spikes.
+        """
+        detector = cls(matrix.routes, **kwargs)
+        counts = matrix.counts
+        n_days = counts.shape[1]
+        for offset in range(n_days - 1):
+            day = matrix.start + offset
+            spikes, expected, std = detector.close_day(day, counts[:, offset].astype(np.int64))
+            for row, column in zip(*np.nonzero(spikes)):
+                detector.record(row, column, day, counts[row, offset, column], expected, std)
+        if n_days:
+            day = detector.day = matrix.start + n_days - 1
+            detector.counts[:] = counts[:, -1]
+            detector.flagged[:] = detector.counts > detector.threshold(day)
+            for row, column in zip(*np.nonzero(detector.flagged)):
+                detector.record(row, column, day, detector.counts[row, column], *detector.expected(day))
+        return detector
+
+    def spike_table(self):
+        """All spikes so far as a dataframe with SPIKE_COLUMNS, strongest first."""
+        return pd.DataFrame(self.spikes, columns=SPIKE_COLUMNS).sort_values('Z', ascending=False, ignore_index=True)
+
+
+def spike_passups(passup_within, spikes, route_column='Route'):
+    """
+    The pass-ups inside flagged windows, for the dashboard's spike layer.
+
+    Args:
+        passup_within (pd.DataFrame): The cleaned pass-ups within the city.
+        spikes (pd.DataFrame): Spike windows, see SpikeDetector.spike_table.
+        route_column (str): Column with the route labels the detector used.
+
+    Returns:
+        pd.DataFrame: The matching pass-ups with the window's 'Expected' and 'Z'.
+    """
+    windows = spikes[['Route', 'Time_Period', 'Date', 'Expected', 'Z']].rename(columns={'Route': route_column, 'Date': 'Spike Day'})
+    rows = passup_within.assign(**{'Spike Day': passup_within['Time'].dt.normalize()})
+    return rows.merge(windows, on=[route_column, 'Time_Period', 'Spike Day'], how='inner').drop(columns='Spike Day')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay the pass-up history of the current bundle through the spike detector.')
+    parser.add_argument('--z', type=float, default=Z_THRESHOLD, help='standard deviations above the baseline')
+    parser.add_argument('--min-count', type=int, default=MIN_SPIKE_COUNT, help='fewest pass-ups of a spike')
+    parser.add_argument('--top', type=int, default=20, help='number of spikes to print')
+    args = parser.parse_args(argv)
+
+    matrix = RouteDayMatrix.from_bundle(artifacts.load_bundle())
+    start = time.perf_counter()
+    detector = SpikeDetector.backfill(matrix, z_threshold=args.z, min_count=args.min_count)
+    spikes = detector.spike_table()
+    print("Replayed %d days of %d routes in %.2fs: %d spikes" % (
+        matrix.counts.shape[1], len(matrix.routes), time.perf_counter() - start, len(spikes)))
+    print(spikes.head(args.top).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
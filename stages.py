@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+A dependency graph of build stages memoized on disk by content hash.
+
+Every stage declares its function, the stages it takes as inputs and its
+parameters. Its key hashes the stage name, the source code of its function,
+its parameters and the keys of its inputs, so it changes exactly when
+something that goes into the stage changes. Outputs are pickled under
+STAGE_CACHE_DIR/<stage>-<key>.pkl; a rerun loads a stage whose key has a
+file and recomputes the others, and stages upstream of loaded ones aren't
+touched at all. Unmemoized stages (the source reads) always run and are
+keyed by the hash of their output, so a changed CSV invalidates exactly
+the stages built on it.
+
+A function's code is hashed as the source files of its module and of every
+module of this repo that module imports, directly or not, so a change to a
+helper in another file invalidates the stages that may call it. Library
+upgrades aren't seen; STAGE_FORMAT (and artifacts.BUNDLE_FORMAT) are in
+every key and are bumped when one changes an output. After a build,
+StageGraph.prune drops the pickles of older keys:
+
+    python build.py --dry-run
+"""
+
+import ast
+import functools
+import hashlib
+import json
+import os
+import pickle
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import artifacts
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+STAGE_CACHE_DIR = os.environ.get('WTC_STAGE_CACHE', os.path.join(REPO_DIR, 'cache', 'stages'))
+STAGE_FORMAT = 2
+# Pickles of other keys kept per stage by prune, e.g. for another city or a parameter switched back and forth
+STAGE_CACHE_KEEP = int(os.environ.get('WTC_STAGE_CACHE_KEEP', 2))
+# Age after which a temporary file is taken to be left by a build that died while writing it
+STALE_TMP_SECONDS = 3600
+
+
+def repo_imports(path):
+    """The source files of this repo's modules imported anywhere in a source file."""
+    with open(path, 'rb') as f:
+        tree = ast.parse(f.read(), path)
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            names.add(node.module.split('.')[0])
+    paths = (os.path.join(REPO_DIR, name + '.py') for name in names)
+    return {path for path in paths if os.path.exists(path)}
+
+
+@functools.lru_cache(maxsize=None)
+def module_digest(path):
+    """Hash of a source file and of the repo modules it imports, transitively."""
+    files, todo = set(), [os.path.abspath(path)]
+    while todo:
+        current = todo.pop()
+        if current not in files:
+            files.add(current)
+            todo.extend(repo_imports(current) - files)
+    digest = hashlib.sha1()
+    for current in sorted(files):
+        with open(current, 'rb') as f:
+            digest.update(os.path.basename(current).encode() + b'\0' + f.read())
+    return digest.hexdigest()
+
+
+def function_digest(func):
+    """
+    Hash of a function's code: its qualified name and the sources of its module
+    and the repo modules that one imports, or only the name when the module
+    has no source file.
+    """
+    module = sys.modules.get(getattr(func, '__module__', None))
+    path = getattr(module, '__file__', None)
+    text = '%s.%s' % (getattr(func, '__module__', ''), getattr(func, '__qualname__', repr(func)))
+    if path and path.endswith('.py') and os.path.exists(path):
+        text += ' ' + module_digest(path)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def value_digest(value):
+    """Hash of a value's content: bytes as they are, anything else pickled."""
+    data = value if isinstance(value, bytes) else pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    return hashlib.sha1(data).hexdigest()
+
+
+class Stage:
+    """
+    One node of a StageGraph.
+
+    Args:
+        name (str): The stage name, also its cache file prefix.
+        func (callable): Called with the input values, then args, then params as keywords.
+        inputs (list): Names of the stages or values it takes.
+        params (dict): JSON-serializable keyword arguments, part of the key.
+        args (tuple): Extra positional arguments that don't change the output (e.g. a
+            process count), so they're left out of the key.
+        memo (bool): Store the output; unmemoized stages always run and are keyed by their output.
+    """
+
+    def __init__(self, name, func, inputs=(), params=None, args=(), memo=True):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.params = params or {}
+        self.args = tuple(args)
+        self.memo = memo
+
+
+class StageGraph:
+    """
+    Stages and given values, computed on demand with memoization.
+
+    Args:
+        cache_dir (str): Directory of the memoized outputs; None memoizes nothing.
+    """
+
+    def __init__(self, cache_dir=STAGE_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.stages = {}
+        self.values = {}
+        self.keys = {}
+        # How each stage was obtained ('run' or 'cached') and the seconds it took
+        self.status = {}
+        self.timings = {}
+
+    def add(self, name, func, inputs=(), params=None, args=(), memo=True):
+        self.stages[name] = Stage(name, func, inputs, params, args, memo)
+
+    def add_value(self, name, value, key=None):
+        """A given input, keyed by its content unless a key is passed."""
+        self.values[name] = value
+        self.keys[name] = key if key is not None else value_digest(value)
+
+    def key(self, name):
+        """The content key of a stage; runs the unmemoized stages it depends on."""
+        if name not in self.keys:
+            stage = self.stages[name]
+            if not stage.memo:
+                self.compute(stage)
+            else:
+                text = json.dumps([STAGE_FORMAT, artifacts.BUNDLE_FORMAT, name, function_digest(stage.func),
+                                   stage.params, [self.key(i) for i in stage.inputs]], sort_keys=True, default=str)
+                self.keys[name] = hashlib.sha1(text.encode()).hexdigest()[:16]
+        return self.keys[name]
+
+    def path(self, name):
+        return os.path.join(self.cache_dir, '%s-%s.pkl' % (name, self.key(name)))
+
+    def cached(self, name):
+        return self.cache_dir is not None and self.stages[name].memo and os.path.exists(self.path(name))
+
+    def plan(self, targets):
+        """
+        What a run of targets would do, without computing any memoized stage.
+
+        Returns:
+            list: (stage, 'memory', 'cached' or 'run', key) in run order.
+        """
+        steps, seen = [], set()
+
+        def visit(name):
+            if name in seen:
+                return
+            seen.add(name)
+            if name in self.values:
+                if name in self.stages:
+                    steps.append((name, 'memory', self.key(name)))
+            elif self.cached(name):
+                steps.append((name, 'cached', self.key(name)))
+            else:
+                for dependency in self.stages[name].inputs:
+                    visit(dependency)
+                key = self.key(name)
+                # Keying an unmemoized stage has just computed it
+                steps.append((name, 'memory' if name in self.values else 'run', key))
+
+        for target in targets:
+            visit(target)
+        return steps
+
+    def compute(self, stage):
+        start = time.perf_counter()
+        value = stage.func(*[self.values[i] for i in stage.inputs], *stage.args, **stage.params)
+        self.timings[stage.name] = time.perf_counter() - start
+        self.values[stage.name] = value
+        self.status[stage.name] = 'run'
+        if not stage.memo:
+            self.keys[stage.name] = value_digest(value)
+        elif self.cache_dir is not None:
+            # Written under a temporary name and renamed, so a concurrent build never loads a partial file
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = self.path(stage.name)
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        return value
+
+    def load(self, stage):
+        start = time.perf_counter()
+        path = self.path(stage.name)
+        with open(path, 'rb') as f:
+            value = pickle.load(f)
+        # Its modification time is its last use, see prune
+        os.utime(path)
+        self.timings[stage.name] = time.perf_counter() - start
+        self.values[stage.name] = value
+        self.status[stage.name] = 'cached'
+        return value
+
+    def run(self, targets, workers=4, timings=None):
+        """
+        Computes or loads the targets and whatever they need, on a thread pool.
+
+        Args:
+            targets (list): Stage names.
+            workers (int): Threads; independent stages run concurrently.
+            timings (dict): Filled with the seconds spent per stage, computing or loading it.
+
+        Returns:
+            dict: The value of every target.
+        """
+        known = set(self.values)
+        steps = self.plan(targets)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # Submitted in run order, so a stage only waits on stages submitted before it and a small pool can't deadlock
+            futures = {}
+
+            def step(name, action):
+                for dependency in self.stages[name].inputs:
+                    if dependency in futures:
+                        futures[dependency].result()
+                if action == 'cached':
+                    return self.load(self.stages[name])
+                return self.compute(self.stages[name])
+
+            for name, action, _ in steps:
+                if action != 'memory':
+                    futures[name] = pool.submit(step, name, action)
+            for future in futures.values():
+                future.result()
+        if timings is not None:
+            timings.update({name: self.timings[name] for name, _, _ in steps if name not in known and name in self.timings})
+        return {target: self.values[target] for target in targets}
+
+    def prune(self, keep=STAGE_CACHE_KEEP):
+        """
+        Deletes the pickles of this graph's stages under keys other than the
+        current ones, all but the keep most recently used per stage, and
+        temporary files left by interrupted writes. Stages of other graphs
+        sharing the directory are left alone.
+
+        Returns:
+            int: Files deleted.
+        """
+        if self.cache_dir is None or not os.path.isdir(self.cache_dir):
+            return 0
+        current = {self.path(name) for name, stage in self.stages.items() if stage.memo}
+        others = {}
+        deleted = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.tmp'):
+                if time.time() - entry.stat().st_mtime > STALE_TMP_SECONDS:
+                    os.remove(entry.path)
+                    deleted += 1
+                continue
+            name = entry.name.rsplit('-', 1)[0]
+            if entry.name.endswith('.pkl') and name in self.stages and entry.path not in current:
+                others.setdefault(name, []).append(entry)
+        for entries in others.values():
+            entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+            for entry in entries[keep:]:
+                os.remove(entry.path)
+                deleted += 1
+        return deleted
+
+    def report(self, targets):
+        """Prints the plan of targets, e.g. for a dry run."""
+        for name, action, key in self.plan(targets):
+            print("  %-18s %-7s %s" % (name, action, key))
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Startup profile of the web app: import time per module and time per boot stage.
+
+app.py marks its boot stages (imports, loading the default city's bundle,
+the shared caches, the layout and the callbacks) on a BootTimer, and prints
+them when WTC_PROFILE_STARTUP=1. This module imports the app in a fresh
+interpreter under `python -X importtime`, so every import is timed as a
+worker would pay it, and reports the slowest modules with the boot stages.
+With --budget it is the regression check of worker boot: it fails when
+importing the app takes longer than the budget, or pulls in one of the
+geospatial modules only the build needs:
+
+    python startup.py
+    python startup.py --budget 2.5
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+PROFILE_STARTUP = os.environ.get('WTC_PROFILE_STARTUP') == '1'
+# Seconds the app may take to import, including loading the default bundle
+IMPORT_BUDGET = float(os.environ.get('WTC_IMPORT_BUDGET', 3.0))
+# Build-only modules a web worker must not import
+HEAVY_MODULES = ('osmnx', 'geopandas', 'shapely', 'pyproj', 'networkx', 'sklearn', 'scipy')
+
+# One line of -X importtime output: self and cumulative microseconds, then the module indented by depth
+IMPORT_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)\s*$')
+
+
+class BootTimer:
+    """Seconds spent per boot stage, each stage running from the previous mark."""
+
+    def __init__(self):
+        self.start = self.last = time.perf_counter()
+        self.timings = {}
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.timings[name] = now - self.last
+        self.last = now
+
+    def total(self):
+        return self.last - self.start
+
+    def report(self):
+        print("Boot stages:")
+        for name, seconds in self.timings.items():
+            print("  %-12s %6.3fs" % (name, seconds))
+        print("  %-12s %6.3fs" % ('total', self.total()))
+
+
+# The timer of this process; app.py imports it first, so its start is the start of the app's imports
+boot = BootTimer()
+
+
+def parse_import_times(text):
+    """
+    The modules of -X importtime output.
+
+    Returns:
+        list: (module, self seconds, cumulative seconds, depth) in import order.
+    """
+    modules = []
+    for line in text.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            modules.append((match.group(4), int(match.group(1)) / 1e6, int(match.group(2)) / 1e6,
+                            len(match.group(3)) // 2))
+    return modules
+
+
+def profile_import(module='app'):
+    """
+    Imports a module in a fresh interpreter under -X importtime.
+
+    Returns:
+        tuple: (list of imported modules, see parse_import_times; boot stage timings of the module's BootTimer).
+    """
+    code = 'import %s, json, startup; print(json.dumps(startup.boot.timings))' % module
+    directory = os.path.dirname(os.path.abspath(__file__))
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [directory, os.environ.get('PYTHONPATH')]))}
+    env.pop('WTC_PROFILE_STARTUP', None)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True, env=env)
+    if result.returncode:
+        raise RuntimeError('importing %s failed:\n%s' % (module, result.stderr[-2000:]))
+    stages = json.loads(result.stdout.strip().splitlines()[-1])
+    return parse_import_times(result.stderr), stages
+
+
+def budget_failures(modules, module='app', budget=IMPORT_BUDGET, forbidden=HEAVY_MODULES):
+    """Why an import profile breaks the budget, as messages; empty when it doesn't."""
+    failures = []
+    total = sum(cumulative for name, _, cumulative, depth in modules if depth == 0 and name == module)
+    if total > budget:
+        failures.append('importing %s took %.2fs, over the %.2fs budget' % (module, total, budget))
+    imported = {name.split('.')[0] for name, _, _, _ in modules}
+    for name in forbidden:
+        if name in imported:
+            failures.append('importing %s imports %s' % (module, name))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Import time per module and time per boot stage of the web app.')
+    parser.add_argument('--module', default='app', help='module to import')
+    parser.add_argument('--top', type=int, default=20, help='slowest modules to list')
+    parser.add_argument('--repeat', type=int, default=3, help='imports to run; the fastest is reported, the first warms the disk cache')
+    parser.add_argument('--budget', type=float, nargs='?', const=IMPORT_BUDGET,
+                        help='fail if the import takes longer than this many seconds (default %s) or imports %s'
+                        % (IMPORT_BUDGET, ', '.join(HEAVY_MODULES)))
+    args = parser.parse_args(argv)
+
+    runs = [profile_import(args.module) for _ in range(max(args.repeat, 1))]
+    modules, stages = min(runs, key=lambda run: sum(cumulative for _, _, cumulative, depth in run[0] if depth == 0))
+
+    # Top-level packages by cumulative time, then the modules doing the work by their own time
+    packages = sorted(((cumulative, name) for name, _, cumulative, depth in modules if depth <= 1), reverse=True)
+    print("Slowest imports (cumulative, direct imports of %s and top level):" % args.module)
+    for cumulative, name in packages[:args.top]:
+        print("  %-40s %6.3fs" % (name, cumulative))
+    print("Slowest modules (own time):")
+    for name, own, _, _ in sorted(modules, key=lambda module: module[1], reverse=True)[:args.top]:
+        print("  %-40s %6.3fs" % (name, own))
+    print("Boot stages:")
+    for name, seconds in stages.items():
+        print("  %-40s %6.3fs" % (name, seconds))
+
+    if args.budget is not None:
+        failures = budget_failures(modules, args.module, args.budget)
+        for failure in failures:
+            print("FAIL: " + failure)
+        if failures:
+            sys.exit(1)
+        print("OK: within the %.2fs import budget" % args.budget)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+# The modules live at the top of the repo, next to app.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'timing: wall-clock budgets; deselect with -m "not timing" on slow or shared machines')
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""Pass-up validation and quarantine on a small csv with one row per rule."""
+
+import os
+
+import pandas as pd
+import pytest
+
+import pipeline
+
+PASSUPS_CSV = os.path.join(os.path.dirname(__file__), 'data', 'passups.csv')
+
+# Pass-Up ID -> the rules its row breaks; 10 is valid but in Toronto
+EXPECTED_REASONS = {
+    1: [],
+    2: ['coord_missing'],
+    3: ['coord_non_numeric'],
+    4: ['coord_zero'],
+    5: ['coord_out_of_range'],
+    6: ['time_missing'],
+    7: ['time_invalid'],
+    8: ['route_missing'],
+    9: ['type_unknown'],
+    10: [],
+    11: ['coord_zero', 'time_missing'],
+    12: [],
+}
+OUTSIDE = [10]
+
+
+def reasons_mask(names):
+    return sum(1 << pipeline.PASSUP_REASONS.index(name) for name in names)
+
+
+@pytest.fixture
+def raw():
+    return pd.read_csv(PASSUPS_CSV)
+
+
+@pytest.fixture
+def validated(raw):
+    return pipeline.validate_passups(raw)
+
+
+def within(validated):
+    # The boundary filter without the geospatial stack: every valid row but those in OUTSIDE
+    valid = pipeline.valid_passups(validated, verbose=False)
+    return valid[~valid['Pass-Up ID'].isin(OUTSIDE)]
+
+
+def test_every_reason_has_a_row():
+    assert sorted({name for names in EXPECTED_REASONS.values() for name in names}) == sorted(pipeline.PASSUP_REASONS)
+
+
+@pytest.mark.parametrize('passup_id', sorted(EXPECTED_REASONS))
+def test_validate_sets_the_reason_bits(validated, passup_id):
+    row = validated[validated['Pass-Up ID'] == passup_id].iloc[0]
+    assert row['Reasons'] == reasons_mask(EXPECTED_REASONS[passup_id])
+
+
+def test_validate_parses_the_valid_rows(validated):
+    valid = pipeline.valid_passups(validated, verbose=False)
+    assert valid['Pass-Up ID'].tolist() == [1, 10, 12]
+    assert valid['Time'].tolist() == [pd.Timestamp('2017-05-13 21:50:37'), pd.Timestamp('2017-05-15 08:10:00'),
+                                      pd.Timestamp('2017-05-16 17:45:00')]
+    assert valid['Lat'].dtype == float and valid['Long'].dtype == float
+    assert 'Reasons' not in valid
+
+
+def test_validate_leaves_the_input_alone(raw):
+    before = raw.copy()
+    pipeline.validate_passups(raw)
+    pd.testing.assert_frame_equal(raw, before)
+
+
+def test_blank_route_keeps_integer_labels(raw, validated):
+    # The blank route of row 8 makes read_csv parse the column as floats
+    assert raw['Route Number'].dtype == float
+    assert validated['Route Number'].dropna().tolist() == ['16', '16', '11', '11', '21', '21', '21', '60', '60', '60', '60']
+
+
+def test_passup_types_per_city(raw):
+    validated = pipeline.validate_passups(raw, passup_types=['Full Bus Pass-Up', 'Banana'])
+    type_unknown = reasons_mask(['type_unknown'])
+    assert validated.loc[validated['Reasons'] & type_unknown != 0, 'Pass-Up ID'].tolist() == [4, 12]
+
+
+def test_quarantine_labels(raw, validated):
+    quarantine = pipeline.quarantine_passups(raw, validated, within(validated))
+    labels = dict(zip(quarantine['Pass-Up ID'].astype(int), quarantine['Reason']))
+    expected = {passup_id: ','.join(names) for passup_id, names in EXPECTED_REASONS.items() if names}
+    expected.update({passup_id: 'outside_city' for passup_id in OUTSIDE})
+    assert labels == expected
+
+
+def test_quarantine_keeps_the_raw_text(raw, validated):
+    quarantine = pipeline.quarantine_passups(raw, validated, within(validated))
+    assert quarantine.set_index('Pass-Up ID').loc['3', 'Lat'] == '#VALUE!'
+    assert quarantine.columns.tolist() == raw.columns.tolist() + ['Reason']
+
+
+def test_quarantine_of_clean_rows(raw, validated):
+    valid = validated['Reasons'] == 0
+    quarantine = pipeline.quarantine_passups(raw[valid], validated[valid], validated[valid])
+    assert len(quarantine) == 0
+    assert pipeline.quarantine_counts(quarantine) == {}
+
+
+def test_quarantine_counts(raw, validated):
+    counts = pipeline.quarantine_counts(pipeline.quarantine_passups(raw, validated, within(validated)))
+    assert counts == {**{name: 1 for name in pipeline.PASSUP_REASONS}, 'coord_zero': 2, 'time_missing': 2,
+                      'outside_city': 1}
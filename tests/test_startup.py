@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""Worker boot: the app imports none of the build-only modules, within the import budget."""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import startup
+
+IMPORT_LINES = """\
+import time: self [us] | cumulative | imported package
+import time:       120 |        120 |   _io
+import time:       300 |       5000 |     pandas.core
+import time:      2000 |       7000 |   pandas
+import time:        50 |         50 |     shapely.geometry
+import time:       400 |      12000 | app
+"""
+
+
+def test_parse_import_times():
+    modules = startup.parse_import_times(IMPORT_LINES)
+    assert modules[0] == ('_io', 0.00012, 0.00012, 1)
+    assert modules[-1] == ('app', 0.0004, 0.012, 0)
+    assert [depth for _, _, _, depth in modules] == [1, 2, 1, 2, 0]
+
+
+def test_budget_failures_names_forbidden_modules_and_slow_imports():
+    modules = startup.parse_import_times(IMPORT_LINES)
+    assert startup.budget_failures(modules, budget=1.0, forbidden=('osmnx',)) == []
+    assert startup.budget_failures(modules, budget=1.0) == ['importing app imports shapely']
+    slow = startup.budget_failures(modules, budget=0.005, forbidden=())
+    assert len(slow) == 1 and slow[0].startswith('importing app took 0.01s')
+
+
+# The stubbed city boundary, a box around central Winnipeg
+WEST, SOUTH, EAST, NORTH = -97.30, 49.80, -97.00, 49.96
+
+
+def write_sources(directory, seed=1):
+    # Small random stops, census points and pass-ups in the columns of the real files
+    rng = np.random.default_rng(seed)
+
+    def points(n):
+        return rng.uniform(WEST, EAST, n), rng.uniform(SOUTH, NORTH, n)
+
+    long, lat = points(40)
+    pd.DataFrame({'stop_id': 10001 + np.arange(40), 'stop_code': 10001 + np.arange(40), 'stop_name': 'Stop',
+                  'stop_url': '', 'Lat': lat, 'Long': long}).to_csv(os.path.join(directory, 'stops.txt'), index=False)
+
+    long, lat = points(30)
+    teens, area = rng.integers(20, 200, 30), rng.uniform(0.2, 2.0, 30)
+    pd.DataFrame({'OBJECTID': np.arange(1, 31), 'PRNAME': 'Manitoba', 'PRUID': 46, 'CDUID': 4611,
+                  'CDNAME': 'Division No. 11', 'DAUID': 46110001 + np.arange(30), 'Total_15_to_19_years': teens,
+                  'Men_15_to_19_years': teens // 2, 'Women_15_to_19_years': teens - teens // 2,
+                  'Shape_Area(m^2)': area * 1e6, 'Shape_Area(km^2)': area, 'Total_15_Density': teens / area,
+                  'Men_15_Density': teens // 2 / area, 'Women_15_Density': (teens - teens // 2) / area,
+                  'Long': long, 'Lat': lat}).to_csv(os.path.join(directory, 'census.csv'), index=False)
+
+    long, lat = points(400)
+    times = pd.Timestamp('2023-01-01') + pd.to_timedelta(rng.integers(0, 365 * 24 * 3600, 400), unit='s')
+    pd.DataFrame({'Pass-Up ID': np.arange(1, 401),
+                  'Pass-Up Type': rng.choice(['Full Bus Pass-Up', 'Wheelchair User Pass-Up'], 400, p=[0.9, 0.1]),
+                  'Time': times.strftime('%m/%d/%Y %I:%M:%S %p'), 'Route Number': rng.choice([11, 16, 18, 21], 400),
+                  'Route Name': 'Route', 'Route Destination': 'Downtown', 'Location': 'POINT',
+                  'Long': long, 'Lat': lat}).to_csv(os.path.join(directory, 'passups.csv'), index=False)
+
+
+def stub_boundary(city):
+    import geopandas as gpd
+    from shapely.geometry import box
+
+    return gpd.GeoDataFrame(geometry=[box(WEST, SOUTH, EAST, NORTH)], crs=4326)
+
+
+@pytest.fixture(scope='module')
+def app_import(tmp_path_factory):
+    # A tiny bundle built offline: the boundary is stubbed and the rasters coarse
+    pytest.importorskip('geopandas')
+    import build
+    import density
+    import pipeline
+
+    directory = tmp_path_factory.mktemp('boot')
+    write_sources(str(directory))
+    sources = {name: str(directory / filename)
+               for name, filename in [('stops', 'stops.txt'), ('census', 'census.csv'), ('passups', 'passups.csv')]}
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(pipeline, 'load_boundary', stub_boundary)
+        patch.setattr(pipeline, 'MIN_ROUTE_COUNT', 10)
+        patch.setattr(density, 'RESOLUTIONS', {'low': 64, 'medium': 128, 'high': 256})
+        build.build(sources, root=str(directory / 'artifacts'), workers=2, cache_dir=None)
+        # The app is imported in a fresh interpreter, which reads these
+        patch.setenv('WTC_ARTIFACTS', str(directory / 'artifacts'))
+        patch.setenv('WTC_SHARED_CACHE', str(directory / 'shared.sqlite'))
+        patch.delenv('WTC_CITIES', raising=False)
+        return startup.profile_import('app')
+
+
+def test_app_imports_no_build_modules(app_import):
+    modules, stages = app_import
+    assert startup.budget_failures(modules, budget=float('inf')) == []
+    assert {'imports', 'bundle', 'layout', 'callbacks'} <= set(stages)
+
+
+@pytest.mark.timing
+def test_app_import_within_budget(app_import):
+    # The budget is WTC_IMPORT_BUDGET, so a slow machine can raise it rather than skip the check
+    modules, _ = app_import
+    assert startup.budget_failures(modules, budget=startup.IMPORT_BUDGET, forbidden=()) == []
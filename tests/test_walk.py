@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""The walk engine against networkx on a small street grid."""
+
+import math
+import os
+import random
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+import pytest
+
+import walk
+
+SIZE = 6
+STOPS = [(0, 0), (4, 5), (5, 1)]
+
+
+def street_grid(directed=False, seed=1):
+    # A SIZE x SIZE grid about 110 m apart with uneven street lengths
+    rng = random.Random(seed)
+    grid = nx.grid_2d_graph(SIZE, SIZE)
+    graph = nx.DiGraph() if directed else nx.Graph()
+    for i, j in grid.nodes:
+        graph.add_node((i, j), x=-97.14 + i * 0.0015, y=49.88 + j * 0.001)
+    for u, v in grid.edges:
+        graph.add_edge(u, v, length=rng.uniform(80, 200))
+        if directed:
+            # Most streets go both ways, each way with its own length; the rest are one way
+            if rng.random() < 0.7:
+                graph.add_edge(v, u, length=rng.uniform(80, 200))
+    return graph
+
+
+def stop_table(graph, nodes=STOPS):
+    return pd.DataFrame({'stop_id': [10 + k for k in range(len(nodes))],
+                         'Lat': [graph.nodes[node]['y'] for node in nodes],
+                         'Long': [graph.nodes[node]['x'] for node in nodes]})
+
+
+def expected_distances(graph, cutoff=None):
+    # Node -> nearest stop is stop -> node over the reversed edges
+    reverse = graph.reverse() if graph.is_directed() else graph
+    return nx.multi_source_dijkstra_path_length(reverse, set(STOPS), cutoff=cutoff, weight='length')
+
+
+@pytest.fixture(autouse=True)
+def empty_memory_cache():
+    walk._memory_cache.clear()
+    yield
+    walk._memory_cache.clear()
+
+
+@pytest.mark.parametrize('directed', [False, True])
+def test_multi_source_dijkstra_matches_networkx(directed):
+    graph = street_grid(directed)
+    walk_graph = walk.WalkGraph(graph)
+    nodes = list(graph.nodes)
+    sources = np.array([nodes.index(node) for node in STOPS])
+    dist, origin = walk_graph.multi_source_dijkstra(sources, np.zeros(len(STOPS)), cutoff=math.inf)
+
+    expected = expected_distances(graph)
+    for i, node in enumerate(nodes):
+        if node not in expected:
+            assert dist[i] == math.inf and origin[i] == -1
+            continue
+        assert dist[i] == pytest.approx(expected[node])
+        # The stop it is assigned is one of the closest
+        stop = STOPS[origin[i]]
+        assert nx.dijkstra_path_length(graph, node, stop, weight='length') == pytest.approx(expected[node])
+
+
+def test_cutoff_leaves_farther_nodes_unreached():
+    graph = street_grid()
+    walk_graph = walk.WalkGraph(graph)
+    nodes = list(graph.nodes)
+    sources = np.array([nodes.index(node) for node in STOPS])
+    cutoff = 250
+    dist, origin = walk_graph.multi_source_dijkstra(sources, np.zeros(len(STOPS)), cutoff=cutoff)
+
+    expected = expected_distances(graph, cutoff=cutoff)
+    assert 0 < len(expected) < len(nodes)
+    for i, node in enumerate(nodes):
+        if node in expected:
+            assert dist[i] == pytest.approx(expected[node])
+        else:
+            assert dist[i] == math.inf and origin[i] == -1
+
+
+def test_walk_access_of_points_on_nodes(tmp_path):
+    graph = street_grid()
+    walk_graph = walk.WalkGraph(graph)
+    nodes = list(graph.nodes)
+    points = pd.DataFrame({'Lat': [graph.nodes[node]['y'] for node in nodes],
+                           'Long': [graph.nodes[node]['x'] for node in nodes]}, index=range(100, 100 + len(nodes)))
+    cutoff = 300
+    access = walk.walk_access(points, stop_table(graph), walk_graph, cutoff=cutoff, cache_dir=str(tmp_path))
+
+    assert list(access.columns) == walk.WALK_COLUMNS
+    assert list(access.index) == list(points.index)
+    expected = expected_distances(graph, cutoff=cutoff)
+    for (_, row), node in zip(access.iterrows(), nodes):
+        if node in expected:
+            assert row['Walk to Stop (m)'] == pytest.approx(expected[node], abs=0.1)
+            assert row['Nearest Stop'] in {'10', '11', '12'}
+        else:
+            assert np.isnan(row['Walk to Stop (m)']) and pd.isna(row['Nearest Stop'])
+    # A stop's own node is a walk of nothing to itself
+    at_stops = access.loc[[100 + nodes.index(node) for node in STOPS]]
+    assert at_stops['Nearest Stop'].tolist() == ['10', '11', '12']
+    assert at_stops['Walk to Stop (m)'].tolist() == [0, 0, 0]
+
+
+def test_node_access_cache_key(tmp_path, monkeypatch):
+    graph = street_grid()
+    walk_graph = walk.WalkGraph(graph)
+    stops = stop_table(graph)
+    first = walk.node_access(walk_graph, stops, cutoff=500, cache_dir=str(tmp_path))
+    assert os.listdir(tmp_path) == [first['key'] + '.npz']
+    assert first['key'].startswith(walk_graph.version + '-')
+
+    # A fresh process loads the file instead of walking again
+    walk._memory_cache.clear()
+
+    def fail(*args, **kwargs):
+        raise AssertionError('walked the graph again instead of loading the cache')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(walk.WalkGraph, 'multi_source_dijkstra', fail)
+        loaded = walk.node_access(walk_graph, stops, cutoff=500, cache_dir=str(tmp_path))
+    assert loaded['key'] == first['key']
+    np.testing.assert_array_equal(loaded['dist'], first['dist'])
+    np.testing.assert_array_equal(loaded['origin'], first['origin'])
+
+    # Another cutoff, stop set or street graph is another entry
+    keys = {first['key'],
+            walk.node_access(walk_graph, stops, cutoff=400, cache_dir=str(tmp_path))['key'],
+            walk.node_access(walk_graph, stops.iloc[:2], cutoff=500, cache_dir=str(tmp_path))['key'],
+            walk.node_access(walk.WalkGraph(street_grid(seed=2)), stops, cutoff=500, cache_dir=str(tmp_path))['key']}
+    assert len(keys) == 4
+    assert sorted(os.listdir(tmp_path)) == sorted(key + '.npz' for key in keys)
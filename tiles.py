@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+"""
+XYZ raster tiles of the heat layers.
+
+Tiles are rendered on demand from the bundle's point tables with the same
+Gaussian kernel as the city-wide rasters (see density.py), in Web Mercator,
+and kept in a size-bounded on-disk LRU keyed by data version:
+
+    <ARTIFACT_ROOT>/tiles/<version>/<layer>/<z>/<x>/<y>.png
+
+Seed the cache for the city ahead of time with
+
+    python tiles.py --zoom 9 13
+"""
+
+import argparse
+import contextlib
+import math
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: the budget then holds per process
+    fcntl = None
+
+import numpy as np
+from plotly.colors import sequential
+
+import artifacts
+import density
+
+TILE_SIZE = 256
+EARTH_RADIUS = 6378137.0
+HALF_WORLD = math.pi * EARTH_RADIUS
+
+TILE_CACHE_BYTES = int(os.environ.get('WTC_TILE_CACHE_MB', 256)) * 1024 * 1024
+SEED_ZOOMS = (9, 13)
+
+
+def to_mercator(lat, lon):
+    lat = np.radians(np.clip(np.asarray(lat, dtype=float), -85.0511, 85.0511))
+    lon = np.radians(np.asarray(lon, dtype=float))
+    return EARTH_RADIUS * lon, EARTH_RADIUS * np.log(np.tan(np.pi / 4 + lat / 2))
+
+
+def mercator_to_lat(y):
+    return math.degrees(2 * math.atan(math.exp(y / EARTH_RADIUS)) - math.pi / 2)
+
+
+def tile_range(bounds, z):
+    """
+    The x and y tile index ranges covering a lat/lon box at zoom z.
+
+    Args:
+        bounds (tuple): (west, south, east, north) in degrees.
+        z (int): Zoom level.
+
+    Returns:
+        tuple: (range of x, range of y).
+    """
+    west, south, east, north = bounds
+    n = 2 ** z
+    (x0, x1), (y1, y0) = to_mercator([south, north], [west, east])
+    size = 2 * HALF_WORLD / n
+
+    def index(v):
+        return min(max(int(v // size), 0), n - 1)
+
+    return range(index(x0 + HALF_WORLD), index(x1 + HALF_WORLD) + 1), range(index(HALF_WORLD - y0), index(HALF_WORLD - y1) + 1)
+
+
+class TilePoints:
+    """Points of one layer in Web Mercator metres, sorted by x for range reads."""
+
+    def __init__(self, lat, lon, weights=None):
+        xs, ys = to_mercator(lat, lon)
+        keep = np.isfinite(xs) & np.isfinite(ys)
+        if weights is not None:
+            weights = np.asarray(weights, dtype=float)
+            keep &= np.isfinite(weights)
+        order = np.argsort(xs[keep], kind='stable')
+        self.xs = xs[keep][order]
+        self.ys = ys[keep][order]
+        self.weights = None if weights is None else weights[keep][order]
+
+    def select(self, west, south, east, north):
+        start, stop = np.searchsorted(self.xs, [west, east])
+        ys = self.ys[start:stop]
+        inside = (ys >= south) & (ys <= north)
+        weights = None if self.weights is None else self.weights[start:stop][inside]
+        return self.xs[start:stop][inside], ys[inside], weights
+
+
+def upsample_matrix(cells, factor, size=TILE_SIZE):
+    # Linear interpolation weights from `cells` coarse cells to `size` pixel centres
+    centres = np.clip((np.arange(size) + 0.5) / factor - 0.5, 0, cells - 1)
+    low = np.floor(centres).astype(int)
+    high = np.minimum(low + 1, cells - 1)
+    frac = centres - low
+    weights = np.zeros((size, cells))
+    weights[np.arange(size), low] += 1 - frac
+    weights[np.arange(size), high] += frac
+    return weights
+
+
+def render_tile(points, z, x, y, sigma_m, lut, opacity, vmax_per_km2):
+    """
+    Renders one 256 px tile of a heat layer.
+
+    Values are densities per km2 on the ground, so the colours of neighbouring
+    tiles and of different zoom levels agree. Kernels wider than a few pixels
+    are evaluated on a coarser grid and interpolated up, which keeps the FFT
+    small at street-level zooms.
+
+    Args:
+        points (TilePoints): The layer's points.
+        z (int): Zoom level.
+        x (int): Tile column.
+        y (int): Tile row.
+        sigma_m (float): Kernel standard deviation in metres on the ground.
+        lut (np.ndarray): Colour lookup table, see density.colour_lut.
+        opacity (float): Maximum alpha.
+        vmax_per_km2 (float): Density mapped to the top of the colour scale.
+
+    Returns:
+        bytes: The PNG tile.
+    """
+    size = 2 * HALF_WORLD / 2 ** z
+    west = -HALF_WORLD + x * size
+    north = HALF_WORLD - y * size
+
+    # Mercator metres are stretched by 1 / cos(lat) relative to the ground
+    scale = math.cos(math.radians(mercator_to_lat(north - size / 2)))
+    sigma_px = max(sigma_m / scale / (size / TILE_SIZE), 0.5)
+
+    # Coarse grid with at most ~4 cells per sigma
+    factor = max(1, int(sigma_px // 4))
+    cells = int(math.ceil(TILE_SIZE / factor))
+    cell = size / TILE_SIZE * factor
+    sigma_cells = sigma_px / factor
+    pad = int(math.ceil(3 * sigma_cells))
+
+    south_edge, north_edge = north - (cells + pad) * cell, north + pad * cell
+    west_edge, east_edge = west - pad * cell, west + (cells + pad) * cell
+    xs, ys, weights = points.select(west_edge, south_edge, east_edge, north_edge)
+    bins = cells + 2 * pad
+    grid, _, _ = np.histogram2d(ys, xs, bins=(bins, bins), weights=weights,
+                                range=[[south_edge, north_edge], [west_edge, east_edge]])
+    grid = density.gaussian_blur(grid[::-1], sigma_cells)[pad:pad + cells, pad:pad + cells]
+    grid = grid / (cell * scale / 1000) ** 2
+
+    if factor > 1:
+        interp = upsample_matrix(cells, factor)
+        grid = interp @ grid @ interp.T
+    return density.encode_png(density.colorize(grid, lut, opacity, vmax_per_km2))
+
+
+class TileCache:
+    """
+    Size-bounded on-disk LRU of tiles.
+
+    A hit refreshes the file's mtime; when a write takes the cache over its
+    budget, the least recently used files are deleted down to 90% of it.
+    Writes go through a temporary file and a rename, so several worker
+    processes can share the directory. The budget is for all of them
+    together: the total size is kept in a .size file next to the tiles and
+    updated under an fcntl lock on a .lock file, so only a write that takes
+    the shared total over the budget walks the tree.
+    """
+
+    def __init__(self, root, max_bytes=TILE_CACHE_BYTES, ext='png'):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ext = ext
+        self.lock = threading.Lock()
+        self.size_path = os.path.join(root, '.size')
+
+    def path(self, version, layer, z, x, y):
+        return os.path.join(self.root, version, layer, str(z), str(x), '%d.%s' % (y, self.ext))
+
+    def get(self, key):
+        path = self.path(*key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return data
+
+    def put(self, key, data):
+        path = self.path(*key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        with self.lock, self.shared_lock():
+            # Another worker may have written the same tile first
+            try:
+                replaced = os.stat(path).st_size
+            except FileNotFoundError:
+                replaced = 0
+            os.replace(tmp, path)
+            total = self.read_total()
+            if total is None:
+                total = sum(size for _, _, size in self.files())
+            else:
+                total += len(data) - replaced
+            if total > self.max_bytes:
+                total = self.evict(int(self.max_bytes * 0.9))
+            self.write_total(total)
+
+    @contextlib.contextmanager
+    def shared_lock(self):
+        # Held by one process at a time; without fcntl only self.lock is held
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.root, '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def read_total(self):
+        # The bytes of all tiles, as of the last write by any process; None when unknown
+        try:
+            with open(self.size_path) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def write_total(self, total):
+        with open(self.size_path, 'w') as f:
+            f.write(str(total))
+
+    def files(self):
+        for folder, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith('.' + self.ext):
+                    path = os.path.join(folder, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    yield path, stat.st_mtime, stat.st_size
+
+    def evict(self, target):
+        files = sorted(self.files(), key=lambda item: item[1])
+        total = sum(size for _, _, size in files)
+        for path, _, size in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
+
+
+class TileRenderer:
+    """
+    Heat layer tiles of one bundle.
+
+    Point arrays are built from the bundle tables on first use of a layer.
+    """
+
+    def __init__(self, bundle, cache=None):
+        self.bundle = bundle
+        self.cache = cache or TileCache(os.path.join(os.path.dirname(bundle.path), 'tiles'))
+        self.lut = density.colour_lut(sequential.Plasma)
+        self.points = {}
+        self.lock = threading.Lock()
+
+    def layer_points(self, layer):
+        with self.lock:
+            if layer not in self.points:
+                spec = density.HEAT_LAYERS[layer]
+                df = self.bundle.table(spec['table'])
+                weights = df[spec['weight']] if spec['weight'] else None
+                self.points[layer] = TilePoints(df['Lat'], df['Long'], weights)
+            return self.points[layer]
+
+    def tile(self, layer, z, x, y):
+        """
+        PNG bytes of a tile, from the cache or freshly rendered.
+
+        Args:
+            layer (str): One of density.HEAT_LAYERS.
+            z (int): Zoom level.
+            x (int): Tile column.
+            y (int): Tile row.
+
+        Returns:
+            bytes: The PNG tile, or None for an unknown layer or tile index.
+        """
+        if layer not in density.HEAT_LAYERS or not (0 <= z <= 22 and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            return None
+        key = (self.bundle.version, layer, z, x, y)
+        data = self.cache.get(key)
+        if data is None:
+            spec = density.HEAT_LAYERS[layer]
+            meta = self.bundle.manifest['rasters'][layer]
+            data = render_tile(self.layer_points(layer), z, x, y, spec['sigma_m'], self.lut, spec['opacity'],
+                               meta['peaks_per_km2'][density.DEFAULT_RESOLUTION])
+            self.cache.put(key, data)
+        return data
+
+    def seed(self, zooms=SEED_ZOOMS, layers=None):
+        """
+        Renders every tile over the city for zoom levels zooms[0]..zooms[1].
+
+        Returns:
+            int: Number of tiles seeded.
+        """
+        count = 0
+        for layer in layers or density.HEAT_LAYERS:
+            bounds = self.bundle.manifest['rasters'][layer]['bounds']
+            for z in range(zooms[0], zooms[1] + 1):
+                xs, ys = tile_range(bounds, z)
+                for x in xs:
+                    for y in ys:
+                        self.tile(layer, z, x, y)
+                        count += 1
+        return count
+
+
+def tile_url(layer, version, city=None):
+    # The version only busts browser caches; the server answers from the city's current bundle
+    query = 'v=%s' % version if city is None else 'city=%s&v=%s' % (city, version)
+    return '/tiles/%s/{z}/{x}/{y}.png?%s' % (layer, query)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pre-seed the heat layer tile cache of the current bundle.')
+    parser.add_argument('--zoom', type=int, nargs=2, default=SEED_ZOOMS, metavar=('MIN', 'MAX'))
+    parser.add_argument('--layer', action='append', help='layer to seed (default: all)')
+    args = parser.parse_args(argv)
+
+    renderer = TileRenderer(artifacts.load_bundle())
+    print("Seeded", renderer.seed(args.zoom, args.layer), "tiles")
+
+
+if __name__ == '__main__':
+    main()
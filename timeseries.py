@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Per-route pass-up time series.
+
+All pass-ups are counted once into a compact route x day x time period
+matrix in one grouped pass, which the build stores in the bundle. Every
+route keeps its own row, including the ones grouped into 'Other' on the
+maps. Daily and weekly series, rolling statistics, peak-period breakdowns
+and seasonal profiles of a route are slices and sums of its row, and new
+pass-ups are added to the matrix in place.
+"""
+
+import threading
+
+import numpy as np
+import pandas as pd
+
+# Time periods of pipeline.time_period, in order of their hour ranges
+PERIODS = ['0-6am', '6-9am', '9-12am', '12-3pm', '3-6pm', '6-12pm']
+PERIOD_HOURS = [6, 9, 12, 15, 18]
+PEAK_PERIODS = ['6-9am', '3-6pm']
+
+# Rolling window per series frequency, in steps of that frequency
+ROLLING_WINDOWS = {'D': 28, 'W': 8}
+
+
+def period_codes(hours):
+    # Column of every hour in PERIODS
+    return np.digitize(np.asarray(hours, dtype=float), PERIOD_HOURS)
+
+
+def day_numbers(times):
+    # Days since the epoch, -1 for NaT
+    times = pd.to_datetime(pd.Series(times), errors='coerce')
+    days = times.to_numpy(dtype='datetime64[D]').astype(np.int64)
+    return np.where(times.isna().to_numpy(), -1, days)
+
+
+class RouteDayMatrix:
+    """
+    Pass-up counts per route, day and time period.
+
+    Attributes:
+        routes (list): Route labels, one per matrix row.
+        start (int): Day number (days since 1970-01-01) of the first column.
+        counts (np.ndarray): uint16 counts of shape (routes, days, len(PERIODS)),
+            widened to uint32 if a cell ever overflows.
+    """
+
+    def __init__(self, routes, start, counts):
+        self.routes = list(routes)
+        self.index = {route: row for row, route in enumerate(self.routes)}
+        self.start = int(start)
+        self.counts = counts
+        self.lock = threading.Lock()
+        self.series_cache = {}
+        # Bumped by every add, so callers can key their own caches on it
+        self.revision = 0
+
+    @classmethod
+    def from_passups(cls, passup_within, route_column='Route'):
+        """
+        Counts the pass-ups in one grouped pass.
+
+        Args:
+            passup_within (pd.DataFrame): The cleaned pass-ups within the city.
+            route_column (str): Column with the ungrouped route labels.
+
+        Returns:
+            RouteDayMatrix: The matrix, routes ordered by their total count.
+        """
+        routes = [str(route) for route in passup_within[route_column].value_counts().index]
+        matrix = cls(routes, 0, np.zeros((len(routes), 0, len(PERIODS)), dtype=np.uint16))
+        matrix.add(passup_within, route_column)
+        return matrix
+
+    @classmethod
+    def from_bundle(cls, bundle):
+        meta = bundle.manifest['route_day']
+        return cls(meta['routes'], meta['start'], bundle.array('route_day'))
+
+    def meta(self):
+        """Manifest entry of the matrix; the counts go to the bundle's 'route_day' array."""
+        return {'routes': self.routes, 'start': self.start, 'periods': PERIODS}
+
+    @property
+    def days(self):
+        return pd.to_datetime(np.arange(self.start, self.start + self.counts.shape[1]), unit='D')
+
+    def add(self, passups, route_column='Route'):
+        """
+        Adds pass-ups to the matrix in place.
+
+        New routes get new rows and the day range grows as needed; only the
+        cells touched by the new rows are updated.
+
+        Args:
+            passups (pd.DataFrame): Pass-ups with route_column, 'Time' and 'Hour'.
+            route_column (str): Column with the ungrouped route labels.
+
+        Returns:
+            int: Number of pass-ups counted.
+        """
+        routes = passups[route_column]
+        days = day_numbers(passups['Time'])
+        keep = routes.notna().to_numpy() & (days >= 0)
+        if not keep.any():
+            return 0
+        routes, days = routes[keep].astype(str), days[keep]
+        periods = period_codes(passups['Hour'].to_numpy()[keep])
+
+        with self.lock:
+            for route in pd.unique(routes):
+                if route not in self.index:
+                    self.index[route] = len(self.routes)
+                    self.routes.append(route)
+
+            # Grow the matrix only when the new rows fall outside it
+            n_days = self.counts.shape[1]
+            first = min(int(days.min()), self.start) if n_days else int(days.min())
+            last = max(int(days.max()), self.start + n_days - 1) if n_days else int(days.max())
+            shape = (len(self.routes), last - first + 1, len(PERIODS))
+            counts = self.counts
+            if shape != counts.shape:
+                counts = np.zeros(shape, dtype=self.counts.dtype)
+                offset = self.start - first
+                counts[:self.counts.shape[0], offset:offset + n_days] = self.counts
+            elif not counts.flags.writeable:
+                # Arrays of a bundle are read-only memory maps
+                counts = np.array(counts)
+
+            rows = routes.map(self.index).to_numpy(dtype=np.int64)
+            cells, added = np.unique((rows * shape[1] + (days - first)) * shape[2] + periods, return_counts=True)
+            values = counts.reshape(-1)[cells].astype(np.int64) + added
+            if values.max() > np.iinfo(counts.dtype).max:
+                counts = counts.astype(np.uint32)
+            counts.reshape(-1)[cells] = values
+
+            self.counts = counts
+            self.start = first
+            self.series_cache.clear()
+            self.revision += 1
+        return int(keep.sum())
+
+    def totals(self):
+        """Total pass-ups per route, in row order."""
+        return pd.Series(self.counts.sum(axis=(1, 2), dtype=np.int64), index=self.routes)
+
+    def series(self, route, freq='D'):
+        """
+        Pass-up counts of a route over time, cached until the next add.
+
+        Args:
+            route (str): A route label.
+            freq (str): 'D' for daily or 'W' for weekly counts.
+
+        Returns:
+            pd.DataFrame: Indexed by date, one column per time period plus
+            'Peak' (6-9am and 3-6pm), 'Off-peak', 'Count', 'Rolling Mean'
+            and 'Rolling Std' over ROLLING_WINDOWS[freq] steps.
+        """
+        key = (route, freq)
+        cached = self.series_cache.get(key)
+        if cached is not None:
+            return cached
+
+        df = pd.DataFrame(np.asarray(self.counts[self.index[route]], dtype=np.int64), index=self.days, columns=PERIODS)
+        if freq != 'D':
+            df = df.resample(freq).sum()
+        df['Peak'] = df[PEAK_PERIODS].sum(axis=1)
+        df['Count'] = df[PERIODS].sum(axis=1)
+        df['Off-peak'] = df['Count'] - df['Peak']
+        rolling = df['Count'].rolling(ROLLING_WINDOWS[freq], min_periods=1)
+        df['Rolling Mean'] = rolling.mean()
+        df['Rolling Std'] = rolling.std().fillna(0)
+        self.series_cache[key] = df
+        return df
+
+    def seasonality(self, route):
+        """
+        Average daily pass-ups of a route by month of year and by weekday.
+
+        Returns:
+            tuple: (pd.Series indexed 1-12, pd.Series indexed 0-6 with Monday = 0).
+        """
+        daily = self.series(route)['Count']
+        return daily.groupby(daily.index.month).mean(), daily.groupby(daily.index.dayofweek).mean()
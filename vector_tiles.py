@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Vector tiles of the stop and pass-up points.
+
+At build time every point table gets a Morton (z-order) code of its tile at
+MORTON_ZOOM, and the codes are stored sorted together with the row order.
+All points of a tile (z, x, y) with z <= MORTON_ZOOM then share a code
+prefix, so a tile is one contiguous range of that order found by two binary
+searches.
+
+Tiles are served as compact GeoJSON from
+/vtiles/<layer>/<z>/<x>/<y>.geojson?city=<key>&v=<version> and cached on
+disk per data version; like the heat map tiles, they come from the city's
+current bundle, and are cached by browsers for good when v is that version. The scatter views use the same index
+to plot only the points in view once a table is larger than
+VECTOR_TILE_THRESHOLD.
+"""
+
+import json
+import math
+import os
+
+import numpy as np
+
+from tiles import HALF_WORLD, TileCache, tile_range, to_mercator
+
+MORTON_ZOOM = 16
+
+# Point layers: source table and the columns sent as feature properties
+VECTOR_LAYERS = {
+    'stops': {'table': 'stops', 'properties': ['stop_id', 'stop_name', 'stop_url']},
+    'passups': {'table': 'passups', 'properties': ['Pass-Up ID', 'Route Name', 'Route Number', 'Pass-Up Type', 'Time']},
+}
+
+# Scatter views switch to tiled points above this many rows
+VECTOR_TILE_THRESHOLD = int(os.environ.get('WTC_VECTOR_TILE_POINTS', 50000))
+# Most points sent for one tile or one view; denser areas are thinned evenly along the Morton order
+MAX_TILE_FEATURES = 5000
+MAX_VIEW_POINTS = int(os.environ.get('WTC_MAX_VIEW_POINTS', 20000))
+
+
+def tile_xy(lat, lon, z):
+    xs, ys = to_mercator(lat, lon)
+    n = 2 ** z
+    size = 2 * HALF_WORLD / n
+    tx = np.clip(((xs + HALF_WORLD) // size), 0, n - 1).astype(np.uint64)
+    ty = np.clip(((HALF_WORLD - ys) // size), 0, n - 1).astype(np.uint64)
+    return tx, ty
+
+
+def interleave(x, y):
+    """Morton code of 16-bit tile indices: the bits of x and y interleaved, y first."""
+    def spread(v):
+        v = np.asarray(v, dtype=np.uint64) & np.uint64(0xFFFF)
+        v = (v | (v << np.uint64(8))) & np.uint64(0x00FF00FF)
+        v = (v | (v << np.uint64(4))) & np.uint64(0x0F0F0F0F)
+        v = (v | (v << np.uint64(2))) & np.uint64(0x33333333)
+        v = (v | (v << np.uint64(1))) & np.uint64(0x55555555)
+        return v
+    return spread(x) | (spread(y) << np.uint64(1))
+
+
+def spatial_index(df):
+    """
+    Morton-sorted index of a point table.
+
+    Args:
+        df (pd.DataFrame): A table with 'Lat' and 'Long'.
+
+    Returns:
+        dict: 'codes' (sorted uint64 Morton codes at MORTON_ZOOM) and 'order'
+        (row positions of df in that order).
+    """
+    lat = df['Lat'].to_numpy(dtype=float)
+    lon = df['Long'].to_numpy(dtype=float)
+    codes = interleave(*tile_xy(lat, lon, MORTON_ZOOM))
+    order = np.argsort(codes, kind='stable')
+    return {'codes': codes[order], 'order': order.astype(np.int64)}
+
+
+def build_spatial_indexes(tables):
+    """Arrays to store in the bundle: '<layer>_codes' and '<layer>_order' for every layer."""
+    arrays = {}
+    for layer, spec in VECTOR_LAYERS.items():
+        index = spatial_index(tables[spec['table']])
+        arrays[layer + '_codes'] = index['codes']
+        arrays[layer + '_order'] = index['order']
+    return arrays
+
+
+def thin(positions, limit):
+    # Evenly spaced picks along the Morton order spread over the whole area
+    if len(positions) <= limit:
+        return positions
+    return positions[np.linspace(0, len(positions) - 1, limit).astype(np.int64)]
+
+
+def viewport(relayout, default_bounds, default_zoom, width=1000, height=600):
+    """
+    Visible box and zoom of a map from its relayoutData.
+
+    Args:
+        relayout (dict): dcc.Graph relayoutData, or None for the initial view.
+        default_bounds (tuple): (west, south, east, north) when nothing is known yet.
+        default_zoom (float): Zoom level of the initial view.
+        width (int): Assumed map width in pixels when the corners aren't reported.
+        height (int): Assumed map height in pixels.
+
+    Returns:
+        tuple: ((west, south, east, north), zoom, (center_lat, center_lon)), or
+        None if relayout has no map position.
+    """
+    if not relayout:
+        west, south, east, north = default_bounds
+        return default_bounds, default_zoom, ((south + north) / 2, (west + east) / 2)
+    if 'mapbox.center' not in relayout or 'mapbox.zoom' not in relayout:
+        return None
+    center = relayout['mapbox.center']
+    zoom = relayout['mapbox.zoom']
+    corners = relayout.get('mapbox._derived', {}).get('coordinates')
+    if corners:
+        lons = [c[0] for c in corners]
+        lats = [c[1] for c in corners]
+        bounds = (min(lons), min(lats), max(lons), max(lats))
+    else:
+        degrees_per_px = 360 / (256 * 2 ** zoom)
+        dx = width / 2 * degrees_per_px
+        dy = height / 2 * degrees_per_px * math.cos(math.radians(center['lat']))
+        bounds = (center['lon'] - dx, center['lat'] - dy, center['lon'] + dx, center['lat'] + dy)
+    return bounds, zoom, (center['lat'], center['lon'])
+
+
+class VectorTiles:
+    """Tile ranges and GeoJSON tiles of the point layers of one bundle."""
+
+    def __init__(self, bundle, cache=None):
+        self.bundle = bundle
+        self.cache = cache or TileCache(os.path.join(os.path.dirname(bundle.path), 'vtiles'), ext='geojson')
+
+    def index(self, layer):
+        return self.bundle.array(layer + '_codes'), self.bundle.array(layer + '_order')
+
+    def table(self, layer):
+        return self.bundle.table(VECTOR_LAYERS[layer]['table'])
+
+    def tile_positions(self, layer, z, x, y):
+        """
+        Row positions of the points in tile (z, x, y), in Morton order.
+
+        Tiles deeper than MORTON_ZOOM read their parent's range and filter it.
+        """
+        codes, order = self.index(layer)
+        depth = min(z, MORTON_ZOOM)
+        shift = np.uint64(2 * (MORTON_ZOOM - depth))
+        prefix = interleave(x >> (z - depth), y >> (z - depth))
+        start, stop = np.searchsorted(codes, [prefix << shift, (prefix + np.uint64(1)) << shift])
+        positions = np.asarray(order[start:stop])
+        if z > MORTON_ZOOM:
+            df = self.table(layer)
+            tx, ty = tile_xy(df['Lat'].to_numpy()[positions], df['Long'].to_numpy()[positions], z)
+            positions = positions[(tx == x) & (ty == y)]
+        return positions
+
+    def view_tiles(self, bounds, zoom):
+        """
+        The tiles view_positions reads for a viewport: every viewport with the
+        same tiles gets the same points.
+
+        Returns:
+            tuple: (tile zoom, range of x, range of y).
+        """
+        z = int(min(max(math.floor(zoom) + 1, 0), MORTON_ZOOM))
+        xs, ys = tile_range(bounds, z)
+        return z, xs, ys
+
+    def view_positions(self, layer, bounds, zoom, limit=MAX_VIEW_POINTS):
+        """
+        Row positions of the points in a viewport, thinned to at most limit.
+
+        Args:
+            layer (str): One of VECTOR_LAYERS.
+            bounds (tuple): (west, south, east, north).
+            zoom (float): Map zoom; tiles one level deeper are read.
+            limit (int): Most points to return.
+
+        Returns:
+            np.ndarray: Row positions into the layer's table.
+        """
+        z, xs, ys = self.view_tiles(bounds, zoom)
+        parts = [self.tile_positions(layer, z, x, y) for x in xs for y in ys]
+        positions = np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+        return thin(positions, limit)
+
+    def tile(self, layer, z, x, y):
+        """
+        GeoJSON FeatureCollection of a tile, from the cache or freshly cut.
+
+        Returns:
+            bytes: The GeoJSON, or None for an unknown layer or tile index.
+        """
+        if layer not in VECTOR_LAYERS or not (0 <= z <= 22 and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            return None
+        key = (self.bundle.version, layer, z, x, y)
+        data = self.cache.get(key)
+        if data is None:
+            data = self.geojson(layer, thin(self.tile_positions(layer, z, x, y), MAX_TILE_FEATURES))
+            self.cache.put(key, data)
+        return data
+
+    def geojson(self, layer, positions):
+        rows = self.table(layer).iloc[positions]
+        properties = json.loads(rows[VECTOR_LAYERS[layer]['properties']].to_json(orient='records', date_format='iso'))
+        features = [
+            {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [round(lon, 6), round(lat, 6)]}, 'properties': props}
+            for lon, lat, props in zip(rows['Long'].tolist(), rows['Lat'].tolist(), properties)
+        ]
+        return json.dumps({'type': 'FeatureCollection', 'features': features}, separators=(',', ':')).encode()
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Walking distance from census points to their nearest stop over the street network.
+
+The walk graph is read from a GraphML file saved by osmnx (downloaded once
+with --download). Stops and census points are snapped to their nearest
+graph node, and a single multi-source Dijkstra run over the reversed edges,
+seeded with every stop at once, gives each node its walking distance to the
+closest stop and which stop that is. Any set of points is then answered by
+array lookups.
+
+The per-node result depends only on the graph and the stops, so it is
+cached in memory and on disk under WALK_CACHE_DIR, keyed by the content
+hash of both:
+
+    python walk.py --graph cache/winnipeg_walk.graphml --download
+"""
+
+import argparse
+import hashlib
+import heapq
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import shapely
+
+import artifacts
+
+WALK_CACHE_DIR = os.environ.get('WTC_WALK_CACHE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'walk'))
+# Nodes farther than this from every stop are left at inf
+MAX_WALK_METERS = 3000
+
+METERS_PER_DEGREE = 111320.0
+
+WALK_COLUMNS = ['Walk to Stop (m)', 'Nearest Stop', 'Straight Line (m)']
+
+# Per-node results of this process, keyed like the disk cache
+_memory_cache = {}
+
+
+def load_graph(path, place=None):
+    """
+    Reads a walk graph from GraphML, downloading and saving it first if a place is given and the file is missing.
+
+    Args:
+        path (str): The GraphML file.
+        place (str): Place name to download the walk network of, e.g. pipeline.CITY.
+
+    Returns:
+        networkx.MultiDiGraph: The graph, with 'x'/'y' node and 'length' edge attributes.
+    """
+    import osmnx as ox
+
+    if not os.path.exists(path) and place is not None:
+        graph = ox.graph_from_place(place, network_type='walk')
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        ox.save_graphml(graph, path)
+    return ox.load_graphml(path)
+
+
+class WalkGraph:
+    """
+    A street graph as compressed sparse rows over the reversed edges.
+
+    Args:
+        graph (networkx.Graph): Any networkx graph with 'x' (longitude) and
+            'y' (latitude) on its nodes and 'length' (metres) on its edges;
+            undirected graphs are walked both ways.
+    """
+
+    def __init__(self, graph):
+        nodes = list(graph.nodes)
+        index = {node: i for i, node in enumerate(nodes)}
+        self.x = np.array([graph.nodes[node]['x'] for node in nodes], dtype=float)
+        self.y = np.array([graph.nodes[node]['y'] for node in nodes], dtype=float)
+
+        edges = [(index[u], index[v], float(data.get('length', 0))) for u, v, data in graph.edges(data=True)]
+        u = np.array([edge[0] for edge in edges], dtype=np.int64)
+        v = np.array([edge[1] for edge in edges], dtype=np.int64)
+        length = np.array([edge[2] for edge in edges], dtype=float)
+        if not graph.is_directed():
+            u, v, length = np.r_[u, v], np.r_[v, u], np.r_[length, length]
+        # Reversed: a run from the stops follows edges backwards, giving node -> stop distances
+        order = np.lexsort((length, u, v))
+        self.indptr = np.r_[0, np.cumsum(np.bincount(v[order], minlength=len(nodes)))].astype(np.int64)
+        self.indices = u[order].astype(np.int64)
+        self.weights = length[order]
+
+        self.lat0 = float(self.y.mean()) if len(nodes) else 0.0
+        self.tree = shapely.STRtree(shapely.points(*self.project(self.y, self.x)))
+        self.version = self.digest()
+
+    def project(self, lat, lon):
+        # Local equirectangular metres, so planar nearest neighbours are nearest on the ground
+        scale = np.cos(np.radians(self.lat0))
+        return np.asarray(lon, dtype=float) * scale * METERS_PER_DEGREE, np.asarray(lat, dtype=float) * METERS_PER_DEGREE
+
+    def digest(self):
+        sha = hashlib.sha1()
+        for array in (self.x, self.y, self.indptr, self.indices, self.weights):
+            sha.update(np.ascontiguousarray(array).tobytes())
+        return sha.hexdigest()[:12]
+
+    def nearest_nodes(self, lat, lon):
+        """
+        Nearest graph node of every point.
+
+        Returns:
+            tuple: (node indexes, straight-line metres to them).
+        """
+        points = shapely.points(*self.project(lat, lon))
+        _, nodes = self.tree.query_nearest(points, all_matches=False, return_distance=False)
+        px, py = self.project(lat, lon)
+        node_x, node_y = self.project(self.y[nodes], self.x[nodes])
+        return nodes, np.hypot(px - node_x, py - node_y)
+
+    def multi_source_dijkstra(self, sources, offsets, cutoff=MAX_WALK_METERS):
+        """
+        Distance from every node to its closest source, in one run.
+
+        Args:
+            sources (np.ndarray): Source node of every stop.
+            offsets (np.ndarray): Metres from every stop to its source node.
+            cutoff (float): Distances beyond this are not explored.
+
+        Returns:
+            tuple: (distance per node, inf where unreached; stop number per node, -1 where unreached).
+        """
+        # Plain lists: the loop below touches single elements, which numpy is slow at
+        dist = [float('inf')] * len(self.x)
+        origin = [-1] * len(self.x)
+        heap = []
+        for stop, (node, offset) in enumerate(zip(sources.tolist(), offsets.tolist())):
+            if offset < dist[node]:
+                dist[node], origin[node] = offset, stop
+                heap.append((offset, node, stop))
+        heapq.heapify(heap)
+
+        indptr, indices, weights = self.indptr.tolist(), self.indices.tolist(), self.weights.tolist()
+        while heap:
+            d, node, stop = heapq.heappop(heap)
+            if d > dist[node]:
+                continue  # A shorter path got here first
+            for k in range(indptr[node], indptr[node + 1]):
+                nd = d + weights[k]
+                neighbour = indices[k]
+                if nd < dist[neighbour] and nd <= cutoff:
+                    dist[neighbour], origin[neighbour] = nd, stop
+                    heapq.heappush(heap, (nd, neighbour, stop))
+        return np.array(dist), np.array(origin, dtype=np.int64)
+
+
+def stop_set_version(stops):
+    sha = hashlib.sha1()
+    sha.update(stops['stop_id'].astype(str).str.cat(sep='\n').encode())
+    sha.update(np.ascontiguousarray(stops[['Lat', 'Long']].to_numpy(dtype=float)).tobytes())
+    return sha.hexdigest()[:12]
+
+
+def node_access(walk_graph, stops, cutoff=MAX_WALK_METERS, cache_dir=WALK_CACHE_DIR):
+    """
+    Walking distance and nearest stop of every graph node, cached by graph and stop-set version.
+
+    Args:
+        walk_graph (WalkGraph): The street graph.
+        stops (pd.DataFrame): Stops with 'stop_id', 'Lat' and 'Long'.
+        cutoff (float): Longest walk explored.
+        cache_dir (str): Directory of the disk cache; None keeps the result in memory only.
+
+    Returns:
+        dict: 'dist' and 'origin' (index into stops) per node, and the cache 'key'.
+    """
+    key = '%s-%s-%d' % (walk_graph.version, stop_set_version(stops), cutoff)
+    if key in _memory_cache:
+        return _memory_cache[key]
+    path = os.path.join(cache_dir, key + '.npz') if cache_dir else None
+    if path and os.path.exists(path):
+        with np.load(path) as cached:
+            result = {'dist': cached['dist'], 'origin': cached['origin'], 'key': key}
+    else:
+        sources, offsets = walk_graph.nearest_nodes(stops['Lat'].to_numpy(), stops['Long'].to_numpy())
+        dist, origin = walk_graph.multi_source_dijkstra(sources, offsets, cutoff)
+        result = {'dist': dist, 'origin': origin, 'key': key}
+        if path:
+            # Written under a temporary name and renamed, so concurrent builds never read a partial file
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = '%s.%d.tmp.npz' % (path[:-4], os.getpid())
+            np.savez(tmp, dist=dist, origin=origin)
+            os.replace(tmp, path)
+    _memory_cache[key] = result
+    return result
+
+
+def walk_access(points, stops, walk_graph, cutoff=MAX_WALK_METERS, cache_dir=WALK_CACHE_DIR):
+    """
+    Network walking distance from every point to its nearest stop.
+
+    The walk is the straight line to the point's nearest graph node, the
+    network path, and the straight line from the stop's node to the stop.
+
+    Args:
+        points (pd.DataFrame): Points with 'Lat' and 'Long', e.g. census_within.
+        stops (pd.DataFrame): Stops with 'stop_id', 'Lat' and 'Long'.
+        walk_graph (WalkGraph): The street graph.
+        cutoff (float): Longest walk explored; farther points get NaN.
+        cache_dir (str): Directory of the disk cache, see node_access.
+
+    Returns:
+        pd.DataFrame: WALK_COLUMNS, indexed like points.
+    """
+    stops = stops.reset_index(drop=True)
+    access = node_access(walk_graph, stops, cutoff, cache_dir)
+    nodes, offsets = walk_graph.nearest_nodes(points['Lat'].to_numpy(), points['Long'].to_numpy())
+    dist = access['dist'][nodes] + offsets
+    origin = access['origin'][nodes]
+    reached = (origin >= 0) & (dist <= cutoff)
+
+    # Straight-line distance to the same stop, for comparison with the old radius rule
+    stop_x, stop_y = walk_graph.project(stops['Lat'].to_numpy(), stops['Long'].to_numpy())
+    px, py = walk_graph.project(points['Lat'].to_numpy(), points['Long'].to_numpy())
+    safe = np.where(reached, origin, 0)
+    straight = np.hypot(px - stop_x[safe], py - stop_y[safe]) if len(stops) else np.zeros(len(points))
+
+    return pd.DataFrame({
+        'Walk to Stop (m)': np.where(reached, dist, np.nan).round(1),
+        'Nearest Stop': pd.Series(stops['stop_id'].astype(str).to_numpy()[safe] if len(stops) else [None] * len(points),
+                                  index=points.index).where(reached),
+        'Straight Line (m)': np.where(reached, straight, np.nan).round(1),
+    }, index=points.index)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Walking distance from the census points of the current bundle to their nearest stop.')
+    parser.add_argument('--graph', required=True, help='GraphML walk network')
+    parser.add_argument('--download', action='store_true', help='download the walk network of the city if the file is missing')
+    parser.add_argument('--cutoff', type=float, default=MAX_WALK_METERS, help='longest walk in metres')
+    parser.add_argument('--top', type=int, default=10, help='number of farthest points to print')
+    args = parser.parse_args(argv)
+
+    bundle = artifacts.load_bundle()
+    start = time.perf_counter()
+    walk_graph = WalkGraph(load_graph(args.graph, bundle.manifest['params']['city'] if args.download else None))
+    loaded = time.perf_counter()
+    census = bundle.table('census')
+    access = walk_access(census, bundle.table('stops'), walk_graph, args.cutoff)
+    print("Graph of %d nodes loaded in %.2fs; walk access of %d census points in %.2fs" % (
+        len(walk_graph.x), loaded - start, len(census), time.perf_counter() - loaded))
+    print(access.describe().round(1).to_string())
+    print(census[['DAUID', 'Total_15_to_19_years']].join(access).nlargest(args.top, 'Walk to Stop (m)').to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()